@@ -26,27 +26,122 @@ monkey.patch_all()
 import flask
 import urllib
 import urllib.parse
+import threading
+import time
 import os
 
 from functools import reduce, wraps
+from operator import attrgetter
 from flask import request
 from werkzeug.utils import secure_filename
 from ipaddress import ip_address, ip_network
 
 from .database import Database
 from .streamer import Streamer
-from .cast import Cast
+from .sessions import SessionRegistry, MatroskaScanner, MP4Scanner
+from .cache import DiskCache
+from .delivery import send_file
+from .process import ManagedProcess
+from .pretranscode import Pretranscoder
+from .index import Indexer
+from .thumbnail import Thumbnailer
+from .upload import partial_path, create_partial, write_chunk, finish_partial, received, missing
+from .scheduler import Scheduler, SchedulerFull, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
+from . import metrics
+from .cast import CastService, NoDevice, ENABLE_CHROMECAST, COMMANDS as CAST_COMMANDS
 
 app = flask.Flask(__name__, static_url_path="/static")
 app.config.from_object("config")
 app.secret_key = os.urandom(16)
 
-filesDirectory = os.path.join(app.root_path, "files")
-databaseFile = os.path.join(app.root_path, "database.db")
+filesDirectory = app.config.get("FILES_DIRECTORY") or os.path.join(app.root_path, "files")
+databaseFile = app.config.get("DATABASE_FILE") or os.path.join(app.root_path, "database.db")
+cacheDirectory = app.config.get("CACHE_DIRECTORY") or os.path.join(app.root_path, "cache")
 
-db = Database(databaseFile)
+db = Database(databaseFile, app.config.get("DATABASE_POOL_SIZE", 8))
 db.init()
 
+scheduler = Scheduler(
+    max_jobs=app.config.get("MAX_TRANSCODES", 0),
+    queue_size=app.config.get("TRANSCODE_QUEUE_SIZE", 16),
+    queue_timeout=app.config.get("TRANSCODE_QUEUE_TIMEOUT", 30),
+    retry_after=app.config.get("TRANSCODE_RETRY_AFTER", 10),
+)
+
+sessions = SessionRegistry(
+    buffer_size=app.config.get("STREAM_BUFFER_SIZE", 16 * 1024 * 1024),
+    chunk_size=app.config.get("STREAM_CHUNK_SIZE", 256 * 1024),
+    lag_timeout=app.config.get("STREAM_LAG_TIMEOUT", 10),
+    scheduler=scheduler,
+)
+
+pretranscoder = Pretranscoder(
+    db,
+    os.path.join(cacheDirectory, "transcoded"),
+    workers=app.config.get("PRETRANSCODE_WORKERS", 1),
+    niceness=app.config.get("PRETRANSCODE_NICENESS", 10),
+)
+
+indexer = Indexer(db, app.config.get("INDEX_RESCAN_INTERVAL", 600))
+
+segments = DiskCache(
+    os.path.join(cacheDirectory, "segments"),
+    app.config.get("SEGMENT_CACHE_SIZE", 4 * 1024 * 1024 * 1024),
+)
+
+caster = CastService() if ENABLE_CHROMECAST else None
+
+thumbnailer = Thumbnailer(
+    db,
+    DiskCache(
+        os.path.join(cacheDirectory, "thumbnails"),
+        app.config.get("THUMBNAIL_CACHE_SIZE", 512 * 1024 * 1024),
+    ),
+    workers=app.config.get("THUMBNAIL_WORKERS", 1),
+    niceness=app.config.get("PRETRANSCODE_NICENESS", 10),
+)
+
+
+def session_values(attribute):
+    # Values of a gauge by session, sessions without a progress report are left out
+    get = attrgetter(attribute)
+    return lambda: [((s.id,), get(s)) for s in sessions.sessions() if get(s) is not None]
+
+
+metrics.registry.gauge(
+    "swamp_transcode_sessions",
+    "Running transcoding sessions",
+    callback=lambda: [((), len(sessions))],
+)
+metrics.registry.gauge(
+    "swamp_streams_active",
+    "Clients receiving a transcoded stream",
+    callback=lambda: [((), sum(s.subscribers for s in sessions.sessions()))],
+)
+metrics.registry.gauge(
+    "swamp_processes_live",
+    "Running child processes",
+    callback=lambda: [((), ManagedProcess.stats()["live"])],
+)
+metrics.registry.gauge(
+    "swamp_stream_throughput_bytes",
+    "Bytes per second produced by the encoder of each session",
+    ("session",),
+    callback=session_values("throughput"),
+)
+metrics.registry.gauge(
+    "swamp_stream_encoder_speed",
+    "Encoding speed relative to real time of each session, from ffmpeg progress",
+    ("session",),
+    callback=session_values("speed"),
+)
+metrics.registry.gauge(
+    "swamp_stream_encoder_fps",
+    "Frames per second encoded by each session, from ffmpeg progress",
+    ("session",),
+    callback=session_values("fps"),
+)
+
 
 def url_base(urlpath):
     return app.config["BASE_PATH"] + urlpath
@@ -69,6 +164,7 @@ def allowed_file(name):
     return ext not in ["php", "htm", "html", "js"]
 
 
+@metrics.directory_seconds.timed()
 def get_directory_path(username, urlpath):
     urlpath = urlpath.split("?", 2)[0]
     r = db.resolveDirectory(username, urlpath)
@@ -83,15 +179,69 @@ def get_directory_path(username, urlpath):
     return os.path.join(*s), True
 
 
+def is_writable(username, path):
+    # Whether the user may write in the directory containing path, see get_directory_path()
+    directory = os.path.dirname(path)
+    roots = [os.path.join(filesDirectory, username)]
+    roots += [root for root, level in db.getDirectoriesForUser(username).values() if level >= 2]
+    return any(directory == root or directory.startswith(root + os.sep) for root in roots)
+
+
 class FileInfo:
-    def __init__(self, path, urlpath, writable=False):
+    __slots__ = ("path", "name", "isdir", "ext", "isvideo", "urlpath", "writable", "key")
+
+    VideoExtensions = frozenset(["avi", "mkv", "mp4"])
+
+    def __init__(self, path, urlpath, writable=False, isdir=None, name=None):
         self.path = path
-        self.name = os.path.basename(path)
-        self.isdir = os.path.isdir(path)
-        self.ext = os.path.splitext(path)[1][1:]
-        self.isvideo = self.ext in ["avi", "mkv", "mp4"]
+        self.name = name or os.path.basename(path)
+        self.isdir = isdir if isdir is not None else os.path.isdir(path)
+        self.ext = os.path.splitext(self.name)[1][1:]
+        self.isvideo = self.ext in FileInfo.VideoExtensions
         self.urlpath = urlpath
         self.writable = writable
+        self.key = ("0" if self.isdir else "1") + self.name.lower()  # directories first
+
+
+def list_files(path, urlpath, writable):
+    # Visible entries sorted by key, hidden and forbidden names are skipped before any stat
+    entries = indexer.list_directory(path)
+    if entries is not None:
+        return sort_files(path, urlpath, writable, ((e[0], e[1]) for e in entries))
+    # Not in a shared directory, DirEntry only stats symlinks to get the type
+    with os.scandir(path) as it:
+        entries = ((e.name, e.is_dir()) for e in it if e.name[0] != ".")
+        return sort_files(path, urlpath, writable, entries)
+
+
+def sort_files(path, urlpath, writable, entries):
+    files = (
+        FileInfo(os.path.join(path, name), urlpath + name, writable, bool(isdir), name)
+        for name, isdir in entries
+        if name[0] != "." and (isdir or allowed_file(name))
+    )
+    return sorted(files, key=attrgetter("key"))
+
+
+def render_listing(template, files, **context):
+    # Large listings are sent while being rendered, in pieces of a reasonable size
+    if len(files) < app.config.get("LISTING_STREAM_THRESHOLD", 1000):
+        return flask.render_template(template, files=files, **context)
+
+    def generate(stream, chunk_size=64 * 1024):
+        parts = []
+        size = 0
+        for part in stream:
+            parts.append(part)
+            size += len(part)
+            if size >= chunk_size:
+                yield "".join(parts)
+                parts = []
+                size = 0
+        yield "".join(parts)
+
+    stream = flask.stream_template(template, files=files, **context)
+    return flask.Response(generate(stream), mimetype="text/html")
 
 
 @app.context_processor
@@ -137,6 +287,30 @@ def local(f):
     return decorated
 
 
+@app.before_request
+def start_timer():
+    flask.g.start_time = time.perf_counter()
+
+
+@app.after_request
+def observe_latency(response):
+    if "start_time" in flask.g:
+        metrics.request_seconds.observe(
+            time.perf_counter() - flask.g.start_time,
+            request.endpoint or "none",
+            request.method,
+            response.status_code,
+        )
+    return response
+
+
+@app.errorhandler(SchedulerFull)
+def scheduler_full(e):
+    return flask.Response(
+        "Too many streams, retry later", 503, {"Retry-After": str(e.retry_after)}
+    )
+
+
 @app.route("/", methods=["GET"])
 def home():
     if "username" in flask.session:
@@ -176,6 +350,25 @@ def file(urlpath=""):
                 flask.abort(400)
         if len(urlpath) > 0 and urlpath[-1] != "/":
             urlpath += "/"
+        if "upload" in request.args:
+            # Resumable upload, the body stays empty and chunks go to the returned location
+            name = request.args.get("name", "")
+            size = request.args.get("size", None, type=int)
+            if size is None or size < 0:
+                flask.abort(400)
+            if not allowed_file(name):
+                flask.abort(403)
+            filename = secure_filename(name)
+            if not filename:
+                flask.abort(400)
+            destination = os.path.join(path, filename)
+            if os.path.lexists(destination):
+                flask.abort(409)  # Conflict
+            partial = partial_path(destination)
+            create_partial(partial)
+            identifier = db.createUpload(flask.g.username, destination, partial, size)
+            location = url_for("upload", identifier=identifier)
+            return flask.jsonify({"location": location}), 201, {"Location": location}
         data = request.form
         files = request.files
         if "file" in files and files["file"].filename != "":
@@ -217,33 +410,32 @@ def file(urlpath=""):
                 return flask.redirect(
                     url_for("link", identifier=identifier) + "?display", code=302
                 )
-            files = list(
-                map(
-                    lambda f: FileInfo(os.path.join(path, f), urlpath + f, writable),
-                    os.listdir(path),
-                )
-            )
-            files = list(
-                filter(lambda f: f.name[0] != "." and (f.isdir or allowed_file(f.name)), files)
-            )
+            files = list_files(path, urlpath, writable)
             if len(urlpath) == 0:
                 d = db.getDirectoriesForUser(flask.g.username)
-                directories = []
                 for name in d:
                     path, level = d[name]
                     if level >= 1:
-                        directories.append(FileInfo(path, name, level >= 2))
-                files += directories
-            files.sort(key=lambda f: "0" + f.name.lower() if f.isdir else "1" + f.name.lower())
-            return flask.render_template(
-                "directory.html", path="/" + urlpath, files=files, writable=writable
-            )
+                        files.append(FileInfo(path, name, level >= 2))
+                files.sort(key=attrgetter("key"))
+            return render_listing("directory.html", files, path="/" + urlpath, writable=writable)
         elif os.path.isfile(path):
             if "download" in request.args:
-                return flask.send_file(path, as_attachment=True)
+                return send_file(path, as_attachment=True)
+            if "thumbnail" in request.args:
+                # Never wait for generation, show the generic icon meanwhile
+                name = thumbnailer.get(path, "poster")
+                if name is None:
+                    return flask.redirect(url_for("static", filename="icons/file.png"), code=302)
+                return flask.redirect(url_for("thumbnail", name=name), code=302)
+            if "preview" in request.args:
+                name = thumbnailer.get(path, "vtt")
+                if name is None:
+                    flask.abort(404)
+                return flask.redirect(url_for("thumbnail", name=name), code=302)
             mimetypes = ["application/octet-stream", "text/html"]
             if request.accept_mimetypes.best_match(mimetypes) != "text/html":
-                return flask.send_file(path)
+                return send_file(path)
             elif "play" in request.args:
                 identifier = db.createLink(flask.g.username, urlpath)
                 seconds = 0
@@ -256,6 +448,7 @@ def file(urlpath=""):
                     downloadLocation=url_base(request.path) + "?download",
                     videoLocation=url_for("stream", identifier=identifier),
                     castLocation=url_for("cast", identifier=identifier),
+                    previewLocation=url_base(request.path) + "?preview",
                     videoTime=seconds,
                 )
             elif "link" in request.args:
@@ -264,11 +457,121 @@ def file(urlpath=""):
                     url_for("link", identifier=identifier) + "?display", code=302
                 )
             else:
-                return flask.send_file(path, as_attachment=True)
+                return send_file(path, as_attachment=True)
         else:
             flask.abort(404)
 
 
+@app.route("/thumbnail/<name>", methods=["GET"])
+@auth
+def thumbnail(name):
+    # Entries are named after the file version, so they never change
+    path = thumbnailer.cache.get(name)
+    if path is None:
+        flask.abort(404)
+    mimetype = "text/vtt" if name.endswith(".vtt") else "image/jpeg"
+    max_age = app.config.get("THUMBNAIL_MAX_AGE", 365 * 24 * 60 * 60)
+    response = send_file(path, mimetype=mimetype, max_age=max_age)
+    response.cache_control.immutable = True
+    return response
+
+
+@app.route("/search", methods=["GET"])
+@auth
+def search():
+    query = request.args.get("q", "")
+    results = db.searchFiles(flask.g.username, query) if query else []
+    mimetypes = ["application/json", "text/html"]
+    if request.accept_mimetypes.best_match(mimetypes) == "application/json":
+        return flask.jsonify(
+            {
+                "results": [
+                    {"path": r[0], "directory": bool(r[1]), "size": r[2], "type": r[3]}
+                    for r in results
+                ]
+            }
+        )
+    files = [FileInfo(r[0], r[0], False, bool(r[1])) for r in results]
+    return flask.render_template("search.html", query=query, files=files)
+
+
+def page_limit():
+    limit = request.args.get("limit", app.config.get("LIBRARY_PAGE_SIZE", 100), type=int)
+    return max(1, min(limit, app.config.get("LIBRARY_MAX_PAGE_SIZE", 1000)))
+
+
+def page_cursor(types):
+    # Key of the last item of the previous page, fields are separated by dots
+    after = request.args.get("after")
+    if not after:
+        return None
+    fields = after.split(".", len(types) - 1)
+    if len(fields) != len(types):
+        flask.abort(400)
+    try:
+        return tuple(t(f) for t, f in zip(types, fields))
+    except ValueError:
+        flask.abort(400)
+
+
+@app.route("/library", methods=["GET"])
+@auth
+def library():
+    return flask.render_template("library.html")
+
+
+@app.route("/library/series", methods=["GET"])
+@auth
+def library_series():
+    limit = page_limit()
+    rows = db.getSeries(flask.g.username, request.args.get("after"), limit)
+    return flask.jsonify(
+        {
+            "series": [{"title": r[0], "seasons": r[1], "episodes": r[2]} for r in rows],
+            "next": rows[-1][0] if len(rows) == limit else None,
+        }
+    )
+
+
+@app.route("/library/series/<title>", methods=["GET"])
+@auth
+def library_episodes(title):
+    limit = page_limit()
+    season = request.args.get("season", None, type=int)
+    after = page_cursor([int, int, int])
+    rows = db.getEpisodes(flask.g.username, title, season, after, limit)
+    result = {
+        "title": title,
+        "episodes": [
+            {"path": r[1], "season": r[2], "episode": r[3], "size": r[4]} for r in rows
+        ],
+        "next": "{2}.{3}.{0}".format(*rows[-1]) if len(rows) == limit else None,
+    }
+    if after is None:
+        seasons = db.getSeasons(flask.g.username, title)
+        result["seasons"] = [{"season": r[0], "episodes": r[1]} for r in seasons]
+    return flask.jsonify(result)
+
+
+@app.route("/library/movies", methods=["GET"])
+@auth
+def library_movies():
+    limit = page_limit()
+    year = request.args.get("year", None, type=int)
+    after = page_cursor([int, int, str])  # year, id, title
+    if after is not None:
+        after = (after[0], after[2], after[1])
+    rows = db.getMovies(flask.g.username, year, after, limit)
+    result = {
+        "movies": [{"path": r[1], "title": r[2], "year": r[3], "size": r[4]} for r in rows],
+        "next": "{3}.{0}.{2}".format(*rows[-1]) if len(rows) == limit else None,
+    }
+    if after is None:
+        years = db.getMovieYears(flask.g.username)
+        result["years"] = [{"year": r[0], "movies": r[1]} for r in years]
+    return flask.jsonify(result)
+
+
 def resolve(identifier, subpath=None):
     r = db.resolveLink(identifier)
     if not r:
@@ -280,6 +583,52 @@ def resolve(identifier, subpath=None):
     return username, urlpath, path
 
 
+@app.route("/upload/<identifier>", methods=["GET", "PATCH", "POST", "DELETE"])
+@auth
+def upload(identifier):
+    r = db.getUpload(identifier)
+    if r is None or r[0] != flask.g.username:
+        flask.abort(404)
+    username, path, partial, size = r
+    if request.method == "PATCH":
+        # Chunk at Upload-Offset, read from the request and written in place
+        offset = request.headers.get("Upload-Offset", None, type=int)
+        length = request.content_length
+        if offset is None or length is None or offset < 0 or offset + length > size:
+            flask.abort(400)
+        written = write_chunk(partial, offset, request.stream, length)
+        if written > 0:
+            db.addUploadRange(identifier, offset, offset + written)
+        if written < length:
+            flask.abort(400)
+    elif request.method == "POST":
+        # Finish, the complete file takes the destination if still allowed and free
+        if not is_writable(username, path):
+            flask.abort(403)
+        if received(db.getUploadRanges(identifier)) < size:
+            flask.abort(409)
+        os.truncate(partial, size)
+        if not finish_partial(partial, path):
+            flask.abort(409)  # a file appeared there, the upload is kept until deleted
+        db.delUpload(identifier)
+        return flask.jsonify({"size": size}), 201
+    elif request.method == "DELETE":
+        db.delUpload(identifier)
+        try:
+            os.remove(partial)
+        except OSError:
+            pass
+        return "", 204
+    ranges = db.getUploadRanges(identifier)
+    offset = received(ranges)
+    headers = {
+        "Upload-Offset": str(offset),
+        "Upload-Length": str(size),
+        "Cache-Control": "no-store",
+    }
+    return flask.jsonify({"offset": offset, "size": size, "missing": missing(ranges, size)}), headers
+
+
 @app.route("/link/<identifier>", methods=["GET"], defaults={"subpath": None})
 @app.route("/link/<identifier>/", methods=["GET"], defaults={"subpath": None})
 @app.route("/link/<identifier>/<path:subpath>", methods=["GET"])
@@ -294,20 +643,14 @@ def link(identifier, subpath):
             return flask.redirect(
                 url_base(request.path + "/") + ("?" + query if query else ""), code=302
             )
-        files = list(
-            map(lambda f: FileInfo(os.path.join(path, f), urlpath + f, False), os.listdir(path))
-        )
-        files = list(
-            filter(lambda f: f.name[0] != "." and (f.isdir or allowed_file(f.name)), files)
-        )
-        files.sort(key=lambda f: "0" + f.name.lower() if f.isdir else "1" + f.name.lower())
-        return flask.render_template("safe_directory.html", files=files)
+        files = list_files(path, urlpath, False)
+        return render_listing("safe_directory.html", files)
     elif os.path.isfile(path):
         if "download" in request.args:
-            return flask.send_file(path, as_attachment=True)
+            return send_file(path, as_attachment=True)
         mimetypes = ["application/octet-stream", "text/html"]
         if request.accept_mimetypes.best_match(mimetypes) != "text/html":
-            return flask.send_file(path)
+            return send_file(path)
         elif "play" in request.args:
             seconds = 0
             if "start" in request.args:
@@ -321,7 +664,7 @@ def link(identifier, subpath):
                 videoTime=seconds,
             )
         else:
-            return flask.send_file(path, as_attachment=True)
+            return send_file(path, as_attachment=True)
     else:
         flask.abort(404)
 
@@ -329,40 +672,144 @@ def link(identifier, subpath):
 @app.route("/stream/<identifier>/", methods=["GET"], defaults={"subpath": None})
 @app.route("/stream/<identifier>/<path:subpath>", methods=["GET"])
 def stream(identifier, subpath):
-    default_range = "bytes=0-"
-    if request.headers.get("Range", default_range) != default_range:
-        flask.abort(416)  # Range not satisfiable
     username, urlpath, path = resolve(identifier, subpath)
     stream_format = request.args.get('format', 'webm')
-    s = Streamer(path, stream_format)
-    if "info" in request.args:
-        return flask.jsonify(s.get_description())
+    s = Streamer(path, stream_format, db, app.config.get("RENDITIONS"))
     is_hd = bool(request.args.get('hd', False))
     start = request.args["start"] if "start" in request.args else None
-    f = s.get_stream(is_hd, start=start, stop=None, force_subtitles=True)
+    audio = request.args.get("audio", None, type=int)
+    try:
+        s.select_rendition(
+            request.args.get("rendition", None), request.args.get("bandwidth", None, type=int)
+        )
+    except ValueError:
+        flask.abort(400)
+    s.select_mode(is_hd, start=start, force_subtitles=True, audio=audio)
+    if "info" in request.args:
+        return flask.jsonify(s.get_description())
+    if stream_format == "hls":
+        return stream_segmented(s, is_hd, audio)
+    if s.mode == "direct":
+        return send_file(s.source)
+    default_range = "bytes=0-"
+    if request.headers.get("Range", default_range) != default_range:
+        flask.abort(416)  # Range not satisfiable
+    args = s.get_command(is_hd, start=start, stop=None, force_subtitles=True, audio=audio)
+    # Viewers share a session only if they would run the exact same ffmpeg command,
+    # which covers the source, mode, container, rendition, start and audio track
+    key = tuple(args)
+    scanner = MP4Scanner() if s.output_format == "mp4" else MatroskaScanner()
+    priority = PRIORITY_HIGH if is_hd else PRIORITY_NORMAL
+    f = sessions.subscribe(key, args, scanner, priority)
     return flask.Response(f, direct_passthrough=True, mimetype=s.mimetype)
 
 
+def stream_segmented(s, is_hd, audio):
+    query = ("&hd=1" if is_hd else "") + ("&audio={}".format(audio) if audio is not None else "")
+    if "segment" not in request.args:
+        if s.rendition is None and not is_hd:
+            return flask.Response(s.get_master_playlist(query), mimetype=s.mimetype)
+        return flask.Response(s.get_playlist(query), mimetype=s.mimetype)
+    index = request.args.get("segment", None, type=int)
+    if index is None or index < 0:
+        flask.abort(400)
+    # Browsers without native HLS play fragmented MP4 segments through Media Source Extensions
+    container = "mp4" if request.args.get("container", None) == "mp4" else "mpegts"
+
+    def get_segment(index, priority):
+        def generate(output):
+            with scheduler.acquire(priority, wait=(priority != PRIORITY_LOW)):
+                s.write_segment(index, output, is_hd, True, audio, container)
+
+        name = s.get_segment_name(
+            index, is_hd, force_subtitles=True, audio=audio, container=container
+        )
+        return segments.get_or_create(name, generate)
+
+    def prefetch(index):
+        try:
+            get_segment(index, PRIORITY_LOW)
+        except SchedulerFull:
+            pass  # no idle encoder
+
+    segment_path = get_segment(index, PRIORITY_HIGH if is_hd else PRIORITY_NORMAL)
+    # Encode the next segment ahead while this one is being played
+    next_name = s.get_segment_name(
+        index + 1, is_hd, force_subtitles=True, audio=audio, container=container
+    )
+    if not segments.get(next_name) and not segments.is_pending(next_name):
+        threading.Thread(target=prefetch, args=(index + 1,), daemon=True).start()
+    return send_file(
+        segment_path,
+        mimetype="video/mp4" if container == "mp4" else "video/mp2t",
+        max_age=app.config.get("SEGMENT_MAX_AGE", 24 * 60 * 60),
+    )
+
+
 @app.route("/cast/<identifier>/", methods=["GET", "POST"], defaults={"subpath": None})
 @app.route("/cast/<identifier>/<path:subpath>", methods=["GET", "POST"])
 @local
 def cast(identifier, subpath):
-    cast = Cast()
-    if cast is None:
+    if caster is None:
         flask.abort(503)  # Service unavailable
     username, urlpath, path = resolve(identifier, subpath)
     if "list" in request.args:
-        cast = Cast()
-        devices = cast.list() if cast is not None else []
-        return flask.jsonify({"devices": devices})
-    cast.connect(request.args.get("host", None))
-    if request.method == "POST":
-        query = "?format=matroska&hd=1"
-        if "start" in request.args:
-            query += "&start={}".format(request.args["start"])
-        if "audio" in request.args:
-            query += "&audio={}".format(request.args["audio"])
-        cast_url = url_absolute(url_for("stream", identifier=identifier, subpath=subpath) + query)
-        cast.play(cast_url, "video/x-matroska")
-    return flask.jsonify({})
+        return flask.jsonify({"devices": caster.list()})
+    host = request.args.get("host", None) or None
+    if request.method == "GET":
+        if "job" in request.args:
+            # Long poll, answers as soon as the job is finished
+            timeout = app.config.get("CAST_POLL_TIMEOUT", 20) if "wait" in request.args else 0
+            job = caster.job(request.args["job"], timeout)
+            if job is None:
+                flask.abort(404)
+            return flask.jsonify(job)
+        return flask.jsonify({"status": caster.status(host)})
+
+    command = request.args.get("command", "play")
+    if command not in CAST_COMMANDS:
+        flask.abort(400)
+    args = {}
+    try:
+        if command == "play":
+            query = "?format=matroska&hd=1"
+            if "start" in request.args:
+                query += "&start={}".format(request.args["start"])
+            if "audio" in request.args:
+                query += "&audio={}".format(request.args["audio"])
+            stream_url = url_for("stream", identifier=identifier, subpath=subpath)
+            args["url"] = url_absolute(stream_url + query)
+            args["mimetype"] = "video/x-matroska"
+        elif command == "seek":
+            args["position"] = max(float(request.args["position"]), 0.0)
+        elif command == "volume":
+            args["level"] = min(max(float(request.args["level"]), 0.0), 1.0)
+    except (KeyError, ValueError):
+        flask.abort(400)
+    try:
+        job_id = caster.submit(command, host, **args)
+    except NoDevice:
+        flask.abort(404)
+    return flask.jsonify({"job": job_id}), 202
+
 
+@app.route("/metrics", methods=["GET"])
+@local
+def metrics_view():
+    return flask.Response(metrics.registry.expose(), content_type=metrics.CONTENT_TYPE)
+
+
+@app.route("/status", methods=["GET"])
+@local
+def status():
+    return flask.jsonify(
+        {
+            "transcodes": scheduler.describe(),
+            "sessions": sessions.describe(),
+            "processes": ManagedProcess.stats(),
+            "pretranscodes": db.getTranscodeStatus(),
+            "access": db.getAccessCacheStats(),
+            "thumbnails": thumbnailer.describe(),
+            "cast": caster.describe() if caster is not None else None,
+        }
+    )
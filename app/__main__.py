@@ -19,12 +19,16 @@
     If not, see <http://www.gnu.org/licenses/>.
 """
 
+import threading
+import os
+import time
 import sys
 
 from gevent.pywsgi import WSGIServer
 from getpass import getpass
 
-from . import app, db
+from . import app, db, pretranscoder, indexer, thumbnailer, caster
+from .delivery import SendfileHandler
 
 port = 8085
 
@@ -85,11 +89,59 @@ def command(a):
             db.delDirectory(path)
         else:
             print("Unknown operation, expected 'add' or 'del'")
+    elif obj == "transcode":
+        opr = a.pop() if len(a) else "run"
+        if opr == "scan":
+            count = pretranscoder.scan()
+            print("Queued {} files".format(count))
+        elif opr == "run":
+            count = pretranscoder.scan()
+            print("Queued {} files".format(count))
+            try:
+                pretranscoder.start()
+                pretranscoder.join()
+            except KeyboardInterrupt:
+                pretranscoder.stop()
+                pretranscoder.join()
+        elif opr == "status":
+            for status, r in sorted(db.getTranscodeStatus().items()):
+                print("{}\t{}\t{:.0%}".format(status, r["count"], r["progress"] or 0))
+        else:
+            print("Unknown operation, expected 'scan', 'run' or 'status'")
+    elif obj == "index":
+        opr = a.pop() if len(a) else "scan"
+        if opr == "scan":
+            count = indexer.scan()
+            print("Indexed {} directories".format(count))
+        else:
+            print("Unknown operation, expected 'scan'")
+    elif obj == "link":
+        opr = a.pop() if len(a) else "sweep"
+        if opr == "sweep":
+            count = db.sweepLinks()
+            print("Deleted {} expired links".format(count))
+        else:
+            print("Unknown operation, expected 'sweep'")
     else:
-        print("Unknown argument, expected 'user' or 'dir'")
+        print("Unknown argument, expected 'user', 'dir', 'transcode', 'index' or 'link'")
     return 0
 
 
+def sweep_links(interval):
+    while True:
+        try:
+            db.sweepLinks()
+        except Exception as e:
+            print("Link sweep failed: {}".format(e))
+        try:
+            for partial in db.sweepUploads():
+                if os.path.exists(partial):
+                    os.remove(partial)
+        except Exception as e:
+            print("Upload sweep failed: {}".format(e))
+        time.sleep(interval)
+
+
 def main():
     a = list(reversed(sys.argv))
     assert len(a)
@@ -98,8 +150,16 @@ def main():
         return command(a)
     else:
         try:
+            if app.config.get("PRETRANSCODE_IN_PROCESS", False):
+                pretranscoder.start(loop=True)
+            indexer.start()
+            thumbnailer.start()
+            if caster is not None:
+                caster.start()
+            interval = app.config.get("LINK_SWEEP_INTERVAL", 60 * 60)
+            threading.Thread(target=sweep_links, args=(interval,), daemon=True).start()
             print("Listening on http://127.0.0.1:{}/".format(port))
-            http_server = WSGIServer(("127.0.0.1", port), app)
+            http_server = WSGIServer(("127.0.0.1", port), app, handler_class=SendfileHandler)
             http_server.serve_forever()
         except KeyboardInterrupt:
             return 0
@@ -0,0 +1,112 @@
+"""
+    Copyright (C) 2017 by Paul-Louis Ageneau
+    paul-louis (at) ageneau (dot) org
+
+    This file is part of Swamp.
+
+    Swamp is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of
+    the License, or (at your option) any later version.
+
+    Swamp is distributed in the hope that it will be useful, but
+    WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public
+    License along with Swamp.
+    If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import collections
+import threading
+import os
+
+
+class DiskCache:
+    """On-disk file cache with LRU eviction once max_size bytes are exceeded"""
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.size = 0
+        self._entries = collections.OrderedDict()  # name -> size, least recent first
+        self._pending = {}  # name -> lock held while generating
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        entries = []
+        for entry in os.scandir(directory):
+            if entry.name.endswith(".tmp"):
+                os.remove(entry.path)
+            elif entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._entries[name] = size
+            self.size += size
+
+    def get(self, name):
+        with self._lock:
+            if name not in self._entries:
+                return None
+            self._entries.move_to_end(name)
+        path = os.path.join(self.directory, name)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self._remove(name)
+            return None
+        return path
+
+    def get_or_create(self, name, generate):
+        # generate(tmp_path) writes the entry, concurrent callers wait for it
+        path = self.get(name)
+        if path:
+            return path
+        with self._lock:
+            lock = self._pending.setdefault(name, threading.Lock())
+        with lock:
+            path = self.get(name)
+            if path:
+                return path
+            tmp_path = os.path.join(self.directory, name + ".tmp")
+            try:
+                generate(tmp_path)
+                return self.put(name, tmp_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                with self._lock:
+                    self._pending.pop(name, None)
+
+    def is_pending(self, name):
+        with self._lock:
+            return name in self._pending
+
+    def put(self, name, source_path):
+        path = os.path.join(self.directory, name)
+        size = os.path.getsize(source_path)
+        os.replace(source_path, path)
+        with self._lock:
+            self._remove(name)
+            self._entries[name] = size
+            self.size += size
+            self._evict()
+        return path
+
+    def _evict(self):
+        while self.size > self.max_size and len(self._entries) > 1:
+            name = next(iter(self._entries))
+            self._remove(name)
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+    def _remove(self, name):
+        size = self._entries.pop(name, None)
+        if size is not None:
+            self.size -= size
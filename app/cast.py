@@ -19,65 +19,274 @@
     If not, see <http://www.gnu.org/licenses/>.
 """
 
-import time
+import collections
+import itertools
+import threading
+import queue
 
 ENABLE_CHROMECAST = True
 try:
     import pychromecast
+    import zeroconf
 except ImportError:
     print("Missing pychromecast package, disabling Chromecast support")
     ENABLE_CHROMECAST = False
 
-CHROMECAST_TIMEOUT = 30
+CHROMECAST_PORT = 8009
 
+CHROMECAST_TIMEOUT = 30  # seconds to wait for a device to connect
 
-def Cast():
-    return ChromeCast() if ENABLE_CHROMECAST else None
+COMMANDS = ("play", "pause", "resume", "seek", "stop", "volume")
 
+MAX_JOBS = 256  # finished jobs kept for status queries
 
-class ChromeCast:
+WORKER_IDLE_TIMEOUT = 60  # seconds before the command thread of an idle device exits
+
+
+class NoDevice(Exception):
     def __init__(self):
-        self.cast = None
+        super().__init__("No Chromecast found")
+
+
+class CastService:
+    """Chromecast devices discovered in the background, with persistent connections
+
+    Discovery keeps a registry of devices up to date and connects to them as they
+    appear, connections are kept by host and reconnect by themselves. Commands are
+    queued per device and run by a thread of that device, callers get a job id right
+    away and poll for its outcome. The backend is the pychromecast module or a
+    stand-in with the same interface.
+    """
+
+    def __init__(self, backend=None, zconf=None):
+        self.backend = backend or pychromecast
+        self._zconf = zconf
+        self._browser = None
+        self._devices = {}  # uuid -> CastInfo
+        self._casts = {}  # host -> Chromecast
+        self._queues = {}  # host -> queue of (job id, arguments)
+        self._jobs = collections.OrderedDict()  # job id -> job
+        self._job_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+    def start(self):
+        if self._browser is not None:
+            return
+        if self._zconf is None:
+            self._zconf = zeroconf.Zeroconf()
+        discovery = self.backend.discovery
+        listener = discovery.SimpleCastListener(self._added, self._removed, self._updated)
+        self._browser = discovery.CastBrowser(listener, self._zconf)
+        self._browser.start_discovery()
+
+    def stop(self):
+        if self._browser is not None:
+            self._browser.stop_discovery()
+            self._browser = None
+        with self._lock:
+            casts = list(self._casts.values())
+            self._casts = {}
+        for cast in casts:
+            cast.disconnect()
 
     def list(self):
-        return list(map(lambda c: {
-            "name": c.device.friendly_name,
-            "host": c.host
-        },
-            pychromecast.get_chromecasts()))
+        with self._lock:
+            devices = list(self._devices.values())
+        return [{"name": d.friendly_name, "host": d.host} for d in devices]
+
+    def describe(self):
+        with self._lock:
+            pending = sum(1 for job in self._jobs.values() if job["state"] in ("queued", "running"))
+            return {
+                "devices": len(self._devices),
+                "connections": len(self._casts),
+                "jobs": pending,
+            }
 
     def connect(self, host=None):
+        # Connection to the device at host, or to any known device, never waits
+        with self._lock:
+            host = self._resolve(host)
+            cast = self._casts.get(host)
+            if cast is not None:
+                return cast
+            info = next((d for d in self._devices.values() if d.host == host), None)
+            if info is not None:
+                cast = self.backend.get_chromecast_from_cast_info(info, self._zconf)
+            else:
+                # Not discovered, for instance on another subnet
+                cast = self.backend.get_chromecast_from_host(
+                    (host, CHROMECAST_PORT, None, None, None)
+                )
+        # Only a started connection is kept, a failed one is retried on next use
+        cast.start()
+        with self._lock:
+            existing = self._casts.get(host)
+            if existing is None:
+                self._casts[host] = cast
+                return cast
+        cast.disconnect()  # connected concurrently
+        return existing
+
+    def submit(self, command, host=None, **args):
+        # Queue a command for the device and return its job id without waiting
+        if command not in COMMANDS:
+            raise Exception("Unknown cast command: {}".format(command))
+        with self._lock:
+            host = self._resolve(host)
+            job_id = str(next(self._job_ids))
+            self._jobs[job_id] = {
+                "id": job_id,
+                "command": command,
+                "host": host,
+                "state": "queued",
+                "error": None,
+            }
+            self._trim_jobs()
+            commands = self._queues.get(host)
+            if commands is None:
+                commands = self._queues[host] = queue.Queue()
+                thread = threading.Thread(target=self._run, args=(host, commands), daemon=True)
+                thread.start()
+            # Under the lock so that an idle thread cannot exit in between
+            commands.put((job_id, args))
+        return job_id
+
+    def job(self, job_id, timeout=0):
+        # Job state, waiting up to timeout seconds for it to finish
+        with self._changed:
+            self._changed.wait_for(
+                lambda: self._jobs.get(job_id, {}).get("state") not in ("queued", "running"),
+                timeout,
+            )
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def status(self, host=None):
+        # Last media state reported by the device, never waits on it
+        with self._lock:
+            try:
+                host = self._resolve(host)
+            except NoDevice:
+                return None
+            cast = self._casts.get(host)
+        if cast is None:
+            return {"host": host, "connected": False}
+        media = cast.media_controller.status
+        device = cast.status
+        return {
+            "host": host,
+            "connected": True,
+            "state": media.player_state,
+            "time": media.adjusted_current_time,
+            "duration": media.duration,
+            "volume": device.volume_level if device is not None else None,
+            "muted": device.volume_muted if device is not None else None,
+        }
+
+    def _resolve(self, host):
+        # Called with the lock held
         if host is None:
-            self.connect_by_name()
+            host = next((d.host for d in self._devices.values()), None)
+            if host is None:
+                raise NoDevice()
+        return host
+
+    def _trim_jobs(self):
+        # Called with the lock held, forget the oldest finished jobs
+        finished = [k for k, j in self._jobs.items() if j["state"] in ("done", "failed")]
+        for job_id in finished[: max(len(self._jobs) - MAX_JOBS, 0)]:
+            del self._jobs[job_id]
+
+    def _run(self, host, commands):
+        # Commands of a device run one after the other, device I/O only blocks here
+        while True:
+            try:
+                job_id, args = commands.get(timeout=WORKER_IDLE_TIMEOUT)
+            except queue.Empty:
+                if self._retire(host, commands):
+                    return
+                continue
+            with self._changed:
+                job = self._jobs[job_id]
+                job["state"] = "running"
+            try:
+                cast = self.connect(host)
+                cast.wait(CHROMECAST_TIMEOUT)  # immediate once connected
+                getattr(self, "_" + job["command"])(cast, **args)
+                state, error = "done", None
+            except Exception as e:
+                print("Cast command {} failed on {}: {}".format(job["command"], host, e))
+                state, error = "failed", str(e)
+            with self._changed:
+                job["state"] = state
+                job["error"] = error
+                self._changed.notify_all()
+
+    def _retire(self, host, commands):
+        # Stop the idle thread of host, and its connection if the device is not discovered
+        with self._lock:
+            if not commands.empty():
+                return False
+            del self._queues[host]
+            cast = None
+            if not any(d.host == host for d in self._devices.values()):
+                cast = self._casts.pop(host, None)
+        if cast is not None:
+            cast.disconnect()
+        return True
+
+    def _play(self, cast, url, mimetype):
+        cast.media_controller.play_media(url, mimetype, stream_type="BUFFERED")
+
+    def _pause(self, cast):
+        cast.media_controller.pause()
+
+    def _resume(self, cast):
+        cast.media_controller.play()
+
+    def _seek(self, cast, position):
+        cast.media_controller.seek(position)
+
+    def _stop(self, cast):
+        if not cast.is_idle:
+            cast.quit_app()
+
+    def _volume(self, cast, level):
+        cast.set_volume(level)
+
+    def _added(self, uuid, service):
+        info = self._browser.devices.get(uuid)
+        if info is None:
             return
-        self.disconnect()
-        self.cast = pychromecast.Chromecast(host)
-        self.cast.wait(CHROMECAST_TIMEOUT)
-
-    def connect_by_name(self, name=None):
-        self.disconnect()
-        chromecasts = pychromecast.get_chromecasts()
-        self.cast = next(
-            (c for c in chromecasts if name is None or c.device.friendly_name == name), None
-        )
-        if self.cast is None:
-            raise Exception("Chromecast not found (name={})".format(name))
-        self.cast.wait(CHROMECAST_TIMEOUT)
-
-    def disconnect(self):
-        if self.cast:
-            self.cast.disconnect()
-            self.cast = None
-
-    def play(self, url, mimetype):
-        if self.cast is None:
-            self.connect()
-        self.stop()
-        mc = self.cast.media_controller
-        mc.play_media(url, mimetype, stream_type="BUFFERED")
-        mc.block_until_active(CHROMECAST_TIMEOUT)
+        with self._lock:
+            self._devices[uuid] = info
+        try:
+            self.connect(info.host)  # ready before anyone asks to cast
+        except Exception as e:
+            print("Unable to connect to Chromecast {}: {}".format(info.friendly_name, e))
 
-    def stop(self):
-        if self.cast is not None and not self.cast.is_idle:
-            self.cast.quit_app()
-            time.sleep(1)
+    def _updated(self, uuid, service):
+        info = self._browser.devices.get(uuid)
+        if info is None:
+            return
+        with self._lock:
+            previous = self._devices.get(uuid)
+            self._devices[uuid] = info
+            cast = None
+            if previous is not None and previous.host != info.host:
+                cast = self._casts.pop(previous.host, None)
+        if cast is not None:
+            cast.disconnect()  # the device moved, reconnect at the new host
+            try:
+                self.connect(info.host)
+            except Exception as e:
+                print("Unable to connect to Chromecast {}: {}".format(info.friendly_name, e))
+
+    def _removed(self, uuid, service, info):
+        with self._lock:
+            info = self._devices.pop(uuid, info)
+            cast = self._casts.pop(info.host, None) if info is not None else None
+        if cast is not None:
+            cast.disconnect()
@@ -19,89 +19,357 @@
     If not, see <http://www.gnu.org/licenses/>.
 """
 
+import collections
+import contextlib
+import threading
+import hashlib
+import hmac
 import sqlite3
 import string
+import queue
+import json
 import random
+import re
 import os
 import time
-import datetime
 from passlib.hash import sha512_crypt
 
+from .parser import TYPE_SERIE, TYPE_MOVIE, TYPE_MUSIC
+from .metrics import database_seconds, database_wait_seconds, password_seconds
+
+STATEMENT_CACHE_SIZE = 256  # prepared statements kept per connection
+
+PAGE_CACHE_SIZE = 16 * 1024 * 1024  # bytes of page cache per connection
+
+ACCESS_CACHE_TTL = 60  # seconds before reloading access rights changed by another process
+
+CREDENTIAL_CACHE_SIZE = 1024  # users with recently verified passwords
+
+CREDENTIAL_CACHE_TTL = 120  # seconds a verified password is trusted without hashing
+
+LINK_LIFETIME = 7 * 24 * 60 * 60  # seconds a link stays valid after it was last shared
+
+UPLOAD_LIFETIME = 7 * 24 * 60 * 60  # seconds an unfinished upload is kept without activity
+
+SEARCH_CANDIDATES = 200  # matches with the fewest words ranked per share and search query
+
+
+class ConnectionPool:
+    """Bounded pool of SQLite connections, one checked out per thread or greenlet"""
+
+    def __init__(self, filename, size=8, timeout=30):
+        self.filename = filename
+        self.size = max(size, 1)
+        self.timeout = timeout
+        self._created = 0
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.filename,
+            timeout=self.timeout,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE,
+        )
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("PRAGMA cache_size = {}".format(-PAGE_CACHE_SIZE // 1024))
+        conn.execute("PRAGMA foreign_keys = ON")
+        return conn
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+        if create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        try:
+            with database_wait_seconds.time():
+                return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise Exception("No database connection available")
+
+    @contextlib.contextmanager
+    def connection(self):
+        # Nested calls from the same thread or greenlet reuse its connection
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            yield conn
+            return
+        conn = self._acquire()
+        self._local.conn = conn
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            self._local.conn = None
+            self._idle.put(conn)
+
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
 
 class Database:
-    def __init__(self, filename):
-        self._conn = sqlite3.connect(filename)
-        c = self._conn.cursor()
-        c.execute("PRAGMA foreign_keys = ON")
+    def __init__(self, filename, pool_size=8, credential_cache_size=CREDENTIAL_CACHE_SIZE):
+        self._pool = ConnectionPool(filename, pool_size)
+        self._credentials = collections.OrderedDict()  # username -> (digest, expiry)
+        self._credentialKey = os.urandom(32)
+        self._credentialCacheSize = credential_cache_size
+        self._credentialGeneration = 0
+        self._credentialLock = threading.Lock()
+        self._access = None  # username -> {name: (path, level)}
+        self._accessExpiry = 0
+        self._accessGeneration = 0
+        self._accessHits = 0
+        self._accessMisses = 0
+        self._accessLock = threading.Lock()
 
     def init(self):
-        c = self._conn.cursor()
+        with self._pool.connection() as conn:
+            c = conn.cursor()
 
-        c.execute(
-            "CREATE TABLE IF NOT EXISTS user ("
-            "id         INTEGER PRIMARY KEY,"
-            "name       TEXT UNIQUE NOT NULL,"
-            "password   TEXT NOT NULL)"
-        )
+            c.execute(
+                "CREATE TABLE IF NOT EXISTS user ("
+                "id         INTEGER PRIMARY KEY,"
+                "name       TEXT UNIQUE NOT NULL,"
+                "password   TEXT NOT NULL)"
+            )
 
-        c.execute(
-            "CREATE TABLE IF NOT EXISTS link ("
-            "identifier TEXT UNQIUE NOT NULL,"
-            "user_id    INTEGER REFERENCES user(id) ON DELETE CASCADE ON UPDATE RESTRICT,"
-            "path       TEXT NOT NULL,"
-            "timestamp  INTEGER NOT NULL)"
-        )
+            c.execute("PRAGMA table_info(link)")
+            columns = [r[1] for r in c.fetchall()]
+            if columns and "expires_at" not in columns:
+                # Migrate from the unindexed table without expiry
+                c.execute("ALTER TABLE link RENAME TO link_old")
 
-        c.execute("CREATE INDEX IF NOT EXISTS link_index ON link(user_id, path)")
+            c.execute(
+                "CREATE TABLE IF NOT EXISTS link ("
+                "identifier TEXT UNIQUE NOT NULL,"
+                "user_id    INTEGER REFERENCES user(id) ON DELETE CASCADE ON UPDATE RESTRICT,"
+                "path       TEXT NOT NULL,"
+                "timestamp  INTEGER NOT NULL,"
+                "expires_at INTEGER NOT NULL)"
+            )
 
-        c.execute(
-            "CREATE TABLE IF NOT EXISTS directory ("
-            "id         INTEGER PRIMARY KEY,"
-            "path       TEXT UNIQUE NOT NULL,"
-            "name       TEXT NOT NULL)"
-        )
+            if columns and "expires_at" not in columns:
+                c.execute(
+                    "INSERT OR IGNORE INTO link (identifier, user_id, path, timestamp, expires_at) SELECT identifier, user_id, path, timestamp, timestamp + ? FROM link_old",
+                    (LINK_LIFETIME,),
+                )
+                c.execute("DROP TABLE link_old")
 
-        c.execute("CREATE UNIQUE INDEX IF NOT EXISTS directory_name_index ON directory(name)")
+            c.execute("CREATE INDEX IF NOT EXISTS link_index ON link(user_id, path)")
+            c.execute("CREATE INDEX IF NOT EXISTS link_expires_index ON link(expires_at)")
 
-        c.execute(
-            "CREATE TABLE IF NOT EXISTS access ("
-            "user_id        INTEGER REFERENCES user(id) ON DELETE CASCADE ON UPDATE RESTRICT,"
-            "directory_id   INTEGER REFERENCES directory(id) ON DELETE CASCADE ON UPDATE RESTRICT,"
-            "level          INTEGER DEFAULT 0)"
-        )
+            c.execute(
+                "CREATE TABLE IF NOT EXISTS directory ("
+                "id         INTEGER PRIMARY KEY,"
+                "path       TEXT UNIQUE NOT NULL,"
+                "name       TEXT NOT NULL)"
+            )
 
-        c.execute(
-            "CREATE UNIQUE INDEX IF NOT EXISTS access_user_index ON access(user_id, directory_id)"
-        )
+            c.execute("CREATE UNIQUE INDEX IF NOT EXISTS directory_name_index ON directory(name)")
 
-        self._conn.commit()
+            c.execute(
+                "CREATE TABLE IF NOT EXISTS access ("
+                "user_id        INTEGER REFERENCES user(id) ON DELETE CASCADE ON UPDATE RESTRICT,"
+                "directory_id   INTEGER REFERENCES directory(id) ON DELETE CASCADE ON UPDATE RESTRICT,"
+                "level          INTEGER DEFAULT 0)"
+            )
+
+            c.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS access_user_index ON access(user_id, directory_id)"
+            )
+
+            c.execute(
+                "CREATE TABLE IF NOT EXISTS upload ("
+                "id         INTEGER PRIMARY KEY,"
+                "identifier TEXT UNIQUE NOT NULL,"
+                "user_id    INTEGER REFERENCES user(id) ON DELETE CASCADE ON UPDATE RESTRICT,"
+                "path       TEXT NOT NULL,"  # destination
+                "partial    TEXT NOT NULL,"  # file receiving the chunks, next to the destination
+                "size       INTEGER NOT NULL,"
+                "timestamp  INTEGER NOT NULL)"  # last activity
+            )
+
+            c.execute(
+                "CREATE TABLE IF NOT EXISTS upload_range ("
+                "upload_id  INTEGER REFERENCES upload(id) ON DELETE CASCADE ON UPDATE RESTRICT,"
+                "start      INTEGER NOT NULL,"
+                "stop       INTEGER NOT NULL)"
+            )
+
+            c.execute(
+                "CREATE INDEX IF NOT EXISTS upload_range_index ON upload_range(upload_id, start)"
+            )
+
+            c.execute(
+                "CREATE TABLE IF NOT EXISTS media ("
+                "path           TEXT PRIMARY KEY,"
+                "size           INTEGER NOT NULL,"
+                "mtime          INTEGER NOT NULL,"
+                "duration       REAL,"
+                "format         TEXT,"
+                "video_codec    TEXT,"
+                "width          INTEGER,"
+                "height         INTEGER,"
+                "info           TEXT NOT NULL)"
+            )
+
+            c.execute(
+                "CREATE TABLE IF NOT EXISTS transcode ("
+                "id         INTEGER PRIMARY KEY,"
+                "path       TEXT UNIQUE NOT NULL,"
+                "size       INTEGER NOT NULL,"
+                "mtime      INTEGER NOT NULL,"
+                "status     TEXT NOT NULL,"
+                "progress   REAL DEFAULT 0,"
+                "output     TEXT,"
+                "timestamp  INTEGER NOT NULL)"
+            )
+
+            c.execute("CREATE INDEX IF NOT EXISTS transcode_status_index ON transcode(status)")
+
+            c.execute(
+                "CREATE TABLE IF NOT EXISTS file ("
+                "id         INTEGER PRIMARY KEY,"
+                "path       TEXT UNIQUE NOT NULL,"
+                "parent     TEXT NOT NULL,"
+                "name       TEXT NOT NULL,"
+                "size       INTEGER NOT NULL,"
+                "mtime      INTEGER NOT NULL,"
+                "is_dir     INTEGER NOT NULL,"
+                "media_type TEXT,"
+                "listed     INTEGER,"  # mtime of the directory when its entries were listed
+                "kind       INTEGER,"  # classification of the name, see parser
+                "title      TEXT,"
+                "season     INTEGER,"
+                "episode    INTEGER,"
+                "year       INTEGER,"
+                "words      INTEGER)"  # words in the searchable names, see searchFiles
+            )
+
+            c.execute("PRAGMA table_info(file)")
+            columns = [r[1] for r in c.fetchall()]
+            if "kind" not in columns:
+                for column in [
+                    "kind INTEGER",
+                    "title TEXT",
+                    "season INTEGER",
+                    "episode INTEGER",
+                    "year INTEGER",
+                ]:
+                    c.execute("ALTER TABLE file ADD COLUMN " + column)
+                # Rebuild the index to classify files
+                c.execute("DELETE FROM file")
+                c.execute("DROP TABLE IF EXISTS search")
+            if "words" not in columns:
+                c.execute("ALTER TABLE file ADD COLUMN words INTEGER")
+
+            c.execute("CREATE INDEX IF NOT EXISTS file_parent_index ON file(parent, name)")
+            # Covering indexes for browsing the library in order
+            c.execute(
+                "CREATE INDEX IF NOT EXISTS file_series_index ON file(title, season, episode, id, path, size) WHERE kind = {}".format(
+                    TYPE_SERIE
+                )
+            )
+            c.execute(
+                "CREATE INDEX IF NOT EXISTS file_movie_index ON file(year, title, id, path, size) WHERE kind = {}".format(
+                    TYPE_MOVIE
+                )
+            )
+
+            c.execute("SELECT 1 FROM sqlite_master WHERE name = 'search' LIMIT 1")
+            if c.fetchone() is not None:
+                # Migrate from a single search table to one per share
+                c.execute("DROP TABLE search")
+                c.execute("DELETE FROM file")
+
+            c.execute("SELECT id FROM directory")
+            for (directory_id,) in c.fetchall():
+                if self._createSearchTable(c, directory_id):
+                    # Rebuild the index to fill the search table
+                    c.execute("DELETE FROM file")
+
+            conn.commit()
 
     def close(self):
-        self._conn.close()
+        self._pool.close()
 
     def addUser(self, name, password):
         h = sha512_crypt.hash(password)
-        c = self._conn.cursor()
-        c.execute("SELECT id FROM user WHERE name = ? LIMIT 1", (name,))
-        r = c.fetchone()
-        if r is None:
-            c.execute("INSERT INTO user (name, password) VALUES (?, ?)", (name, h))
-        else:
-            c.execute("UPDATE user SET password = ? WHERE name = ?", (h, name))
-        self._conn.commit()
+        with self._pool.connection() as conn:
+            c = conn.cursor()
+            c.execute("SELECT id FROM user WHERE name = ? LIMIT 1", (name,))
+            r = c.fetchone()
+            if r is None:
+                c.execute("INSERT INTO user (name, password) VALUES (?, ?)", (name, h))
+            else:
+                c.execute("UPDATE user SET password = ? WHERE name = ?", (h, name))
+            conn.commit()
+        self._forgetCredentials(name)
+        self._invalidateAccess()
 
+    @database_seconds.timed()
     def authUser(self, name, password):
-        c = self._conn.cursor()
-        c.execute("SELECT password FROM user WHERE name = ? LIMIT 1", (name,))
-        r = c.fetchone()
+        # Recently verified credentials are matched by keyed digest instead of rehashing
+        digest = hmac.new(
+            self._credentialKey, name.encode() + b"\0" + password.encode(), hashlib.sha256
+        ).digest()
+        with self._credentialLock:
+            entry = self._credentials.get(name)
+            generation = self._credentialGeneration
+        if entry is not None and time.time() < entry[1] and hmac.compare_digest(entry[0], digest):
+            return True
+        with self._pool.connection() as conn:
+            c = conn.cursor()
+            c.execute("SELECT password FROM user WHERE name = ? LIMIT 1", (name,))
+            r = c.fetchone()
         if r is None:
             return False
-        return sha512_crypt.verify(password, r[0])
+        with password_seconds.time():
+            if not sha512_crypt.verify(password, r[0]):
+                return False
+        with self._credentialLock:
+            if self._credentialCacheSize > 0 and generation == self._credentialGeneration:
+                self._credentials.pop(name, None)
+                self._credentials[name] = (digest, time.time() + CREDENTIAL_CACHE_TTL)
+                while len(self._credentials) > self._credentialCacheSize:
+                    self._credentials.popitem(last=False)
+        return True
+
+    def _forgetCredentials(self, name):
+        with self._credentialLock:
+            self._credentials.pop(name, None)
+            self._credentialGeneration += 1
 
     def delUser(self, name):
-        c = self._conn.cursor()
-        c.execute("DELETE FROM user WHERE name = ?", (name,))
-        self._conn.commit()
+        with self._pool.connection() as conn:
+            c = conn.cursor()
+            c.execute("DELETE FROM user WHERE name = ?", (name,))
+            conn.commit()
+        self._forgetCredentials(name)
+        self._invalidateAccess()
 
     def addDirectory(self, path, name=""):
         path = path.rstrip(os.sep)
@@ -109,34 +377,84 @@ class Database:
             raise Exception("Path is not a directory")
         if len(name) == 0:
             name = os.path.basename(path)
-        c = self._conn.cursor()
-        c.execute("INSERT OR IGNORE INTO directory (path, name) VALUES (?, ?)", (path, name))
-        self._conn.commit()
+        with self._pool.connection() as conn:
+            c = conn.cursor()
+            c.execute("INSERT OR IGNORE INTO directory (path, name) VALUES (?, ?)", (path, name))
+            if c.rowcount:
+                directory_id = c.lastrowid
+                self._createSearchTable(c, directory_id)
+                self._fillSearchTable(c, directory_id, path)
+            conn.commit()
+        self._invalidateAccess()
 
     def delDirectory(self, path):
         path = path.rstrip(os.sep)
-        c = self._conn.cursor()
-        c.execute("DELETE FROM directory WHERE path = ?", (path,))
-        self._conn.commit()
+        with self._pool.connection() as conn:
+            c = conn.cursor()
+            c.execute("SELECT id FROM directory WHERE path = ? LIMIT 1", (path,))
+            r = c.fetchone()
+            c.execute("DELETE FROM directory WHERE path = ?", (path,))
+            self._deleteIndexedTree(c, path)
+            if r is not None:
+                c.execute("DROP TABLE IF EXISTS search_{}".format(r[0]))
+            conn.commit()
+        self._invalidateAccess()
 
-    def setDirectoryAccess(self, path, username, level):
-        path = path.rstrip(os.sep)
-        c = self._conn.cursor()
-        c.execute("SELECT id FROM user WHERE name = ? LIMIT 1", (username,))
-        r = c.fetchone()
-        if r is None:
-            raise Exception("User does not exist")
-        user_id = r[0]
-        c.execute("SELECT id FROM directory WHERE path = ? LIMIT 1", (path,))
-        r = c.fetchone()
-        if r is None:
-            raise Exception("Directory does not exist")
-        directory_id = r[0]
+    def _createSearchTable(self, c, directory_id):
+        # Full-text index of the files in a share, returns whether it was created.
+        # The rowid is the file id after its number of words, see searchFiles.
+        name = "search_{}".format(directory_id)
+        c.execute("SELECT 1 FROM sqlite_master WHERE name = ? LIMIT 1", (name,))
+        if c.fetchone() is not None:
+            return False
         c.execute(
-            "INSERT OR REPLACE INTO access (user_id, directory_id, level) VALUES (?, ?, ?)",
-            (user_id, directory_id, level),
+            "CREATE VIRTUAL TABLE {} USING fts5("
+            "name, title, artist,"
+            "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')".format(name)
         )
-        self._conn.commit()
+        return True
+
+    def _fillSearchTable(self, c, directory_id, path):
+        # Copy files already indexed through enclosing or nested shares
+        for other_id, root in self._getSearchTables(c, path):
+            if other_id == directory_id:
+                continue
+            c.execute(
+                "INSERT INTO search_{0} (rowid, name, title, artist) SELECT rowid, name, title, artist FROM search_{1} WHERE rowid IN (SELECT (words << 32) | id FROM file WHERE words IS NOT NULL AND path >= ? AND path < ?) AND rowid NOT IN (SELECT rowid FROM search_{0})".format(
+                    directory_id, other_id
+                ),
+                (path + "/", path + "0"),
+            )
+
+    def _getSearchTables(self, c, path):
+        # Ids and paths of the shares containing path or inside it
+        c.execute("SELECT id, path FROM directory")
+        return [
+            (directory_id, root)
+            for directory_id, root in c.fetchall()
+            if path == root or path.startswith(root + "/") or root.startswith(path + "/")
+        ]
+
+    def setDirectoryAccess(self, path, username, level):
+        path = path.rstrip(os.sep)
+        with self._pool.connection() as conn:
+            c = conn.cursor()
+            c.execute("SELECT id FROM user WHERE name = ? LIMIT 1", (username,))
+            r = c.fetchone()
+            if r is None:
+                raise Exception("User does not exist")
+            user_id = r[0]
+            c.execute("SELECT id FROM directory WHERE path = ? LIMIT 1", (path,))
+            r = c.fetchone()
+            if r is None:
+                raise Exception("Directory does not exist")
+            directory_id = r[0]
+            c.execute(
+                "INSERT OR REPLACE INTO access (user_id, directory_id, level) VALUES (?, ?, ?)",
+                (user_id, directory_id, level),
+            )
+            conn.commit()
+        self._invalidateAccess()
 
     def addDirectoryForUser(self, path, username, level=2):
         self.addDirectory(path)
@@ -145,81 +463,596 @@ class Database:
     def delDirectoryForUser(self, path, username):
         self.setDirectoryAccess(path, username, 0)
 
+    def getDirectories(self):
+        with self._pool.connection() as conn:
+            c = conn.cursor()
+            c.execute("SELECT path, name FROM directory")
+            return c.fetchall()
+
     def getDirectoriesForUser(self, username):
-        c = self._conn.cursor()
-        c.execute("SELECT id FROM user WHERE name = ? LIMIT 1", (username,))
-        r = c.fetchone()
-        if r is None:
-            raise Exception("User does not exist")
-        user_id = r[0]
-        c.execute(
-            "SELECT d.path, d.name, a.level FROM directory AS d INNER JOIN access AS a ON a.directory_id = d.id AND a.user_id = ? LIMIT 1",
-            (user_id,),
-        )
-        rows = c.fetchall()
-        d = {}
-        for r in rows:
-            if r[2] > 0:
-                d[r[1]] = (r[0], r[2])
-        return d
+        return dict(self._getAccess(username))
 
+    @database_seconds.timed()
     def resolveDirectory(self, username, path):
-        c = self._conn.cursor()
-        c.execute("SELECT id FROM user WHERE name = ? LIMIT 1", (username,))
-        r = c.fetchone()
-        if r is None:
-            raise Exception("User does not exist")
-        user_id = r[0]
+        access = self._getAccess(username)
         s = path.rstrip("/").split("/")
-        if len(s) == 0:
-            return None
-        directory = s[0]
-        c.execute(
-            "SELECT d.path, a.level FROM directory AS d INNER JOIN access AS a ON a.directory_id = d.id AND a.user_id = ? WHERE d.name = ? LIMIT 1",
-            (user_id, directory),
-        )
-        r = c.fetchone()
-        if r is None or r[1] <= 0:
+        r = access.get(s[0])
+        if r is None:
             return None
         s[0] = r[0]
         resolvedPath = os.path.join(*s)
         level = r[1]
         return resolvedPath, level
 
+    def _getAccess(self, username):
+        # Shares readable by the user as name -> (path, level), from the cache
+        with self._accessLock:
+            if self._access is not None and time.time() < self._accessExpiry:
+                self._accessHits += 1
+                access = self._access
+            else:
+                self._accessMisses += 1
+                access = None
+        if access is None:
+            access = self._loadAccess()
+        if username not in access:
+            raise Exception("User does not exist")
+        return access[username]
+
+    def _loadAccess(self):
+        # Load the whole access table at once, unless a write happens meanwhile
+        with self._accessLock:
+            generation = self._accessGeneration
+        with self._pool.connection() as conn:
+            c = conn.cursor()
+            c.execute(
+                "SELECT u.name, d.path, d.name, a.level FROM user AS u LEFT JOIN access AS a ON a.user_id = u.id AND a.level > 0 LEFT JOIN directory AS d ON d.id = a.directory_id"
+            )
+            rows = c.fetchall()
+        access = {}
+        for r in rows:
+            d = access.setdefault(r[0], {})
+            if r[1] is not None:
+                d[r[2]] = (r[1], r[3])
+        with self._accessLock:
+            if generation == self._accessGeneration:
+                self._access = access
+                self._accessExpiry = time.time() + ACCESS_CACHE_TTL
+        return access
+
+    def _invalidateAccess(self):
+        with self._accessLock:
+            self._access = None
+            self._accessGeneration += 1
+
+    def getAccessCacheStats(self):
+        with self._accessLock:
+            return {"hits": self._accessHits, "misses": self._accessMisses}
+
+    @database_seconds.timed()
     def createLink(self, username, path):
+        # Reuse an unexpired link to the same path, extending its lifetime
         timestamp = int(time.time())
-        c = self._conn.cursor()
-        c.execute("SELECT id FROM user WHERE name = ? LIMIT 1", (username,))
-        r = c.fetchone()
-        if r is None:
-            raise Exception("User does not exist")
-        user_id = r[0]
+        expires_at = timestamp + LINK_LIFETIME
+        with self._pool.connection() as conn:
+            c = conn.cursor()
+            c.execute("SELECT id FROM user WHERE name = ? LIMIT 1", (username,))
+            r = c.fetchone()
+            if r is None:
+                raise Exception("User does not exist")
+            user_id = r[0]
+            c.execute(
+                "SELECT identifier FROM link WHERE user_id = ? AND path = ? AND expires_at > ? LIMIT 1",
+                (user_id, path, timestamp),
+            )
+            r = c.fetchone()
+            if r is not None:
+                identifier = r[0]
+                c.execute(
+                    "UPDATE link SET expires_at = ? WHERE identifier = ?", (expires_at, identifier)
+                )
+                conn.commit()
+                return identifier
+            while True:
+                length = 8
+                letters = string.ascii_lowercase + string.digits
+                identifier = "".join(random.choice(letters) for i in range(length))
+                c.execute("SELECT 1 FROM link WHERE identifier = ? LIMIT 1", (identifier,))
+                if not c.fetchone():
+                    break
+            c.execute(
+                "INSERT INTO link (identifier, user_id, path, timestamp, expires_at) VALUES (?, ?, ?, ?, ?)",
+                (identifier, user_id, path, timestamp, expires_at),
+            )
+            conn.commit()
+            return identifier
+
+    @database_seconds.timed()
+    def resolveLink(self, identifier):
+        with self._pool.connection() as conn:
+            c = conn.cursor()
+            c.execute(
+                "SELECT u.name, l.path FROM link AS l LEFT JOIN user AS u ON u.id = l.user_id WHERE identifier = ? AND expires_at > ? LIMIT 1",
+                (identifier, int(time.time())),
+            )
+            r = c.fetchone()
+            if r is None:
+                return None  # missing or expired
+            return r[0], r[1]
+
+    def sweepLinks(self, batch_size=1000):
+        # Delete expired links in short transactions, returns the number deleted
+        timestamp = int(time.time())
+        count = 0
         while True:
-            length = 8
-            letters = string.ascii_lowercase + string.digits
-            identifier = "".join(random.choice(letters) for i in range(length))
-            c.execute("SELECT 1 FROM link WHERE identifier = ? LIMIT 1", (identifier,))
-            if not c.fetchone():
-                break
-        c.execute(
-            "INSERT INTO link (identifier, user_id, path, timestamp) VALUES (?, ?, ?, ?)",
-            (identifier, user_id, path, timestamp),
-        )
-        self._conn.commit()
+            with self._pool.connection() as conn:
+                c = conn.cursor()
+                c.execute(
+                    "DELETE FROM link WHERE rowid IN (SELECT rowid FROM link WHERE expires_at <= ? LIMIT ?)",
+                    (timestamp, batch_size),
+                )
+                conn.commit()
+                deleted = c.rowcount
+            count += deleted
+            if deleted < batch_size:
+                return count
+
+    def createUpload(self, username, path, partial, size):
+        identifier = os.urandom(16).hex()
+        with self._pool.connection() as conn:
+            c = conn.cursor()
+            c.execute("SELECT id FROM user WHERE name = ? LIMIT 1", (username,))
+            r = c.fetchone()
+            if r is None:
+                raise Exception("User does not exist")
+            c.execute(
+                "INSERT INTO upload (identifier, user_id, path, partial, size, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+                (identifier, r[0], path, partial, size, int(time.time())),
+            )
+            conn.commit()
         return identifier
 
-    def resolveLink(self, identifier):
-        c = self._conn.cursor()
+    def getUpload(self, identifier):
+        # (username, path, partial, size), None if missing
+        with self._pool.connection() as conn:
+            c = conn.cursor()
+            c.execute(
+                "SELECT u.name, p.path, p.partial, p.size FROM upload AS p JOIN user AS u ON u.id = p.user_id WHERE identifier = ? LIMIT 1",
+                (identifier,),
+            )
+            return c.fetchone()
+
+    def getUploadRanges(self, identifier):
+        # Received byte ranges as sorted (start, stop) pairs
+        with self._pool.connection() as conn:
+            c = conn.cursor()
+            c.execute(
+                "SELECT r.start, r.stop FROM upload_range AS r JOIN upload AS p ON p.id = r.upload_id WHERE p.identifier = ? ORDER BY r.start",
+                (identifier,),
+            )
+            return c.fetchall()
+
+    def addUploadRange(self, identifier, start, stop):
+        # Record received bytes, merging with overlapping or adjacent ranges
+        with self._pool.connection() as conn:
+            c = conn.cursor()
+            # Read and merge in one write transaction, concurrent chunks must not lose ranges
+            c.execute("BEGIN IMMEDIATE")
+            c.execute("SELECT id FROM upload WHERE identifier = ? LIMIT 1", (identifier,))
+            r = c.fetchone()
+            if r is None:
+                raise Exception("Upload does not exist")
+            upload_id = r[0]
+            c.execute(
+                "SELECT rowid, start, stop FROM upload_range WHERE upload_id = ? AND start <= ? AND stop >= ?",
+                (upload_id, stop, start),
+            )
+            rows = c.fetchall()
+            if rows:
+                start = min([start] + [row[1] for row in rows])
+                stop = max([stop] + [row[2] for row in rows])
+                c.executemany("DELETE FROM upload_range WHERE rowid = ?", [(row[0],) for row in rows])
+            c.execute(
+                "INSERT INTO upload_range (upload_id, start, stop) VALUES (?, ?, ?)",
+                (upload_id, start, stop),
+            )
+            c.execute(
+                "UPDATE upload SET timestamp = ? WHERE id = ?", (int(time.time()), upload_id)
+            )
+            conn.commit()
+
+    def delUpload(self, identifier):
+        with self._pool.connection() as conn:
+            c = conn.cursor()
+            c.execute("DELETE FROM upload WHERE identifier = ?", (identifier,))
+            conn.commit()
+
+    def sweepUploads(self):
+        # Delete uploads without activity for too long, returns their partial files
+        timestamp = int(time.time()) - UPLOAD_LIFETIME
+        with self._pool.connection() as conn:
+            c = conn.cursor()
+            c.execute("SELECT partial FROM upload WHERE timestamp <= ?", (timestamp,))
+            partials = [r[0] for r in c.fetchall()]
+            c.execute("DELETE FROM upload WHERE timestamp <= ?", (timestamp,))
+            conn.commit()
+        return partials
+
+    def getIndexedMtime(self, path):
+        # Directory mtime when its entries were last indexed, None if never
+        with self._pool.connection() as conn:
+            c = conn.cursor()
+            c.execute("SELECT listed FROM file WHERE path = ? LIMIT 1", (path,))
+            r = c.fetchone()
+            return r[0] if r else None
+
+    @database_seconds.timed()
+    def getIndexedEntries(self, path):
+        with self._pool.connection() as conn:
+            c = conn.cursor()
+            c.execute(
+                "SELECT name, is_dir, size, mtime, media_type FROM file WHERE parent = ?", (path,)
+            )
+            return c.fetchall()
+
+    def getIndexedSubdirectories(self, path):
+        with self._pool.connection() as conn:
+            c = conn.cursor()
+            c.execute("SELECT path FROM file WHERE parent = ? AND is_dir = 1", (path,))
+            return [r[0] for r in c.fetchall()]
+
+    def setIndexedEntries(self, path, mtime, entries):
+        # Replace the entries of a directory, given as
+        # (name, is_dir, size, mtime, media_type, classification or None)
+        with self._pool.connection() as conn:
+            c = conn.cursor()
+            tables = [
+                "search_{}".format(directory_id)
+                for directory_id, root in self._getSearchTables(c, path)
+                if path == root or path.startswith(root + "/")
+            ]
+            c.execute("SELECT name, is_dir, size, mtime FROM file WHERE parent = ?", (path,))
+            existing = {r[0]: r[1:] for r in c.fetchall()}
+            names = {e[0]: e for e in entries}
+            for name, r in list(existing.items()):
+                entry = names.get(name)
+                if entry is None or (r[0] and not entry[1]):
+                    self._deleteIndexedTree(c, os.path.join(path, name))
+                    del existing[name]
+            for name, is_dir, size, entry_mtime, media_type, info in entries:
+                r = existing.get(name)
+                if r is None:
+                    kind = info.type if info is not None and info.type else None
+                    title = info.title if kind else ""
+                    artist = info.artist if kind == TYPE_MUSIC else ""
+                    words = min(len(re.findall(r"\w+", " ".join((name, title, artist)))), 255)
+                    c.execute(
+                        "INSERT INTO file (path, parent, name, is_dir, size, mtime, media_type, kind, title, season, episode, year, words) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (
+                            os.path.join(path, name),
+                            path,
+                            name,
+                            is_dir,
+                            size,
+                            entry_mtime,
+                            media_type,
+                            kind,
+                            info.title if kind else None,
+                            info.season if kind else None,
+                            info.episode if kind else None,
+                            info.year if kind else None,
+                            words,
+                        ),
+                    )
+                    rowid = (words << 32) | c.lastrowid
+                    for table in tables:
+                        c.execute(
+                            "INSERT INTO {} (rowid, name, title, artist) VALUES (?, ?, ?, ?)".format(
+                                table
+                            ),
+                            (rowid, name, title, artist),
+                        )
+                elif r != (is_dir, size, entry_mtime):
+                    c.execute(
+                        "UPDATE file SET is_dir = ?, size = ?, mtime = ? WHERE path = ?",
+                        (is_dir, size, entry_mtime, os.path.join(path, name)),
+                    )
+            c.execute("UPDATE file SET listed = ? WHERE path = ?", (mtime, path))
+            if c.rowcount == 0:
+                c.execute(
+                    "INSERT INTO file (path, parent, name, is_dir, size, mtime, listed) VALUES (?, ?, ?, 1, 0, ?, ?)",
+                    (path, os.path.dirname(path), os.path.basename(path), mtime, mtime),
+                )
+            conn.commit()
+
+    def delIndexedTree(self, path):
+        with self._pool.connection() as conn:
+            c = conn.cursor()
+            self._deleteIndexedTree(c, path)
+            conn.commit()
+
+    def _deleteIndexedTree(self, c, path):
+        # Paths under path sort between path + "/" and path + "0"
+        for directory_id, _ in self._getSearchTables(c, path):
+            c.execute(
+                "DELETE FROM search_{} WHERE rowid IN (SELECT (words << 32) | id FROM file WHERE words IS NOT NULL AND (path = ? OR (path >= ? AND path < ?)))".format(
+                    directory_id
+                ),
+                (path, path + "/", path + "0"),
+            )
         c.execute(
-            "SELECT u.name, l.path, l.timestamp FROM link AS l LEFT JOIN user AS u ON u.id = l.user_id WHERE identifier = ? LIMIT 1",
-            (identifier,),
+            "DELETE FROM file WHERE path = ? OR (path >= ? AND path < ?)",
+            (path, path + "/", path + "0"),
         )
-        r = c.fetchone()
-        if r is None:
-            return None
-        link_time = datetime.datetime.fromtimestamp(r[2])
-        current_time = datetime.datetime.now()
-        seconds = (current_time - link_time).total_seconds()
-        if seconds > 7 * 24 * 60 * 60:  # 7 days
-            return None  # expired
-        return r[0], r[1]
+
+    def _getShareRanges(self, username):
+        # Shares readable by the user, with a condition matching indexed files inside them.
+        # The unary + keeps the planner from preferring the path index over ordered ones.
+        shares = list(self._getAccess(username).items())
+        condition = " OR ".join(["(+f.path >= ? AND +f.path < ?)"] * len(shares))
+        params = []
+        for _, (root, _) in shares:
+            params += [root + "/", root + "0"]
+        return shares, "(" + condition + ")", params
+
+    def _toUrlPath(self, shares, path):
+        for name, (root, _) in shares:
+            if path.startswith(root + "/"):
+                return name + path[len(root) :]
+        return None
+
+    @database_seconds.timed()
+    def searchFiles(self, username, query, limit=50):
+        # Indexed files matching all words as prefixes, in shares readable by the user
+        terms = re.findall(r"\w+", query)
+        shares = list(self._getAccess(username).items())
+        if not terms or not shares:
+            return []
+        match = " ".join('"{}"*'.format(term) for term in terms)
+        roots = set(root for _, (root, _) in shares)
+        with self._pool.connection() as conn:
+            c = conn.cursor()
+            c.execute("SELECT id, path FROM directory")
+            ids = [directory_id for directory_id, root in c.fetchall() if root in roots]
+            # Tables of readable shares only, so that no other file is matched. Matches
+            # come in rowid order, with the fewest words first as BM25 favours short
+            # documents, and only the first ones are ranked: a longer one left out can
+            # only rank higher by repeating the searched words.
+            candidates = " UNION ALL ".join(
+                "SELECT * FROM (SELECT rowid, rank FROM search_{0} WHERE search_{0} MATCH ? ORDER BY rowid LIMIT ?)".format(
+                    directory_id
+                )
+                for directory_id in ids
+            )
+            c.execute(
+                "SELECT f.path, f.is_dir, f.size, f.media_type, MIN(s.rank) AS rank FROM ("
+                + candidates
+                + ") AS s JOIN file AS f ON f.id = s.rowid & 4294967295 GROUP BY f.id ORDER BY rank LIMIT ?",
+                [match, SEARCH_CANDIDATES] * len(ids) + [limit],
+            )
+            rows = c.fetchall()
+        return [(self._toUrlPath(shares, r[0]),) + tuple(r[1:4]) for r in rows]
+
+    @database_seconds.timed()
+    def getSeries(self, username, after=None, limit=100):
+        # Series titles with their numbers of seasons and episodes, following title after
+        shares, condition, params = self._getShareRanges(username)
+        if not shares:
+            return []
+        with self._pool.connection() as conn:
+            c = conn.cursor()
+            c.execute(
+                "SELECT f.title, COUNT(DISTINCT f.season), COUNT(*) FROM file AS f WHERE f.kind = {} AND f.title > ? AND ".format(
+                    TYPE_SERIE
+                )
+                + condition
+                + " GROUP BY f.title ORDER BY f.title LIMIT ?",
+                [after or ""] + params + [limit],
+            )
+            return c.fetchall()
+
+    @database_seconds.timed()
+    def getSeasons(self, username, title):
+        # Seasons of a series with their numbers of episodes
+        shares, condition, params = self._getShareRanges(username)
+        if not shares:
+            return []
+        with self._pool.connection() as conn:
+            c = conn.cursor()
+            c.execute(
+                "SELECT f.season, COUNT(*) FROM file AS f WHERE f.kind = {} AND f.title = ? AND ".format(
+                    TYPE_SERIE
+                )
+                + condition
+                + " GROUP BY f.season ORDER BY f.season",
+                [title] + params,
+            )
+            return c.fetchall()
+
+    @database_seconds.timed()
+    def getEpisodes(self, username, title, season=None, after=None, limit=100):
+        # Episodes of a series as (id, urlpath, season, episode, size),
+        # following the (season, episode, id) key after
+        shares, condition, params = self._getShareRanges(username)
+        if not shares:
+            return []
+        where = "f.kind = {} AND f.title = ?".format(TYPE_SERIE)
+        args = [title]
+        if season is not None:
+            where += " AND f.season = ?"
+            args.append(season)
+        if after is not None:
+            where += " AND (f.season, f.episode, f.id) > (?, ?, ?)"
+            args += list(after)
+        with self._pool.connection() as conn:
+            c = conn.cursor()
+            c.execute(
+                "SELECT f.id, f.path, f.season, f.episode, f.size FROM file AS f WHERE "
+                + where
+                + " AND "
+                + condition
+                + " ORDER BY f.season, f.episode, f.id LIMIT ?",
+                args + params + [limit],
+            )
+            rows = c.fetchall()
+        return [(r[0], self._toUrlPath(shares, r[1])) + tuple(r[2:]) for r in rows]
+
+    @database_seconds.timed()
+    def getMovieYears(self, username):
+        # Years of movies with their numbers of movies
+        shares, condition, params = self._getShareRanges(username)
+        if not shares:
+            return []
+        with self._pool.connection() as conn:
+            c = conn.cursor()
+            c.execute(
+                "SELECT f.year, COUNT(*) FROM file AS f WHERE f.kind = {} AND ".format(TYPE_MOVIE)
+                + condition
+                + " GROUP BY f.year ORDER BY f.year",
+                params,
+            )
+            return c.fetchall()
+
+    @database_seconds.timed()
+    def getMovies(self, username, year=None, after=None, limit=100):
+        # Movies as (id, urlpath, title, year, size), following the (year, title, id) key after
+        shares, condition, params = self._getShareRanges(username)
+        if not shares:
+            return []
+        where = "f.kind = {}".format(TYPE_MOVIE)
+        args = []
+        if year is not None:
+            where += " AND f.year = ?"
+            args.append(year)
+        if after is not None:
+            where += " AND (f.year, f.title, f.id) > (?, ?, ?)"
+            args += list(after)
+        with self._pool.connection() as conn:
+            c = conn.cursor()
+            c.execute(
+                "SELECT f.id, f.path, f.title, f.year, f.size FROM file AS f WHERE "
+                + where
+                + " AND "
+                + condition
+                + " ORDER BY f.year, f.title, f.id LIMIT ?",
+                args + params + [limit],
+            )
+            rows = c.fetchall()
+        return [(r[0], self._toUrlPath(shares, r[1])) + tuple(r[2:]) for r in rows]
+
+    @database_seconds.timed()
+    def getMediaInfo(self, path, size, mtime):
+        with self._pool.connection() as conn:
+            c = conn.cursor()
+            c.execute(
+                "SELECT info FROM media WHERE path = ? AND size = ? AND mtime = ? LIMIT 1",
+                (path, size, mtime),
+            )
+            r = c.fetchone()
+            if r is None:
+                return None
+            return json.loads(r[0])
+
+    def setMediaInfo(self, path, size, mtime, info):
+        video = info.get("video") or {}
+        with self._pool.connection() as conn:
+            c = conn.cursor()
+            c.execute(
+                "INSERT OR REPLACE INTO media (path, size, mtime, duration, format, video_codec, width, height, info) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    path,
+                    size,
+                    mtime,
+                    info.get("duration"),
+                    info.get("format"),
+                    video.get("codec"),
+                    video.get("width"),
+                    video.get("height"),
+                    json.dumps(info),
+                ),
+            )
+            conn.commit()
+
+    def queueTranscode(self, path, size, mtime):
+        # Returns True if the file was (re)queued
+        timestamp = int(time.time())
+        with self._pool.connection() as conn:
+            c = conn.cursor()
+            c.execute("SELECT size, mtime FROM transcode WHERE path = ? LIMIT 1", (path,))
+            r = c.fetchone()
+            if r is not None and r[0] == size and r[1] == mtime:
+                return False
+            c.execute(
+                "INSERT OR REPLACE INTO transcode (path, size, mtime, status, progress, output, timestamp) VALUES (?, ?, ?, 'pending', 0, NULL, ?)",
+                (path, size, mtime, timestamp),
+            )
+            conn.commit()
+            return True
+
+    def resetTranscodes(self):
+        # Requeue jobs interrupted by a previous run
+        with self._pool.connection() as conn:
+            c = conn.cursor()
+            c.execute("UPDATE transcode SET status = 'pending', progress = 0 WHERE status = 'running'")
+            conn.commit()
+
+    def claimTranscode(self):
+        timestamp = int(time.time())
+        with self._pool.connection() as conn:
+            c = conn.cursor()
+            while True:
+                c.execute(
+                    "SELECT id, path, size, mtime FROM transcode WHERE status = 'pending' ORDER BY id LIMIT 1"
+                )
+                r = c.fetchone()
+                if r is None:
+                    return None
+                c.execute(
+                    "UPDATE transcode SET status = 'running', progress = 0, timestamp = ? WHERE id = ? AND status = 'pending'",
+                    (timestamp, r[0]),
+                )
+                conn.commit()
+                if c.rowcount > 0:
+                    return r
+
+    def updateTranscode(self, job_id, status, progress=0, output=None):
+        # Returns False if the job was dropped meanwhile, its source changed or went away
+        timestamp = int(time.time())
+        with self._pool.connection() as conn:
+            c = conn.cursor()
+            c.execute(
+                "UPDATE transcode SET status = ?, progress = ?, output = ?, timestamp = ? WHERE id = ?",
+                (status, progress, output, timestamp, job_id),
+            )
+            conn.commit()
+            return c.rowcount > 0
+
+    def getTranscodes(self):
+        # All jobs as (path, size, mtime, output), output is None unless done
+        with self._pool.connection() as conn:
+            c = conn.cursor()
+            c.execute("SELECT path, size, mtime, output FROM transcode")
+            return c.fetchall()
+
+    def delTranscodes(self, paths):
+        with self._pool.connection() as conn:
+            c = conn.cursor()
+            c.executemany("DELETE FROM transcode WHERE path = ?", [(path,) for path in paths])
+            conn.commit()
+
+    @database_seconds.timed()
+    def getTranscode(self, path, size, mtime):
+        with self._pool.connection() as conn:
+            c = conn.cursor()
+            c.execute(
+                "SELECT output FROM transcode WHERE path = ? AND size = ? AND mtime = ? AND status = 'done' LIMIT 1",
+                (path, size, mtime),
+            )
+            r = c.fetchone()
+            return r[0] if r else None
+
+    def getTranscodeStatus(self):
+        with self._pool.connection() as conn:
+            c = conn.cursor()
+            c.execute("SELECT status, COUNT(*), AVG(progress) FROM transcode GROUP BY status")
+            return {r[0]: {"count": r[1], "progress": r[2]} for r in c.fetchall()}
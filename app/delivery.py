@@ -0,0 +1,220 @@
+"""
+    Copyright (C) 2017 by Paul-Louis Ageneau
+    paul-louis (at) ageneau (dot) org
+
+    This file is part of Swamp.
+
+    Swamp is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of
+    the License, or (at your option) any later version.
+
+    Swamp is distributed in the hope that it will be useful, but
+    WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public
+    License along with Swamp.
+    If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import mimetypes
+import unicodedata
+import urllib.parse
+import uuid
+import ssl
+import os
+
+import flask
+from flask import request
+from gevent.pywsgi import WSGIHandler
+from gevent.socket import wait_write
+
+from .metrics import response_bytes
+
+BUFFER_SIZE = 1024 * 1024  # read size when sendfile() is not available
+
+MAX_RANGES = 16  # more ranges than this are answered with the whole file
+
+
+class FileBody:
+    """Response body made of byte ranges of a file interleaved with literal parts
+
+    Iterating reads the file in large blocks, SendfileHandler sends it with sendfile().
+    """
+
+    def __init__(self, path, segments):
+        self.path = path
+        self.segments = segments  # bytes or (offset, length)
+        self._file = None
+        self._iter = None
+
+    def open(self):
+        if self._file is None:
+            self._file = open(self.path, "rb")
+        return self._file
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._iter is None:
+            self._iter = self._generate()
+        return next(self._iter)
+
+    def _generate(self):
+        fd = self.open().fileno()
+        for segment in self.segments:
+            if isinstance(segment, bytes):
+                yield segment
+                continue
+            offset, length = segment
+            while length > 0:
+                data = os.pread(fd, min(length, BUFFER_SIZE), offset)
+                if not data:
+                    raise Exception("File truncated while sending")
+                offset += len(data)
+                length -= len(data)
+                yield data
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class SendfileHandler(WSGIHandler):
+    """gevent request handler sending FileBody responses with sendfile()"""
+
+    def process_result(self):
+        body = self.result
+        if not isinstance(body, FileBody) or isinstance(self.socket, ssl.SSLSocket):
+            return super().process_result()
+        self.write(b"")  # headers only, the body has a Content-Length
+        fd = body.open().fileno()
+        for segment in body.segments:
+            if isinstance(segment, bytes):
+                self._sendall(segment)
+            else:
+                self._sendfile(fd, *segment)
+
+    def log_request(self):
+        response_bytes.inc(amount=self.response_length or 0)
+        super().log_request()
+
+    def _sendfile(self, fd, offset, length):
+        out = self.socket.fileno()
+        while length > 0:
+            try:
+                sent = os.sendfile(out, fd, offset, length)
+            except BlockingIOError:
+                wait_write(out, timeout=self.socket.gettimeout())
+                continue
+            if sent == 0:
+                raise Exception("File truncated while sending")
+            offset += sent
+            length -= sent
+            self.response_length += sent
+
+
+def get_ranges(size, etag, mtime):
+    # Satisfiable (start, stop) ranges, None to send the whole file, [] if unsatisfiable
+    r = request.range
+    if r is None or r.units != "bytes" or len(r.ranges) > MAX_RANGES:
+        return None
+    if_range = request.if_range
+    if if_range.etag is not None:
+        if if_range.etag != etag.strip('"'):
+            return None
+    elif if_range.date is not None:
+        if int(if_range.date.timestamp()) != int(mtime):
+            return None
+    ranges = []
+    for start, stop in r.ranges:
+        if start < 0:
+            start, stop = max(size + start, 0), size
+        else:
+            stop = min(stop, size) if stop is not None else size
+        if start < stop:
+            ranges.append((start, stop))
+    return ranges
+
+
+def is_not_modified(etag, mtime):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag.strip('"'))
+    if request.if_modified_since is not None:
+        return int(mtime) <= int(request.if_modified_since.timestamp())
+    return False
+
+
+def send_file(path, mimetype=None, as_attachment=False, max_age=None):
+    """Serve a file with conditional and single or multiple range requests"""
+    stat = os.stat(path)
+    size = stat.st_size
+    mtime = stat.st_mtime
+    etag = '"{:x}-{:x}"'.format(stat.st_mtime_ns, size)
+    mimetype = mimetype or mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+    if is_not_modified(etag, mtime):
+        response = flask.Response(status=304)
+        ranges = None
+    else:
+        ranges = get_ranges(size, etag, mtime)
+        if ranges is None:
+            response = flask.Response(
+                FileBody(path, [(0, size)]), mimetype=mimetype, direct_passthrough=True
+            )
+            response.content_length = size
+        elif not ranges:
+            response = flask.Response(status=416)
+            response.headers["Content-Range"] = "bytes */{}".format(size)
+        elif len(ranges) == 1:
+            start, stop = ranges[0]
+            response = flask.Response(
+                FileBody(path, [(start, stop - start)]),
+                206,
+                mimetype=mimetype,
+                direct_passthrough=True,
+            )
+            response.content_length = stop - start
+            response.headers["Content-Range"] = "bytes {}-{}/{}".format(start, stop - 1, size)
+        else:
+            boundary = uuid.uuid4().hex
+            segments = []
+            for i, (start, stop) in enumerate(ranges):
+                part = "{}--{}\r\nContent-Type: {}\r\nContent-Range: bytes {}-{}/{}\r\n\r\n"
+                part = part.format("\r\n" if i else "", boundary, mimetype, start, stop - 1, size)
+                segments.append(part.encode())
+                segments.append((start, stop - start))
+            segments.append("\r\n--{}--\r\n".format(boundary).encode())
+            response = flask.Response(
+                FileBody(path, segments),
+                206,
+                mimetype="multipart/byteranges; boundary=" + boundary,
+                direct_passthrough=True,
+            )
+            response.content_length = sum(
+                len(s) if isinstance(s, bytes) else s[1] for s in segments
+            )
+
+    response.headers["Accept-Ranges"] = "bytes"
+    response.headers["ETag"] = etag
+    response.last_modified = int(mtime)
+    if max_age is not None:
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+    else:
+        response.cache_control.no_cache = True
+    if as_attachment:
+        name = os.path.basename(path)
+        try:
+            name.encode("ascii")
+            names = {"filename": name}
+        except UnicodeEncodeError:
+            simple = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode()
+            quoted = urllib.parse.quote(name, safe="!#$&+^`|~")
+            names = {"filename": simple, "filename*": "UTF-8''" + quoted}
+        response.headers.set("Content-Disposition", "attachment", **names)
+    return response
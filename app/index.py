@@ -0,0 +1,238 @@
+"""
+    Copyright (C) 2017 by Paul-Louis Ageneau
+    paul-louis (at) ageneau (dot) org
+
+    This file is part of Swamp.
+
+    Swamp is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of
+    the License, or (at your option) any later version.
+
+    Swamp is distributed in the hope that it will be useful, but
+    WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public
+    License along with Swamp.
+    If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+import select
+import time
+import os
+
+from .pretranscode import VIDEO_EXTENSIONS
+from .parser import Classifier
+
+ENABLE_INOTIFY = True
+try:
+    import inotify_simple
+except ImportError:
+    print("Missing inotify_simple package, falling back to periodic rescans")
+    ENABLE_INOTIFY = False
+
+AUDIO_EXTENSIONS = ["mp3", "m4a", "ogg", "flac"]
+
+RESCAN_INTERVAL = 600  # seconds between rescans of the shared directories
+YIELD_ENTRIES = 256  # entries listed between yields to other greenlets
+
+classifier = Classifier()
+
+
+def media_type(name):
+    ext = os.path.splitext(name)[1][1:].lower()
+    if ext in VIDEO_EXTENSIONS:
+        return "video"
+    if ext in AUDIO_EXTENSIONS:
+        return "audio"
+    return None
+
+
+class Indexer:
+    """Index of shared directories in the database
+
+    Directories are listed again when their mtime changes. While running, inotify
+    updates the index as files change and a periodic rescan catches anything missed.
+    Requests only ever list the directory they show, subtrees are left to the thread.
+    """
+
+    def __init__(self, database, rescan_interval=RESCAN_INTERVAL):
+        self.database = database
+        self.rescan_interval = rescan_interval
+        self._roots = [root for root, _ in database.getDirectories()]
+        self._stopped = False
+        self._inotify = None
+        self._paths = {}  # watch descriptor -> directory path
+        self._lock = threading.Lock()
+        self._pending = set()  # new subdirectories found by requests
+        self._wakeup = os.pipe()
+        os.set_blocking(self._wakeup[1], False)
+
+    def scan(self):
+        # Bring the index up to date, returns the number of directories listed
+        self._roots = [root for root, _ in self.database.getDirectories()]
+        return sum(self.index_tree(root) for root in self._roots)
+
+    def index_tree(self, path):
+        # List directories whose mtime changed, walking unchanged ones from the index
+        count = 0
+        stack = [path]
+        while stack:
+            path = stack.pop()
+            try:
+                stat = os.stat(path)
+            except OSError:
+                self.database.delIndexedTree(path)
+                continue
+            if self.database.getIndexedMtime(path) != stat.st_mtime_ns:
+                subdirectories = self.index_directory(path, stat.st_mtime_ns)
+                count += 1
+            else:
+                subdirectories = self.database.getIndexedSubdirectories(path)
+            self._watch(path)
+            stack.extend(subdirectories)
+            time.sleep(0)  # cooperative under gevent, scandir and sqlite block the hub
+        return count
+
+    def refresh(self, path):
+        # List a changed directory again, returns its subdirectories not indexed yet
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self.database.delIndexedTree(path)
+            return []
+        subdirectories = self.index_directory(path, stat.st_mtime_ns)
+        return [s for s in subdirectories if self.database.getIndexedMtime(s) is None]
+
+    def index_directory(self, path, mtime):
+        entries = []
+        subdirectories = []
+        media = []
+        with os.scandir(path) as it:
+            for i, entry in enumerate(it):
+                if i % YIELD_ENTRIES == YIELD_ENTRIES - 1:
+                    time.sleep(0)
+                if entry.name[0] == ".":
+                    continue
+                try:
+                    is_dir = entry.is_dir()
+                    stat = entry.stat()
+                except OSError:
+                    continue  # removed meanwhile
+                if is_dir:
+                    subdirectories.append(entry.path)
+                    entries.append((entry.name, 1, 0, stat.st_mtime_ns, None, None))
+                else:
+                    kind = media_type(entry.name)
+                    entries.append((entry.name, 0, stat.st_size, stat.st_mtime_ns, kind, None))
+                    if kind:
+                        media.append(len(entries) - 1)
+        names = ((entries[i][0], entries[i][3]) for i in media)
+        for i, c in zip(media, classifier.classify(names)):
+            entries[i] = entries[i][:5] + (c,)
+        self.database.setIndexedEntries(path, mtime, entries)
+        return subdirectories
+
+    def list_directory(self, path):
+        # Indexed entries of a shared directory, None if it is not shared
+        if not any(path == root or path.startswith(root + os.sep) for root in self._roots):
+            return None
+        if self.database.getIndexedMtime(path) != os.stat(path).st_mtime_ns:
+            self._queue(self.refresh(path))
+        return self.database.getIndexedEntries(path)
+
+    def _queue(self, paths):
+        # Leave new subtrees to the thread, a listing indexes its directory anyway
+        if not paths:
+            return
+        with self._lock:
+            self._pending.update(paths)
+        try:
+            os.write(self._wakeup[1], b"\0")
+        except BlockingIOError:
+            pass  # already woken up
+
+    def start(self):
+        self._stopped = False
+        if ENABLE_INOTIFY and self._inotify is None:
+            self._inotify = inotify_simple.INotify()
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+
+    def stop(self):
+        self._stopped = True
+
+    def _watch(self, path):
+        if self._inotify is None:
+            return
+        flags = inotify_simple.flags
+        mask = (
+            flags.CREATE
+            | flags.DELETE
+            | flags.MOVED_FROM
+            | flags.MOVED_TO
+            | flags.CLOSE_WRITE
+            | flags.ATTRIB
+            | flags.ONLYDIR
+        )
+        try:
+            wd = self._inotify.add_watch(path, mask)
+        except OSError as e:
+            print("Unable to watch {}: {}".format(path, e))  # e.g. watch limit reached
+            return
+        with self._lock:
+            self._paths[wd] = path  # a moved directory keeps its descriptor
+
+    def _run(self):
+        next_scan = 0
+        while not self._stopped:
+            timeout = max(next_scan - time.time(), 0)
+            fds = [self._wakeup[0]]
+            if self._inotify is not None:
+                fds.append(self._inotify.fileno())
+            readable, _, _ = select.select(fds, [], [], timeout)
+            if self._wakeup[0] in readable:
+                os.read(self._wakeup[0], 4096)
+                self._index_pending()
+            if self._inotify is not None and self._inotify.fileno() in readable:
+                self._handle(self._inotify.read(timeout=0))
+            if time.time() >= next_scan:
+                try:
+                    self.scan()
+                except Exception as e:
+                    print("Indexing failed: {}".format(e))
+                next_scan = time.time() + self.rescan_interval
+
+    def _index_pending(self):
+        with self._lock:
+            paths = list(self._pending)
+            self._pending.clear()
+        for path in paths:
+            try:
+                self.index_tree(path)
+            except Exception as e:
+                print("Indexing failed for {}: {}".format(path, e))
+
+    def _handle(self, events):
+        flags = inotify_simple.flags
+        changed = set()
+        for event in events:
+            if event.mask & flags.Q_OVERFLOW:
+                self.scan()  # events were lost
+                return
+            with self._lock:
+                if event.mask & flags.IGNORED:
+                    self._paths.pop(event.wd, None)
+                    continue
+                path = self._paths.get(event.wd)
+            if path is not None:
+                changed.add(path)
+        for path in changed:
+            try:
+                for subdirectory in self.refresh(path):
+                    self.index_tree(subdirectory)
+            except Exception as e:
+                print("Indexing failed for {}: {}".format(path, e))
@@ -0,0 +1,244 @@
+"""
+    Copyright (C) 2017 by Paul-Louis Ageneau
+    paul-louis (at) ageneau (dot) org
+
+    This file is part of Swamp.
+
+    Swamp is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of
+    the License, or (at your option) any later version.
+
+    Swamp is distributed in the hope that it will be useful, but
+    WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public
+    License along with Swamp.
+    If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import functools
+import threading
+import bisect
+import time
+
+# Latency buckets in seconds, from a cached lookup to a slow ffprobe
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Metric:
+    """Named values by label values, exposed in the Prometheus text format"""
+
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # label values -> value
+        self._lock = threading.Lock()
+
+    def samples(self):
+        # (name suffix, label values, value) tuples
+        with self._lock:
+            return [("", labels, value) for labels, value in self._values.items()]
+
+    def expose(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} {}".format(self.name, self.kind),
+        ]
+        for suffix, labels, value in self.samples():
+            lines.append(
+                "{}{}{} {}".format(
+                    self.name, suffix, format_labels(self.labelnames, labels), format_value(value)
+                )
+            )
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """Gauge set by the instrumented code, or read from a callback when exposed
+
+    The callback returns (label values, value) pairs, so it can describe objects
+    which come and go, like streams, without ever removing stale labels.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def samples(self):
+        if self.callback is not None:
+            return [("", tuple(labels), value) for labels, value in self.callback()]
+        return super().samples()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def time(self, *labels):
+        return Timer(self, labels)
+
+    def timed(self, *labels):
+        # Decorator, labelled with the function name when no labels are given
+        def decorator(f):
+            values = labels or (f.__name__,) * len(self.labelnames)
+
+            @functools.wraps(f)
+            def decorated(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return f(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - start, *values)
+
+            return decorated
+
+        return decorator
+
+    def samples(self):
+        with self._lock:
+            entries = [(labels, list(c), total) for labels, (c, total) in self._values.items()]
+        samples = []
+        bounds = [format_value(b) for b in self.buckets] + ["+Inf"]
+        for labels, counts, total in entries:
+            cumulated = 0
+            for bound, count in zip(bounds, counts):
+                cumulated += count
+                samples.append(("_bucket", labels + (("le", bound),), cumulated))
+            samples.append(("_sum", labels, total))
+            samples.append(("_count", labels, cumulated))
+        return samples
+
+
+class Timer:
+    """Context manager observing its duration into a histogram"""
+
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def expose(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        return "\n".join(m.expose() for m in metrics) + "\n"
+
+
+def format_labels(names, values):
+    # Extra labels like the bucket bound come as (name, value) pairs after the values
+    pairs = list(zip(names, values)) + [v for v in values[len(names):]]
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, escape(v)) for k, v in pairs) + "}"
+
+
+def format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return str(value)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+registry = Registry()
+
+request_seconds = registry.histogram(
+    "swamp_request_duration_seconds",
+    "Time to the response headers by route",
+    ("route", "method", "status"),
+)
+
+response_bytes = registry.counter("swamp_response_bytes_total", "Bytes of response bodies sent")
+
+directory_seconds = registry.histogram(
+    "swamp_directory_resolve_seconds", "Resolutions of URL paths to directories"
+)
+
+database_seconds = registry.histogram(
+    "swamp_database_call_seconds", "Database calls by method", ("method",)
+)
+
+database_wait_seconds = registry.histogram(
+    "swamp_database_pool_wait_seconds", "Waits for a connection when the pool is exhausted"
+)
+
+password_seconds = registry.histogram(
+    "swamp_password_verify_seconds", "Password hash verifications"
+)
+
+probe_seconds = registry.histogram("swamp_probe_seconds", "ffprobe runs")
+
+encoder_start_seconds = registry.histogram(
+    "swamp_encoder_first_byte_seconds", "Time from ffmpeg start to its first output for streams"
+)
+
+segment_seconds = registry.histogram(
+    "swamp_segment_encode_seconds", "Encodings of HLS segments"
+)
+
+stream_bytes = registry.counter(
+    "swamp_stream_bytes_total", "Bytes of transcoded streams sent to clients"
+)
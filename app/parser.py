@@ -19,7 +19,26 @@
     If not, see <http://www.gnu.org/licenses/>.
 """
 
+import collections
+import bisect
+import itertools
+import operator
+import multiprocessing
+import threading
+import select
 import re
+import os
+
+TYPE_NONE = 0
+TYPE_SERIE = 1
+TYPE_MOVIE = 2
+TYPE_MUSIC = 3
+
+DIGITS = frozenset("0123456789")  # [0-9], str.isdigit() accepts other digits
+
+CHUNK_SIZE = 1000  # names per batch sent to a worker process
+
+CACHE_SIZE = 100000  # memoized classifications
 
 
 class Parser:
@@ -28,59 +47,263 @@ class Parser:
 
     PatternSerie = re.compile(r"(?:\[(.*)\]\.?)?([^\[\]]+)(?:\.|\-)(?:S([0-9]{2}) ?E([0-9]{2})|([0-9]{1,2})X([0-9]{2}))(?:(?:\.|\-)(.*))?\.(" + PatternVideoExt + ")$", re.IGNORECASE)
     PatternMovie = re.compile(r"(?:\[(.*)\]\.?)?([^\[\]]+)(?:\.|\-)(\(?((?:19|20)[0-9]{2})\)?)(?:(?:\.|\-)(.*))?\.(" + PatternVideoExt + ")$", re.IGNORECASE)
+    # A title, possibly with a comment, is enough for PatternMusic to match
+    PatternMusicTitle = re.compile(r"[^()]+(?:\.\(.*\))?\.(" + PatternAudioExt + ")$", re.IGNORECASE)
     PatternMusic = re.compile(r"(?:\[(.*)\]\.?)?(?:([0-9]{1,3})(?:\-|\.))?(?:(.+[^0-9])\-)?(?:([0-9]{1,3})\-)?([^()]+)(?:\.\((.*)\))?\.(" + PatternAudioExt + ")$", re.IGNORECASE)
 
+    PatternSpaces = re.compile(r"[\. ]+")
+    PatternDashes = re.compile(r"\.*\-+\.*")
+
+    VideoExtensions = frozenset(PatternVideoExt.split("|"))
+    AudioExtensions = frozenset(PatternAudioExt.split("|"))
+
     def __init__(self, filename):
-        self.type = 0
+        c = classify_name(filename)
+        self.type = c.type
+        self.name = c.name
+        for attr in Classification.__slots__[4:]:
+            value = getattr(c, attr)
+            if value is not None:
+                setattr(self, attr, value)
+
+
+class Classification:
+    """Media information parsed from a file name"""
+
+    __slots__ = (
+        "path",
+        "mtime",
+        "type",
+        "name",
+        "tag",
+        "title",
+        "season",
+        "episode",
+        "year",
+        "artist",
+        "track",
+    )
+
+    def __init__(self, path, mtime=None):
+        self.path = path
+        self.mtime = mtime
+        self.type = TYPE_NONE
         self.name = ""
+        self.tag = None
+        self.title = None
+        self.season = None
+        self.episode = None
+        self.year = None
+        self.artist = None
+        self.track = None
 
-        # Clean filename
-        cfilename = filename.replace("_", " ")
-        cfilename = re.sub(r"[\. ]+", r".", cfilename)
-        cfilename = re.sub(r"\.*\-+\.*", r"-", cfilename)
+    def __getstate__(self):
+        # A plain tuple is much faster to pickle than the slots dictionary
+        return _slot_values(self)
 
-        # Match
+    def __setstate__(self, state):
+        for attr, value in zip(self.__slots__, state):
+            setattr(self, attr, value)
+
+
+_slot_values = operator.attrgetter(*Classification.__slots__)
+
+
+def classify_name(path, mtime=None):
+    c = Classification(path, mtime)
+
+    # Clean filename
+    cfilename = os.path.basename(path).replace("_", " ")
+    cfilename = Parser.PatternSpaces.sub(".", cfilename)
+    cfilename = Parser.PatternDashes.sub("-", cfilename)
+    ext = cfilename.rsplit(".", 1)[-1].lower()
+
+    # Match
+    if ext in Parser.VideoExtensions:
         m = Parser.PatternSerie.match(cfilename)
         if m:
-            self.type = 1
-            self.tag = m.group(1) or ""
-            self.title = m.group(2).replace(".", " ").title()
-            self.season = int(m.group(3) or m.group(5) or "0")
-            self.episode = int(m.group(4) or m.group(6) or "0")
-            self.name = "{} S{:02d}E{:02d}".format(self.title, self.season, self.episode)
-            print(
-                "Serie: " + self.title
-                + ("\tseason=" + str(self.season))
-                + ("\tepisode=" + str(self.episode))
-                + ("\ttag = " + self.tag if self.tag else "")
-            )
-            return
+            c.type = TYPE_SERIE
+            c.tag = m.group(1) or ""
+            c.title = m.group(2).replace(".", " ").title()
+            c.season = int(m.group(3) or m.group(5) or "0")
+            c.episode = int(m.group(4) or m.group(6) or "0")
+            c.name = "{} S{:02d}E{:02d}".format(c.title, c.season, c.episode)
+            return c
 
         m = Parser.PatternMovie.match(cfilename)
         if m:
-            self.type = 2
-            self.tag = m.group(1)
-            self.title = m.group(2).replace(".", " ").title()
-            self.name = self.title
-            print(
-                    "Movie: " + self.title
-                    + ("\ttag = " + self.tag if self.tag else "")
-            )
-            return
+            c.type = TYPE_MOVIE
+            c.tag = m.group(1) or ""
+            c.title = m.group(2).replace(".", " ").title()
+            c.year = int(m.group(4))
+            c.name = c.title
+            return c
 
+    elif ext in Parser.AudioExtensions and _music_may_match(cfilename):
         m = Parser.PatternMusic.match(cfilename)
         if m:
-            self.type = 3
-            self.tag = m.group(1) or ""
-            self.track = int(m.group(2) or m.group(4) or "0")
-            self.artist = (m.group(3) or "").replace(".", " ").title()
-            self.title = m.group(5).replace(".", " ").title()
-            self.name = (self.artist + ", " if self.artist else "") + self.title
-            if self.track or self.artist:
-                print(
-                    "Music: " + self.title
-                    + ("\ttrack=" + str(self.track) if self.track > 0 else "")
-                    + ("\tartist=" + self.artist if self.artist else "")
-                    + ("\ttag = " + self.tag if self.tag else "")
-                )
-                return
+            c.type = TYPE_MUSIC
+            c.tag = m.group(1) or ""
+            c.track = int(m.group(2) or m.group(4) or "0")
+            c.artist = (m.group(3) or "").replace(".", " ").title()
+            c.title = m.group(5).replace(".", " ").title()
+            c.name = (c.artist + ", " if c.artist else "") + c.title
+
+    return c
+
+
+def _music_may_match(name):
+    # Whether PatternMusic can match, in linear time: a failing match backtracks
+    # over every split into tag, artist and title, which takes milliseconds
+    if "\n" in name or Parser.PatternMusicTitle.match(name):
+        return True
+    s = name.rsplit(".", 1)[0]
+    n = len(s)
+    parens = [m.start() for m in re.finditer(r"[()]", s)]
+    comment = s[-1:] == ")"
+
+    def title(i):
+        # The title stops at the first parenthesis, which must open a final comment
+        k = bisect.bisect_left(parens, i)
+        if k == len(parens):
+            return i < n
+        p = parens[k]
+        return comment and s[p] == "(" and p - 1 > i and s[p - 1] == "."
+
+    def track(i, separators):
+        # Positions after a track number of 1 to 3 digits at i
+        for k in range(1, 4):
+            if i + k < n and s[i + k] in separators and all(c in DIGITS for c in s[i : i + k]):
+                yield i + k + 1
+
+    def after_artist(i):
+        return title(i) or any(title(j) for j in track(i, "-"))
+
+    # The artist may contain anything, so only the last dash which can end it matters
+    last = s.rfind("-")
+    while last > 1 and (s[last - 1] in DIGITS or not after_artist(last + 1)):
+        last = s.rfind("-", 0, last)
+
+    def after_tag(i):
+        return any(last > j + 1 or after_artist(j) for j in itertools.chain((i,), track(i, "-.")))
+
+    if after_tag(0):
+        return True
+    if s[:1] == "[":
+        k = s.find("]", 1)
+        while k >= 0:
+            if after_tag(k + 1) or (s[k + 1 : k + 2] == "." and after_tag(k + 2)):
+                return True
+            k = s.find("]", k + 1)
+    return False
+
+
+def _classify_names(keys):
+    return [classify_name(path, mtime) for path, mtime in keys]
+
+
+def _worker(requests, results):
+    # Worker process loop, classifies batches until it receives None
+    try:
+        for keys in iter(requests.recv, None):
+            results.send(_classify_names(keys))
+    except (EOFError, BrokenPipeError):
+        pass
+
+
+class Classifier:
+    """Batch classification of file names, memoized by (path, mtime)
+
+    With processes > 1, batches are classified in a pool of worker processes.
+    """
+
+    def __init__(self, processes=0, cache_size=CACHE_SIZE):
+        self.processes = processes
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()  # (path, mtime) -> Classification
+        self._lock = threading.Lock()
+
+    def classify(self, items, chunk_size=CHUNK_SIZE):
+        # Items are paths or (path, mtime) pairs, results are yielded in the same order
+        workers = [self._start_worker() for _ in range(self.processes if self.processes > 1 else 0)]
+        idle = list(workers)
+        try:
+            batches = collections.deque()  # (chunk, results or worker)
+            for chunk in self._chunks(items, chunk_size):
+                with self._lock:
+                    missing = [key for key in chunk if key not in self._cache]
+                if not workers:
+                    yield from self._collect(chunk, _classify_names(missing))
+                elif missing:
+                    while not idle and batches:
+                        chunk0, result = batches.popleft()
+                        yield from self._collect(chunk0, result)
+                        if isinstance(result, tuple) and not result[2].closed:
+                            idle.append(result)
+                    worker = idle.pop() if idle else None  # none left if all died
+                    if worker is not None:
+                        try:
+                            worker[1].send(missing)
+                        except OSError:
+                            worker[2].close()  # died while idle
+                            worker = None
+                    batches.append((chunk, worker))  # without worker, classified inline
+                else:
+                    batches.append((chunk, None))
+            while batches:
+                yield from self._collect(*batches.popleft())
+        finally:
+            for process, requests, results in workers:
+                try:
+                    requests.send(None)
+                except OSError:
+                    pass  # already dead
+                requests.close()
+                results.close()  # unblocks a worker sending results nobody reads
+                process.join()
+
+    def _start_worker(self):
+        requests_in, requests = multiprocessing.Pipe(duplex=False)
+        results, results_out = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(
+            target=_worker, args=(requests_in, results_out), daemon=True
+        )
+        process.start()
+        requests_in.close()
+        results_out.close()
+        return process, requests, results
+
+    def _chunks(self, items, chunk_size):
+        chunk = []
+        for item in items:
+            chunk.append(item if isinstance(item, tuple) else (item, None))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _collect(self, chunk, result):
+        if isinstance(result, tuple):
+            results = result[2]
+            select.select([results], [], [])  # cooperative wait under gevent
+            try:
+                result = results.recv()
+            except EOFError:
+                results.close()  # the worker died, its batch is classified inline
+                result = None
+        records = []
+        with self._lock:
+            for c in result or []:
+                self._cache[(c.path, c.mtime)] = c
+            for key in chunk:
+                c = self._cache.get(key)
+                if c is None:
+                    c = classify_name(*key)  # evicted meanwhile
+                    self._cache[key] = c
+                else:
+                    self._cache.move_to_end(key)
+                records.append(c)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return records
@@ -0,0 +1,167 @@
+"""
+    Copyright (C) 2017 by Paul-Louis Ageneau
+    paul-louis (at) ageneau (dot) org
+
+    This file is part of Swamp.
+
+    Swamp is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of
+    the License, or (at your option) any later version.
+
+    Swamp is distributed in the hope that it will be useful, but
+    WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public
+    License along with Swamp.
+    If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import hashlib
+import threading
+import time
+import os
+
+from .process import ManagedProcess, parse_progress
+from .streamer import Streamer
+
+VIDEO_EXTENSIONS = ["avi", "mkv", "mp4", "m4v", "mov", "webm"]
+
+PROGRESS_INTERVAL = 5  # seconds between progress updates
+
+SCAN_INTERVAL = 600  # seconds between scans when running as a service
+
+
+class Pretranscoder:
+    """Background pool encoding shared videos ahead of time"""
+
+    def __init__(self, database, directory, workers=1, niceness=10):
+        self.database = database
+        self.directory = directory
+        self.workers = max(workers, 1)
+        self.niceness = niceness
+        self._threads = []
+        self._stopped = False
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def scan(self):
+        # Queue new or modified videos from shared directories, outputs of modified or
+        # removed ones are deleted with their jobs
+        # path -> (size, mtime, output) of jobs left to find
+        known = {r[0]: r[1:] for r in self.database.getTranscodes()}
+        count = 0
+        for root, _ in self.database.getDirectories():
+            for dirpath, dirnames, filenames in os.walk(root):
+                dirnames[:] = [d for d in dirnames if d[0] != "."]
+                for name in filenames:
+                    ext = os.path.splitext(name)[1][1:].lower()
+                    if name[0] == "." or ext not in VIDEO_EXTENSIONS:
+                        continue
+                    path = os.path.join(dirpath, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    previous = known.pop(path, None)
+                    if previous is not None and previous[:2] != (stat.st_size, stat.st_mtime_ns):
+                        self._remove_output(previous[2])
+                    if self.database.queueTranscode(path, stat.st_size, stat.st_mtime_ns):
+                        count += 1
+        # Not found in any share anymore
+        self.database.delTranscodes(list(known))
+        for _, _, output in known.values():
+            self._remove_output(output)
+        return count
+
+    def start(self, loop=False):
+        # With loop, keep scanning and waiting for new files instead of exiting
+        self._stopped = False
+        self.database.resetTranscodes()
+        if loop:
+            thread = threading.Thread(target=self._scan_loop, daemon=True)
+            thread.start()
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._work, args=(loop,), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def stop(self):
+        self._stopped = True
+
+    def get_output_path(self, path, size, mtime):
+        key = "{}|{}|{}".format(path, size, mtime)
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + ".mp4")
+
+    def _remove_output(self, output):
+        if output is None:
+            return
+        try:
+            os.remove(output)
+        except FileNotFoundError:
+            pass
+
+    def _scan_loop(self):
+        while not self._stopped:
+            self.scan()
+            time.sleep(SCAN_INTERVAL)
+
+    def _work(self, loop):
+        while not self._stopped:
+            job = self.database.claimTranscode()
+            if job is None:
+                if not loop:
+                    break
+                time.sleep(60)
+                continue
+            job_id, path, size, mtime = job
+            try:
+                output = self._transcode(job_id, path, size, mtime)
+            except Exception as e:
+                print("Pre-transcoding failed for {}: {}".format(path, e))
+                self.database.updateTranscode(job_id, "failed")
+            else:
+                if output is not None:
+                    if not self.database.updateTranscode(job_id, "done", 1.0, output):
+                        self._remove_output(output)  # dropped by a scan meanwhile
+
+    def _transcode(self, job_id, path, size, mtime):
+        stat = os.stat(path)
+        if stat.st_size != size or stat.st_mtime_ns != mtime:
+            raise Exception("File changed since it was queued")
+        s = Streamer(path, database=self.database)
+        duration = s.get_info()["duration"]
+        output = self.get_output_path(path, size, mtime)
+        tmp_output = output + ".tmp"
+        args = ["nice", "-n", str(self.niceness)] + s.get_pretranscode_command(tmp_output)
+        proc = ManagedProcess(args)
+        try:
+            last_update = time.time()
+            for line in proc.stdout:
+                if self._stopped:
+                    break
+                key, value = parse_progress(line) or (None, None)
+                if key == "out_time_us" and value.isdigit() and duration > 0:
+                    if time.time() - last_update >= PROGRESS_INTERVAL:
+                        last_update = time.time()
+                        progress = min(int(value) / 1e6 / duration, 1.0)
+                        self.database.updateTranscode(job_id, "running", progress)
+            if self._stopped:
+                self.database.updateTranscode(job_id, "pending")
+                return None
+            code = proc.wait()
+            if code != 0:
+                raise Exception("ffmpeg exited with code {}".format(code))
+            os.replace(tmp_output, output)
+        finally:
+            proc.close()
+            if os.path.exists(tmp_output):
+                os.remove(tmp_output)
+        return output
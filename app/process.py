@@ -0,0 +1,161 @@
+"""
+    Copyright (C) 2017 by Paul-Louis Ageneau
+    paul-louis (at) ageneau (dot) org
+
+    This file is part of Swamp.
+
+    Swamp is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of
+    the License, or (at your option) any later version.
+
+    Swamp is distributed in the hope that it will be useful, but
+    WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public
+    License along with Swamp.
+    If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import subprocess
+import threading
+import resource
+import fcntl
+import os
+
+DEFAULT_CHUNK_SIZE = 256 * 1024
+
+
+class ManagedProcess:
+    """Child process owning its output pipe, killed and reaped on close
+
+    As a WSGI response body, the server closes it when the client goes away.
+    """
+
+    _lock = threading.Lock()
+    _live = {}  # pid -> ManagedProcess
+    spawned = 0
+    reaped = 0
+
+    def __init__(self, args, chunk_size=DEFAULT_CHUNK_SIZE, stdout=subprocess.PIPE, stderr=None):
+        self.args = args
+        self.chunk_size = chunk_size
+        self._closed = False
+        self._proc = subprocess.Popen(
+            args, stdin=subprocess.DEVNULL, stdout=stdout, stderr=stderr, shell=False
+        )
+        if self._proc.stdout and hasattr(fcntl, "F_SETPIPE_SZ"):
+            # Let the child write a whole chunk before the pipe blocks it
+            try:
+                fcntl.fcntl(self._proc.stdout.fileno(), fcntl.F_SETPIPE_SZ, chunk_size)
+            except OSError:
+                pass
+        with ManagedProcess._lock:
+            ManagedProcess.spawned += 1
+            ManagedProcess._live[self._proc.pid] = self
+
+    @property
+    def pid(self):
+        return self._proc.pid
+
+    @property
+    def stdout(self):
+        return self._proc.stdout
+
+    @property
+    def stderr(self):
+        return self._proc.stderr
+
+    @property
+    def returncode(self):
+        return self._proc.returncode
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        data = self.read()
+        if not data:
+            self.close()
+            raise StopIteration
+        return data
+
+    def read(self, size=None):
+        if self._closed:
+            return b""
+        return self._proc.stdout.read1(size or self.chunk_size)
+
+    def poll(self):
+        code = self._proc.poll()
+        if code is not None:
+            self._reaped()
+        return code
+
+    def wait(self, timeout=None):
+        code = self._proc.wait(timeout)
+        self._reaped()
+        return code
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._proc.poll() is None:
+            self._proc.kill()
+        self.wait()
+        # A piped stderr is left to its reader, which gets end of file now that the
+        # process is dead: closing it under a pending readline() raises RuntimeError
+        if self._proc.stdout:
+            try:
+                self._proc.stdout.close()
+            except (OSError, ValueError):
+                pass
+
+    def _reaped(self):
+        with ManagedProcess._lock:
+            if ManagedProcess._live.pop(self._proc.pid, None) is not None:
+                ManagedProcess.reaped += 1
+
+    def cpu_time(self):
+        # User and system time of the running process, in seconds
+        try:
+            with open("/proc/{}/stat".format(self._proc.pid)) as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        except (OSError, IndexError, ValueError):
+            return 0.0
+
+    @classmethod
+    def stats(cls):
+        with cls._lock:
+            live = list(cls._live.values())
+            spawned = cls.spawned
+            reaped = cls.reaped
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return {
+            "live": len(live),
+            "spawned": spawned,
+            "reaped": reaped,
+            "cpu_time": usage.ru_utime + usage.ru_stime + sum(p.cpu_time() for p in live),
+        }
+
+    @classmethod
+    def run(cls, args):
+        # Run to completion, killing the process if the caller is interrupted
+        proc = cls(args, stdout=subprocess.DEVNULL)
+        try:
+            code = proc.wait()
+        finally:
+            proc.close()
+        if code != 0:
+            raise subprocess.CalledProcessError(code, args)
+
+
+def parse_progress(line):
+    # (key, value) from a line of ffmpeg -progress output, None for anything else
+    key, sep, value = line.decode(errors="replace").strip().partition("=")
+    if not sep or not key.isidentifier():
+        return None
+    return key, value.strip()
@@ -0,0 +1,111 @@
+"""
+    Copyright (C) 2017 by Paul-Louis Ageneau
+    paul-louis (at) ageneau (dot) org
+
+    This file is part of Swamp.
+
+    Swamp is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of
+    the License, or (at your option) any later version.
+
+    Swamp is distributed in the hope that it will be useful, but
+    WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public
+    License along with Swamp.
+    If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import itertools
+import threading
+import time
+import os
+
+PRIORITY_HIGH = 0  # Chromecast and HD sessions
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2  # background work like segment prefetching
+
+
+def default_max_jobs():
+    return max((os.cpu_count() or 1) // 2, 1)
+
+
+class SchedulerFull(Exception):
+    def __init__(self, retry_after):
+        super().__init__("Too many transcoding jobs")
+        self.retry_after = retry_after
+
+
+class Slot:
+    def __init__(self, scheduler, priority):
+        self.priority = priority
+        self._scheduler = scheduler
+        self._released = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def release(self):
+        self._scheduler._release(self)
+
+
+class Scheduler:
+    """Bounds concurrent encoders, queueing excess jobs by priority"""
+
+    def __init__(self, max_jobs=0, queue_size=16, queue_timeout=30, retry_after=10):
+        self.max_jobs = max_jobs if max_jobs > 0 else default_max_jobs()
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.running = 0
+        self.rejected = 0
+        self._queue = []  # (priority, sequence) waiting entries
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+
+    def acquire(self, priority=PRIORITY_NORMAL, wait=True):
+        with self._cond:
+            if self.running < self.max_jobs and not self._queue:
+                self.running += 1
+                return Slot(self, priority)
+            if not wait or len(self._queue) >= self.queue_size:
+                self.rejected += 1
+                raise SchedulerFull(self.retry_after)
+            entry = (priority, next(self._sequence))
+            self._queue.append(entry)
+            deadline = time.time() + self.queue_timeout
+            try:
+                while self.running >= self.max_jobs or min(self._queue) != entry:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        raise SchedulerFull(self.retry_after)
+                    self._cond.wait(remaining)
+            finally:
+                self._queue.remove(entry)
+                self._cond.notify_all()
+            self.running += 1
+            return Slot(self, priority)
+
+    def _release(self, slot):
+        with self._cond:
+            if slot._released:
+                return
+            slot._released = True
+            self.running -= 1
+            self._cond.notify_all()
+
+    def describe(self):
+        with self._cond:
+            return {
+                "running": self.running,
+                "max": self.max_jobs,
+                "queued": len(self._queue),
+                "rejected": self.rejected,
+            }
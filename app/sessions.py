@@ -0,0 +1,476 @@
+"""
+    Copyright (C) 2017 by Paul-Louis Ageneau
+    paul-louis (at) ageneau (dot) org
+
+    This file is part of Swamp.
+
+    Swamp is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of
+    the License, or (at your option) any later version.
+
+    Swamp is distributed in the hope that it will be useful, but
+    WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public
+    License along with Swamp.
+    If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import collections
+import subprocess
+import itertools
+import threading
+import bisect
+import time
+import sys
+
+from .process import ManagedProcess, parse_progress
+from .metrics import encoder_start_seconds, stream_bytes
+from .scheduler import PRIORITY_NORMAL
+
+DEFAULT_BUFFER_SIZE = 16 * 1024 * 1024
+DEFAULT_CHUNK_SIZE = 256 * 1024
+DEFAULT_LAG_TIMEOUT = 10
+
+
+class MatroskaScanner:
+    """Incremental EBML walker locating the end of the header and cluster starts"""
+
+    ID_EBML = 0x1A45DFA3
+    ID_SEGMENT = 0x18538067
+    ID_CLUSTER = 0x1F43B675
+    ID_SIMPLEBLOCK = 0xA3
+
+    def __init__(self):
+        self.header_size = None
+        self._buffer = b""
+        self._offset = 0  # stream offset of self._buffer[0]
+        self._skip = 0  # bytes of element payload left to skip
+        self._cluster = None  # offset of the current cluster until its first block
+
+    def feed(self, data):
+        # Returns the offsets of clusters starting with a keyframe
+        keyframes = []
+        if self._skip >= len(data):
+            self._skip -= len(data)
+            self._offset += len(data)
+            return keyframes
+        data = data[self._skip:]
+        self._offset += self._skip
+        self._skip = 0
+        self._buffer += data
+        while True:
+            pos = 0
+            element_id, n = self._read_vint(pos, keep_marker=True)
+            if element_id is None:
+                break
+            pos += n
+            size, n = self._read_vint(pos)
+            if size is None:
+                break
+            pos += n
+            start = self._offset
+            if element_id == MatroskaScanner.ID_CLUSTER:
+                if self.header_size is None:
+                    self.header_size = start
+                self._cluster = start
+                size = -1  # enter cluster
+            elif element_id == MatroskaScanner.ID_SIMPLEBLOCK and self._cluster is not None:
+                if len(self._buffer) < pos + 4:
+                    break
+                # Track number vint, 16-bit timecode, then flags
+                _, n = self._read_vint(pos)
+                if n is None or len(self._buffer) < pos + n + 3:
+                    break
+                if self._buffer[pos + n + 2] & 0x80:
+                    keyframes.append(self._cluster)
+                self._cluster = None
+            elif element_id == MatroskaScanner.ID_SEGMENT:
+                size = -1  # enter segment
+            self._buffer = self._buffer[pos:]
+            self._offset += pos
+            if size > 0:
+                if size >= len(self._buffer):
+                    self._skip = size - len(self._buffer)
+                    self._offset += len(self._buffer)
+                    self._buffer = b""
+                    break
+                self._buffer = self._buffer[size:]
+                self._offset += size
+        return keyframes
+
+    def _read_vint(self, pos, keep_marker=False):
+        if pos >= len(self._buffer):
+            return None, None
+        first = self._buffer[pos]
+        length = 1
+        mask = 0x80
+        while length <= 8 and not first & mask:
+            length += 1
+            mask >>= 1
+        if length > 8 or pos + length > len(self._buffer):
+            return None, None
+        value = first if keep_marker else first & (mask - 1)
+        unknown = value == mask - 1
+        for b in self._buffer[pos + 1:pos + length]:
+            value = (value << 8) | b
+            unknown = unknown and b == 0xFF
+        if unknown and not keep_marker:
+            value = -1
+        return value, length
+
+
+class MP4Scanner:
+    """Incremental box walker for fragmented MP4, fragments start with a keyframe"""
+
+    def __init__(self):
+        self.header_size = None
+        self._buffer = b""
+        self._offset = 0  # stream offset of self._buffer[0]
+        self._skip = 0  # bytes of box payload left to skip
+
+    def feed(self, data):
+        # Returns the offsets of movie fragments
+        keyframes = []
+        if self._skip >= len(data):
+            self._skip -= len(data)
+            self._offset += len(data)
+            return keyframes
+        data = data[self._skip:]
+        self._offset += self._skip
+        self._skip = 0
+        self._buffer += data
+        while len(self._buffer) >= 8:
+            size = int.from_bytes(self._buffer[0:4], "big")
+            box_type = self._buffer[4:8]
+            if size == 1:
+                if len(self._buffer) < 16:
+                    break
+                size = int.from_bytes(self._buffer[8:16], "big")
+            elif size < 8:
+                size = None  # box extends to the end of the stream
+            if box_type == b"moof":
+                if self.header_size is None:
+                    self.header_size = self._offset
+                keyframes.append(self._offset)
+            if size is None:
+                self._skip = float("inf")
+                self._buffer = b""
+                break
+            if size >= len(self._buffer):
+                self._skip = size - len(self._buffer)
+                self._offset += len(self._buffer)
+                self._buffer = b""
+                break
+            self._buffer = self._buffer[size:]
+            self._offset += size
+        return keyframes
+
+
+class RingBuffer:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.start = 0  # offset of the first retained byte
+        self.end = 0  # offset after the last byte
+        self._chunks = collections.deque()
+
+    def __len__(self):
+        return self.end - self.start
+
+    def append(self, data):
+        self._chunks.append((self.end, data))
+        self.end += len(data)
+
+    def drop(self):
+        offset, data = self._chunks.popleft()
+        self.start = offset + len(data)
+        return self.start
+
+    def first_chunk_end(self):
+        offset, data = self._chunks[0]
+        return offset + len(data)
+
+    def read(self, offset, size):
+        if offset < self.start or offset >= self.end:
+            return b""
+        index = bisect.bisect_right(self._chunks, offset, key=lambda c: c[0]) - 1
+        chunk_offset, data = self._chunks[index]
+        begin = offset - chunk_offset
+        return data[begin:begin + size]
+
+    def read_exactly(self, offset, size):
+        parts = []
+        while size > 0:
+            data = self.read(offset, size)
+            if not data:
+                break
+            parts.append(data)
+            offset += len(data)
+            size -= len(data)
+        return b"".join(parts)
+
+
+class Subscription:
+    def __init__(self, session, token):
+        self._session = session
+        self._token = token
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._closed:
+            raise StopIteration
+        data = self._session.read(self._token)
+        if data is None:
+            self.close()
+            raise StopIteration
+        stream_bytes.inc(amount=len(data))
+        return data
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._session.registry.release(self._session, self._token)
+
+
+class TranscodeSession:
+    _ids = itertools.count(1)
+
+    def __init__(self, registry, key, args, scanner=None, slot=None):
+        self.registry = registry
+        self.slot = slot
+        self.key = key
+        self.id = next(TranscodeSession._ids)
+        self.created = time.time()
+        self.produced = 0  # bytes read from the encoder
+        self.speed = None  # encoding speed relative to real time
+        self.fps = None
+        self.throughput = None  # bytes per second between the last progress reports
+        self._scanner = scanner
+        self._ring = RingBuffer(registry.buffer_size)
+        self._header = b""
+        self._keyframes = collections.deque()
+        self._positions = {}  # token -> offset, None while waiting for a keyframe
+        self._prefixes = {}  # token -> header to send first
+        self._lock = threading.Lock()
+        self._data = threading.Condition(self._lock)  # signaled on new data
+        self._room = threading.Condition(self._lock)  # signaled when subscribers advance
+        self._eof = False
+        self._closed = False
+        self._proc = ManagedProcess(args, registry.chunk_size, stderr=subprocess.PIPE)
+        self._reader = threading.Thread(target=self._run, daemon=True)
+        self._reader.start()
+        threading.Thread(target=self._read_progress, daemon=True).start()
+
+    @property
+    def subscribers(self):
+        return len(self._positions)
+
+    @property
+    def joinable(self):
+        if self._closed:
+            return False
+        if self._ring.start == 0:
+            return True  # the whole stream is still buffered
+        return not self._eof and bool(self._header)
+
+    def subscribe(self):
+        token = object()
+        with self._lock:
+            if self._ring.start == 0:
+                self._positions[token] = 0
+            else:
+                # Late joiner, start with the header then the last keyframe
+                self._prefixes[token] = self._header
+                self._positions[token] = self._keyframes[-1] if self._keyframes else None
+        return Subscription(self, token)
+
+    def unsubscribe(self, token):
+        with self._lock:
+            self._positions.pop(token, None)
+            self._prefixes.pop(token, None)
+            self._room.notify_all()
+            return len(self._positions)
+
+    def read(self, token):
+        with self._lock:
+            prefix = self._prefixes.pop(token, None)
+            if prefix:
+                return prefix
+            while True:
+                position = self._positions[token]
+                if position is not None and position < self._ring.start:
+                    position = self._resync()
+                    self._positions[token] = position
+                if position is not None and position < self._ring.end:
+                    data = self._ring.read(position, self.registry.chunk_size)
+                    self._positions[token] = position + len(data)
+                    self._room.notify_all()
+                    return data
+                if self._eof or self._closed:
+                    return None
+                self._data.wait()
+                if self._positions[token] is None and self._keyframes:
+                    self._positions[token] = self._keyframes[-1]
+
+    def _resync(self):
+        # Lagging subscriber, skip to the oldest keyframe still buffered
+        for keyframe in self._keyframes:
+            if keyframe >= self._ring.start:
+                return keyframe
+        return None
+
+    def _run(self):
+        started = time.perf_counter()
+        try:
+            while not self._closed:
+                data = self._proc.read()
+                if not data:
+                    break
+                if not self.produced:
+                    encoder_start_seconds.observe(time.perf_counter() - started)
+                self.produced += len(data)
+                keyframes = self._scanner.feed(data) if self._scanner else []
+                with self._lock:
+                    self._ring.append(data)
+                    self._keyframes.extend(keyframes)
+                    if not self._header and self._scanner and self._scanner.header_size:
+                        self._header = self._ring.read_exactly(0, self._scanner.header_size)
+                    self._data.notify_all()
+                    self._make_room()
+        except (OSError, ValueError):
+            pass
+        finally:
+            with self._lock:
+                self._eof = True
+                self._data.notify_all()
+            try:
+                self._proc.close()
+            finally:
+                if self.slot:
+                    self.slot.release()
+
+    def _read_progress(self):
+        # ffmpeg writes -progress reports and its error messages to stderr
+        last = (time.perf_counter(), 0)
+        try:
+            for line in self._proc.stderr:
+                progress = parse_progress(line)
+                if progress is None:
+                    sys.stderr.write(line.decode(errors="replace"))
+                    continue
+                key, value = progress
+                if key == "speed" and value.endswith("x"):
+                    try:
+                        self.speed = float(value[:-1])
+                    except ValueError:
+                        pass
+                elif key == "fps":
+                    try:
+                        self.fps = float(value)
+                    except ValueError:
+                        pass
+                elif key == "progress":
+                    now = time.perf_counter()
+                    if now > last[0]:
+                        self.throughput = (self.produced - last[1]) / (now - last[0])
+                    last = (now, self.produced)
+        except (OSError, ValueError):
+            pass
+        finally:
+            self._proc.stderr.close()
+
+    def _make_room(self):
+        # Wait for lagging subscribers, then drop data they have not read yet
+        deadline = None
+        while len(self._ring) > self._ring.capacity and not self._closed:
+            end = self._ring.first_chunk_end()
+            lagging = any(p is not None and p < end for p in self._positions.values())
+            if lagging:
+                if deadline is None:
+                    deadline = time.time() + self.registry.lag_timeout
+                remaining = deadline - time.time()
+                if remaining > 0:
+                    self._room.wait(remaining)
+                    continue
+            start = self._ring.drop()
+            while self._keyframes and self._keyframes[0] < start:
+                self._keyframes.popleft()
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._data.notify_all()
+            self._room.notify_all()
+        try:
+            self._proc.close()
+        finally:
+            if self.slot:
+                self.slot.release()
+
+
+class SessionRegistry:
+    def __init__(
+        self,
+        buffer_size=DEFAULT_BUFFER_SIZE,
+        chunk_size=DEFAULT_CHUNK_SIZE,
+        lag_timeout=DEFAULT_LAG_TIMEOUT,
+        scheduler=None,
+    ):
+        self.scheduler = scheduler
+        self.buffer_size = buffer_size
+        self.chunk_size = chunk_size
+        self.lag_timeout = lag_timeout
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def subscribe(self, key, args, scanner=None, priority=PRIORITY_NORMAL):
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is not None and session.joinable:
+                return session.subscribe()
+        # Wait for an encoder slot without holding the registry lock
+        slot = self.scheduler.acquire(priority) if self.scheduler else None
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is not None and session.joinable:
+                if slot:
+                    slot.release()
+                return session.subscribe()
+            try:
+                session = TranscodeSession(self, key, args, scanner, slot)
+            except Exception:
+                if slot:
+                    slot.release()
+                raise
+            self._sessions[key] = session
+            return session.subscribe()
+
+    def release(self, session, token):
+        with self._lock:
+            if session.unsubscribe(token) > 0:
+                return
+            if self._sessions.get(session.key) is session:
+                del self._sessions[session.key]
+        session.close()
+
+    def describe(self):
+        with self._lock:
+            return [
+                {"key": list(s.key), "subscribers": s.subscribers, "created": s.created}
+                for s in self._sessions.values()
+            ]
+
+    def sessions(self):
+        with self._lock:
+            return list(self._sessions.values())
@@ -0,0 +1,175 @@
+// Copyright (C) 2017 by Paul-Louis Ageneau
+// paul-louis (at) ageneau (dot) org
+//
+// This file is part of Swamp.
+//
+// Swamp is free software: you can redistribute it and/or modify
+// it under the terms of the GNU Affero General Public License as
+// published by the Free Software Foundation, either version 3 of
+// the License, or (at your option) any later version.
+//
+// Swamp is distributed in the hope that it will be useful, but
+// WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+// GNU Affero General Public License for more details.
+//
+// You should have received a copy of the GNU Affero General Public
+// License along with Swamp.
+// If not, see <http://www.gnu.org/licenses/>
+
+var items = document.getElementById('items');
+var filters = document.getElementById('filters');
+var more = document.getElementById('more');
+var pageUrl = "";
+var pageNext = null;
+var pageRender = null;
+var pageLoading = false;
+var pageView = 0;
+
+// Pages are requested one after the other as the end of the list becomes visible
+if(window.IntersectionObserver) {
+	var observer = new IntersectionObserver(function(entries) {
+		if(entries[0].isIntersecting) loadPage();
+	});
+	observer.observe(more);
+}
+else {
+	more.onclick = loadPage;
+}
+
+function showView(url, render) {
+	pageView++;
+	pageUrl = url;
+	pageNext = "";
+	pageRender = render;
+	pageLoading = false;
+	items.innerHTML = "";
+	filters.innerHTML = "";
+	loadPage();
+}
+
+function loadPage() {
+	if(pageNext === null || pageLoading) return;
+	pageLoading = true;
+	more.style.display = '';
+	var view = pageView;
+	var request = new XMLHttpRequest();
+	var url = pageUrl + (pageUrl.indexOf('?') < 0 ? '?' : '&');
+	request.open('GET', url + "after=" + encodeURIComponent(pageNext), true);
+	request.setRequestHeader('Accept', 'application/json');
+	request.onload = function() {
+		if(view != pageView) return;  // another view was shown meanwhile
+		pageLoading = false;
+		if (this.status >= 200 && this.status < 400) {
+			var data = JSON.parse(this.response);
+			pageRender(data);
+			pageNext = data.next;
+		}
+		else {
+			pageNext = null;
+		}
+		more.style.display = (pageNext === null ? 'none' : '');
+		// Fill the screen if the end of the list is still visible
+		if(pageNext !== null && more.getBoundingClientRect().top < window.innerHeight) loadPage();
+	};
+	request.onerror = function() {
+		if(view != pageView) return;
+		pageLoading = false;
+		pageNext = null;
+		more.style.display = 'none';
+	};
+	request.send();
+}
+
+function addRow(icon, text, href, download) {
+	var row = items.insertRow(-1);
+	row.className = (items.rows.length % 2 ? 'odd' : 'even');
+	var cell = row.insertCell(-1);
+	cell.className = 'icon';
+	var img = document.createElement('img');
+	img.src = iconsUrl + icon;
+	cell.appendChild(img);
+	cell = row.insertCell(-1);
+	cell.className = 'name';
+	var a = document.createElement('a');
+	a.textContent = text;
+	if(typeof href == 'function') {
+		a.href = '#';
+		a.onclick = function() { href(); return false; };
+	}
+	else {
+		a.href = href;
+	}
+	cell.appendChild(a);
+	cell = row.insertCell(-1);
+	cell.className = 'actions';
+	if(download) {
+		a = document.createElement('a');
+		a.href = download;
+		img = document.createElement('img');
+		img.src = iconsUrl + 'download.png';
+		a.appendChild(img);
+		cell.appendChild(a);
+	}
+}
+
+function addFilter(text, onclick) {
+	var a = document.createElement('a');
+	a.href = '#';
+	a.textContent = text;
+	a.onclick = function() { onclick(); return false; };
+	filters.appendChild(document.createTextNode(' '));
+	filters.appendChild(a);
+}
+
+function fileLink(path) {
+	return fileUrl + path.split('/').map(encodeURIComponent).join('/');
+}
+
+function pad(n) {
+	return (n < 10 ? '0' : '') + n;
+}
+
+function showSeries() {
+	showView(libraryUrl + "/series", function(data) {
+		data.series.forEach(function(s) {
+			var text = s.title + " (" + s.episodes + " episodes)";
+			addRow('directory.png', text, function() { showEpisodes(s.title, null); });
+		});
+	});
+}
+
+function showEpisodes(title, season) {
+	var url = libraryUrl + "/series/" + encodeURIComponent(title);
+	if(season !== null) url+= "?season=" + season;
+	showView(url, function(data) {
+		if(data.seasons && data.seasons.length > 1) {
+			addFilter("All seasons", function() { showEpisodes(title, null); });
+			data.seasons.forEach(function(s) {
+				addFilter("Season " + s.season, function() { showEpisodes(title, s.season); });
+			});
+		}
+		data.episodes.forEach(function(e) {
+			var text = title + " S" + pad(e.season) + "E" + pad(e.episode);
+			var link = fileLink(e.path);
+			addRow('file.png', text, link + "?play", link + "?download");
+		});
+	});
+}
+
+function showMovies(year) {
+	var url = libraryUrl + "/movies" + (year !== null ? "?year=" + year : "");
+	showView(url, function(data) {
+		if(data.years && year === null) {
+			data.years.forEach(function(y) {
+				addFilter(String(y.year), function() { showMovies(y.year); });
+			});
+		}
+		data.movies.forEach(function(m) {
+			var link = fileLink(m.path);
+			addRow('file.png', m.title + " (" + m.year + ")", link + "?play", link + "?download");
+		});
+	});
+}
+
+showSeries();
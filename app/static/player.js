@@ -21,16 +21,34 @@ var video = document.getElementById('video');
 var videoSource = document.createElement('source');
 var player = document.getElementById('player');
 var castlinks = document.getElementById('castlinks');
+var caststatus = document.getElementById('caststatus');
 var progress = document.getElementById('progress');
 var progressbar = document.getElementById('progressbar');
+var preview = document.getElementById('preview');
 var playbutton = document.getElementById('playbutton');
 var videoUrl = "";
 var videoTime = 0;
 var castUrl = "";
+var castHost = "";
+var castTimer = null;
 var videoHeight = -1;
 var videoBaseTime = 0;
 var videoDuration = -1;
 var audioStream = 0;
+var segmented = video.canPlayType('application/vnd.apple.mpegurl') != '';
+// Without native HLS, fragmented MP4 segments are fed through Media Source Extensions
+var mseType = 'video/mp4; codecs="avc1.640028,mp4a.40.2"';
+var mse = !segmented && !!window.MediaSource && MediaSource.isTypeSupported(mseType);
+var mseSource = null;
+var mseBuffer = null;
+var mseSegments = [];  // start, duration and URL of each segment in the playlist
+var mseNext = 0;  // index of the next segment to append
+var mseLoading = null;  // pending segment request
+var mseAhead = 30;  // seconds buffered ahead of playback
+var mseBehind = 60;  // seconds kept behind playback
+var direct = false;
+var infoLoaded = false;
+var previews = [];  // seek previews from the WebVTT index
 
 video.appendChild(videoSource);
 
@@ -40,6 +58,20 @@ video.ontimeupdate = function() {
 	else videoTime = this.currentTime;
 	if(videoDuration > 0)
 		updateTimer();
+	if(mseBuffer)
+		appendSegments();
+}
+
+video.onseeking = video.onwaiting = function() {
+	// Restart fetching from the playback position if it is not buffered
+	if(!mseBuffer || isBuffered(this.currentTime))
+		return;
+	if(mseLoading) {
+		mseLoading.abort();
+		mseLoading = null;
+	}
+	mseNext = segmentAt(this.currentTime);
+	appendSegments();
 }
 
 video.onplay = function() {
@@ -62,7 +94,7 @@ playbutton.onclick = function() {
 
 progress.onmousedown = function(evt) {
 	evt.preventDefault();
-	loadVideo(videoUrl, videoDuration*(evt.clientX-this.offsetParent.offsetLeft)/progress.clientWidth);
+	seekVideo(videoDuration*(evt.clientX-this.offsetParent.offsetLeft)/progress.clientWidth);
 };
 
 document.onkeydown = function(evt) {
@@ -73,10 +105,10 @@ document.onkeydown = function(evt) {
 		else video.pause();
 		break;
 	case 37: // left
-		loadVideo(videoUrl, videoTime-30);
+		seekVideo(videoTime-30);
 		break;
 	case 39: // right
-		loadVideo(videoUrl, videoTime+30);
+		seekVideo(videoTime+30);
 		break;
 	default:
 		return;
@@ -96,6 +128,13 @@ function formatTime(time) {
 }
 
 function loadVideo(url, time) {
+	if(!infoLoaded) {
+		requestInfo(url, function() {
+			loadVideo(url, time);
+		});
+		return;
+	}
+
 	if(time < 0)
 		time = 0;
 	if(videoDuration >= 0 && time > videoDuration)
@@ -105,21 +144,193 @@ function loadVideo(url, time) {
 	videoBaseTime = videoTime = time;
 	updateTimer();
 
-	videoSource.setAttribute('src', videoUrl+"?audio="+audioStream+"&start="+formatTime(videoTime));
-	video.load();
+	if(direct || segmented) {
+		// Direct file or segmented stream, the browser seeks by itself
+		videoBaseTime = 0;
+		videoSource.setAttribute('src', direct ? videoUrl : videoUrl+"?format=hls&audio="+audioStream);
+		video.load();
+		video.addEventListener('loadedmetadata', function() {
+			video.currentTime = time;
+		}, {once: true});
+	} else if(mse) {
+		videoBaseTime = 0;
+		requestPlaylist(videoUrl+"?format=hls&audio="+audioStream, function(segments) {
+			openSource(segments, time);
+		});
+		return;
+	} else {
+		videoSource.setAttribute('src', videoUrl+"?audio="+audioStream+bandwidthHint()+"&start="+formatTime(videoTime));
+		video.load();
+	}
 	video.play();
+}
 
-	if(videoDuration < 0) {
-		var request = new XMLHttpRequest();
-		request.open('GET', videoUrl+"?info", true);
-		request.onload = function() {
-			if (this.status >= 200 && this.status < 400) {
+function bandwidthHint() {
+	// Estimated downlink in Mbit/s, if the browser exposes it
+	var connection = navigator.connection;
+	if(connection && connection.downlink)
+		return "&bandwidth="+Math.round(connection.downlink*1000000);
+	return "";
+}
+
+function requestInfo(url, callback) {
+	var request = new XMLHttpRequest();
+	request.open('GET', url+"?info&audio="+audioStream, true);
+	request.onload = function() {
+		if (this.status >= 200 && this.status < 400) {
 			var data = JSON.parse(this.response);
-				videoDuration = data.duration;
+			videoDuration = data.duration;
+			direct = (data.mode == "direct");
+		}
+		infoLoaded = true;
+		callback();
+	};
+	request.onerror = function() {
+		infoLoaded = true;
+		callback();
+	};
+	request.send();
+}
+
+function seekVideo(time) {
+	if(direct || segmented || mse) {
+		if(time < 0)
+			time = 0;
+		if(videoDuration >= 0 && time > videoDuration)
+			time = videoDuration;
+		video.currentTime = time;
+	} else {
+		loadVideo(videoUrl, time);
+	}
+}
+
+function requestPlaylist(url, callback) {
+	var request = new XMLHttpRequest();
+	request.open('GET', url, true);
+	request.onload = function() {
+		if (this.status >= 200 && this.status < 400) {
+			var playlist = parsePlaylist(this.responseText, this.responseURL || url);
+			if(playlist.variants.length) requestPlaylist(pickVariant(playlist.variants), callback);
+			else callback(playlist.segments);
+		}
+	};
+	request.send();
+}
+
+function parsePlaylist(text, baseUrl) {
+	var result = {variants: [], segments: []};
+	var lines = text.split('\n');
+	var bandwidth = 0;
+	var duration = 0;
+	var start = 0;
+	for (var i = 0; i < lines.length; i++) {
+		var line = lines[i].trim();
+		if(line.indexOf('#EXT-X-STREAM-INF:') == 0) {
+			var match = line.match(/BANDWIDTH=(\d+)/);
+			bandwidth = match ? parseInt(match[1]) : 1;
+		}
+		else if(line.indexOf('#EXTINF:') == 0) {
+			duration = parseFloat(line.substr(8));
+		}
+		else if(line && line.charAt(0) != '#') {
+			var url = new URL(line, baseUrl).href;
+			if(bandwidth) {
+				result.variants.push({bandwidth: bandwidth, url: url});
+				bandwidth = 0;
 			}
-		};
-		request.send();
+			else {
+				result.segments.push({start: start, duration: duration, url: url});
+				start+= duration;
+			}
+		}
 	}
+	return result;
+}
+
+function pickVariant(variants) {
+	// Best variant fitting the estimated downlink, the lowest one otherwise
+	var connection = navigator.connection;
+	var limit = (connection && connection.downlink ? connection.downlink*1000000*0.8 : Infinity);
+	var url = variants[0].url;
+	for (var i = 0; i < variants.length; i++)
+		if(variants[i].bandwidth <= limit) url = variants[i].url;
+	return url;
+}
+
+function openSource(segments, time) {
+	if(mseLoading) mseLoading.abort();
+	if(video.src) URL.revokeObjectURL(video.src);
+	mseSegments = segments;
+	mseLoading = null;
+	mseBuffer = null;
+	mseSource = new MediaSource();
+	mseSource.addEventListener('sourceopen', function() {
+		var last = segments[segments.length-1];
+		mseSource.duration = (videoDuration > 0 ? videoDuration : last.start + last.duration);
+		mseBuffer = mseSource.addSourceBuffer(mseType);
+		mseBuffer.addEventListener('updateend', appendSegments);
+		mseNext = segmentAt(time);
+		video.currentTime = time;
+		appendSegments();
+	}, {once: true});
+	video.src = URL.createObjectURL(mseSource);
+	video.play();
+}
+
+function appendSegments() {
+	if(!mseBuffer || mseBuffer.updating || mseLoading)
+		return;
+	var ranges = mseBuffer.buffered;
+	if(ranges.length && video.currentTime - ranges.start(0) > mseBehind) {
+		// Free played data, appending resumes once removed
+		mseBuffer.remove(0, video.currentTime - mseBehind/2);
+		return;
+	}
+	if(mseNext >= mseSegments.length) {
+		if(mseSource.readyState == 'open') mseSource.endOfStream();
+		return;
+	}
+	var segment = mseSegments[mseNext];
+	if(segment.start > video.currentTime + mseAhead)
+		return;  // resumed on time update
+	var request = new XMLHttpRequest();
+	mseLoading = request;
+	request.open('GET', segment.url+"&container=mp4", true);
+	request.responseType = 'arraybuffer';
+	request.onload = function() {
+		if(mseLoading != request) return;
+		mseLoading = null;
+		if (this.status >= 200 && this.status < 400) {
+			// Segments start at zero, place them at their position in the playlist
+			mseBuffer.timestampOffset = segment.start;
+			mseBuffer.appendBuffer(this.response);
+			mseNext++;
+		}
+		else {
+			setTimeout(appendSegments, 1000);  // no encoder available yet
+		}
+	};
+	request.onerror = function() {
+		if(mseLoading != request) return;
+		mseLoading = null;
+		setTimeout(appendSegments, 1000);
+	};
+	request.send();
+}
+
+function segmentAt(time) {
+	for (var i = 0; i < mseSegments.length; i++)
+		if(time < mseSegments[i].start + mseSegments[i].duration)
+			return i;
+	return Math.max(mseSegments.length-1, 0);
+}
+
+function isBuffered(time) {
+	var ranges = mseBuffer.buffered;
+	for (var i = 0; i < ranges.length; i++)
+		if(ranges.start(i) <= time && time < ranges.end(i) - 0.5)
+			return true;
+	return false;
 }
 
 function updateTimer() {
@@ -183,11 +394,145 @@ function requestCastLinks(url) {
 
 function requestCast(host) {
 	video.pause();
+	castHost = host || "";
+	sendCastCommand("play", "&audio="+audioStream+"&start="+formatTime(videoTime));
+}
+
+function sendCastCommand(command, query) {
+	// Commands are queued by the server, which answers with a job to wait for
 	var request = new XMLHttpRequest();
-	var url = castUrl+"?host="+(host || "")+"&audio="+audioStream+"&start="+formatTime(videoTime);
+	var url = castUrl+"?command="+command+"&host="+encodeURIComponent(castHost)+(query || "");
 	request.open('POST', url, true);
 	request.onload = function() {
-		// TODO
+		if (this.status >= 200 && this.status < 400) {
+			var data = JSON.parse(this.response);
+			waitCastJob(data.job);
+		}
+		else {
+			caststatus.textContent = " - Cast failed";
+		}
+	};
+	request.send();
+}
+
+function waitCastJob(job) {
+	var request = new XMLHttpRequest();
+	request.open('GET', castUrl+"?job="+job+"&wait", true);
+	request.onload = function() {
+		if (this.status >= 200 && this.status < 400) {
+			var data = JSON.parse(this.response);
+			if(data.state == "queued" || data.state == "running") {
+				waitCastJob(job);
+			}
+			else if(data.state == "failed") {
+				caststatus.textContent = " - Cast failed: "+data.error;
+			}
+			else {
+				requestCastStatus();
+			}
+		}
 	};
 	request.send();
 }
+
+function requestCastStatus() {
+	clearTimeout(castTimer);
+	var request = new XMLHttpRequest();
+	request.open('GET', castUrl+"?host="+encodeURIComponent(castHost), true);
+	request.onload = function() {
+		if (this.status >= 200 && this.status < 400) {
+			var status = JSON.parse(this.response).status;
+			if(status && status.state) {
+				showCastStatus(status);
+				if(status.state != "IDLE" && status.state != "UNKNOWN")
+					castTimer = setTimeout(requestCastStatus, 2000);
+			}
+		}
+	};
+	request.send();
+}
+
+function showCastStatus(status) {
+	caststatus.innerHTML = "";
+	var text = " - "+status.state.charAt(0)+status.state.slice(1).toLowerCase();
+	if(status.duration) text+= " "+formatTime(status.time)+" / "+formatTime(status.duration);
+	caststatus.appendChild(document.createTextNode(text+" "));
+	var commands = [];
+	if(status.state == "PLAYING" || status.state == "BUFFERING") commands.push(["pause", "Pause"]);
+	if(status.state == "PAUSED") commands.push(["resume", "Resume"]);
+	if(status.state != "IDLE" && status.state != "UNKNOWN") commands.push(["stop", "Stop"]);
+	commands.forEach(function(c) {
+		var a = document.createElement('a');
+		a.href = '#';
+		a.textContent = c[1];
+		a.onclick = function() { sendCastCommand(c[0]); return false; };
+		caststatus.appendChild(a);
+		caststatus.appendChild(document.createTextNode(" "));
+	});
+}
+
+progress.onmousemove = function(evt) {
+	if(!previews.length || videoDuration <= 0) return;
+	var x = evt.clientX - progress.getBoundingClientRect().left;
+	var time = videoDuration*x/progress.clientWidth;
+	var p = null;
+	for (var i = 0; i < previews.length; i++) {
+		if(previews[i].start <= time && time < previews[i].end) {
+			p = previews[i];
+			break;
+		}
+	}
+	if(!p) {
+		preview.style.display = 'none';
+		return;
+	}
+	preview.style.width = p.w+'px';
+	preview.style.height = p.h+'px';
+	preview.style.background = 'url("'+p.url+'") -'+p.x+'px -'+p.y+'px';
+	preview.style.left = Math.max(Math.min(x - p.w/2, progress.clientWidth - p.w), 0)+'px';
+	preview.style.display = 'block';
+}
+
+progress.onmouseleave = function() {
+	preview.style.display = 'none';
+}
+
+function requestPreviews(url) {
+	var request = new XMLHttpRequest();
+	request.open('GET', url, true);
+	request.onload = function() {
+		// Not generated yet is fine, previews will be there next time
+		if (this.status >= 200 && this.status < 400)
+			previews = parsePreviews(this.responseText, this.responseURL || url);
+	};
+	request.send();
+}
+
+function parsePreviews(text, baseUrl) {
+	var result = [];
+	var lines = text.split('\n');
+	for (var i = 0; i < lines.length - 1; i++) {
+		var times = lines[i].split(' --> ');
+		var target = lines[i+1].split('#xywh=');
+		if(times.length != 2 || target.length != 2) continue;
+		var xywh = target[1].split(',');
+		result.push({
+			start: parseVttTime(times[0]),
+			end: parseVttTime(times[1]),
+			url: new URL(target[0], baseUrl).href,
+			x: parseInt(xywh[0]),
+			y: parseInt(xywh[1]),
+			w: parseInt(xywh[2]),
+			h: parseInt(xywh[3])
+		});
+	}
+	return result;
+}
+
+function parseVttTime(str) {
+	var parts = str.trim().split(':');
+	var time = 0;
+	for (var i = 0; i < parts.length; i++)
+		time = time*60 + parseFloat(parts[i]);
+	return time;
+}
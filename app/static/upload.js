@@ -0,0 +1,129 @@
+// Copyright (C) 2017 by Paul-Louis Ageneau
+// paul-louis (at) ageneau (dot) org
+//
+// This file is part of Swamp.
+//
+// Swamp is free software: you can redistribute it and/or modify
+// it under the terms of the GNU Affero General Public License as
+// published by the Free Software Foundation, either version 3 of
+// the License, or (at your option) any later version.
+//
+// Swamp is distributed in the hope that it will be useful, but
+// WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+// GNU Affero General Public License for more details.
+//
+// You should have received a copy of the GNU Affero General Public
+// License along with Swamp.
+// If not, see <http://www.gnu.org/licenses/>
+
+var uploadChunkSize = 8*1024*1024;
+var uploadParallel = 3;
+var uploadRetries = 5;
+
+function canUploadChunks() {
+	return !!(window.XMLHttpRequest && window.Blob && Blob.prototype.slice);
+}
+
+function sendUploadRequest(method, url, headers, body, callback) {
+	var request = new XMLHttpRequest();
+	request.open(method, url, true);
+	for(var name in headers) request.setRequestHeader(name, headers[name]);
+	request.onload = function() { callback(this.status, this.response); };
+	request.onerror = function() { callback(0, null); };
+	request.send(body);
+}
+
+// Upload a file in chunks sent in parallel, resuming an interrupted upload of the same file
+function uploadFile(file, status, done) {
+	var key = 'upload:'+location.pathname+':'+file.name+':'+file.size+':'+file.lastModified;
+	var storage = window.localStorage || null;
+	var saved = storage ? storage.getItem(key) : null;
+
+	function create() {
+		var query = "?upload&name="+encodeURIComponent(file.name)+"&size="+file.size;
+		sendUploadRequest('POST', query, {}, null, function(code, response) {
+			if(code != 201) {
+				status.textContent = "Upload failed";
+				return;
+			}
+			var url = JSON.parse(response).location;
+			if(storage) storage.setItem(key, url);
+			send(url, [[0, file.size]]);
+		});
+	}
+
+	function send(url, missing) {
+		var chunks = [];
+		var total = 0;
+		missing.forEach(function(range) {
+			for(var start = range[0]; start < range[1]; start+= uploadChunkSize) {
+				chunks.push({start: start, stop: Math.min(start+uploadChunkSize, range[1]), tries: 0});
+			}
+			total+= range[1] - range[0];
+		});
+		var sent = 0;
+		var running = 0;
+		var failed = false;
+		var finished = false;
+
+		function next() {
+			if(failed || finished) return;
+			if(!chunks.length) {
+				if(!running) {
+					finished = true;
+					finish(url);
+				}
+				return;
+			}
+			var chunk = chunks.shift();
+			running++;
+			var headers = {'Upload-Offset': String(chunk.start), 'Content-Type': 'application/offset+octet-stream'};
+			sendUploadRequest('PATCH', url, headers, file.slice(chunk.start, chunk.stop), function(code) {
+				running--;
+				if(code == 200) {
+					sent+= chunk.stop - chunk.start;
+					status.textContent = "Uploading "+file.name+": "+Math.floor(100*sent/total)+"%";
+					next();
+				}
+				else if(++chunk.tries < uploadRetries) {
+					chunks.push(chunk);
+					setTimeout(next, 1000*chunk.tries);
+				}
+				else {
+					failed = true;
+					status.textContent = "Upload failed, choose the file again to resume";
+				}
+			});
+		}
+
+		status.textContent = "Uploading "+file.name+": 0%";
+		for(var i = 0; i < uploadParallel; i++) next();
+	}
+
+	function finish(url) {
+		sendUploadRequest('POST', url, {}, null, function(code) {
+			if(code == 201) {
+				if(storage) storage.removeItem(key);
+				done();
+			}
+			else {
+				status.textContent = "Upload failed";
+			}
+		});
+	}
+
+	if(!saved) {
+		create();
+		return;
+	}
+	sendUploadRequest('GET', saved, {'Accept': 'application/json'}, null, function(code, response) {
+		if(code == 200) {
+			send(saved, JSON.parse(response).missing);
+		}
+		else {
+			storage.removeItem(key);
+			create();
+		}
+	});
+}
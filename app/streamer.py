@@ -20,79 +20,444 @@
 """
 
 import subprocess
+import hashlib
+import json
 import os.path
+import math
 import re
 
+from .process import ManagedProcess
+from .metrics import probe_seconds, segment_seconds
+
 directory = "/home/public"
 
+SEGMENT_DURATION = 6  # seconds
+
+CAST_VIDEO_CODECS = ["h264", "vp8", "vp9"]
+
+COMPATIBLE_AUDIO_CODECS = {
+    "mp4": ["aac", "mp3"],
+    "webm": ["vorbis", "opus"],
+    "matroska": ["aac", "mp3", "vorbis", "opus"],
+}
+
+# Default quality ladder as (name, height, video bitrate in kbit/s)
+DEFAULT_RENDITIONS = [
+    ("480p", 480, 1500),
+    ("720p", 720, 3000),
+    ("1080p", 1080, 6000),
+]
+
+AUDIO_BITRATE = 128  # kbit/s
+
+DIRECT_EXTENSIONS = {
+    "mp4": ["mp4", "m4v"],
+    "webm": ["webm"],
+}
+
+
+def parse_time(value):
+    # Seconds from "[[hh:]mm:]ss", 0 if unset
+    if not value:
+        return 0
+    seconds = 0
+    for part in str(value).split(":"):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
 
 class Streamer:
-    def __init__(self, filename, stream_format="webm"):
+    def __init__(self, filename, stream_format="webm", database=None, renditions=None):
         self.filename = filename
+        self.source = filename  # file actually read, may be a pre-transcoded version
         self.stream_format = stream_format
+        self.database = database
+        self.renditions = sorted(renditions or DEFAULT_RENDITIONS, key=lambda r: r[2])
+        self.rendition = None
+        self.mode = "transcode"
+        self.output_format = stream_format
+        self._info = None
         if not os.path.isfile(filename):
             raise Exception("File does not exist: " + filename)
 
     def get_description(self):
+        info = self.get_info()
+        video = info["video"] or {}
+        return {
+            "mode": self.mode,
+            "rendition": self.rendition[0] if self.rendition else None,
+            "pretranscoded": self.source != self.filename,
+            "renditions": [r[0] for r in self.get_variants()],
+            "duration": info["duration"],
+            "width": video.get("width"),
+            "height": video.get("height"),
+            "audio": info["audio"],
+            "subtitles": info["subtitles"],
+        }
+
+    def get_info(self):
+        if self._info is None:
+            stat = os.stat(self.filename)
+            info = None
+            if self.database:
+                info = self.database.getMediaInfo(self.filename, stat.st_size, stat.st_mtime_ns)
+            if info is None:
+                info = self.probe()
+                if self.database:
+                    self.database.setMediaInfo(
+                        self.filename, stat.st_size, stat.st_mtime_ns, info
+                    )
+            self._info = info
+        return self._info
+
+    def probe(self):
         args = [
             "ffprobe",
             "-v", "error",
-            "-show_entries", "format=duration",
-            "-of", "default=noprint_wrappers=1:nokey=1",
+            "-print_format", "json",
+            "-show_format",
+            "-show_streams",
             self.filename,
         ]
-        out = subprocess.check_output(args, shell=False)
-        duration = float(out)
-        return {"duration": duration}
+        with probe_seconds.time():
+            out = subprocess.check_output(args, shell=False)
+        data = json.loads(out.decode())
+        fmt = data.get("format", {})
+        info = {
+            "duration": float(fmt.get("duration", 0)),
+            "format": fmt.get("format_name"),
+            "bit_rate": int(fmt.get("bit_rate", 0)),
+            "video": None,
+            "audio": [],
+            "subtitles": [],
+        }
+        for stream in data.get("streams", []):
+            codec_type = stream.get("codec_type")
+            tags = stream.get("tags", {})
+            if codec_type == "video" and info["video"] is None:
+                if stream.get("disposition", {}).get("attached_pic"):
+                    continue  # cover art
+                info["video"] = {
+                    "codec": stream.get("codec_name"),
+                    "profile": stream.get("profile"),
+                    "pix_fmt": stream.get("pix_fmt"),
+                    "width": stream.get("width"),
+                    "height": stream.get("height"),
+                }
+            elif codec_type == "audio":
+                info["audio"].append({
+                    "codec": stream.get("codec_name"),
+                    "channels": stream.get("channels"),
+                    "language": tags.get("language"),
+                    "title": tags.get("title"),
+                })
+            elif codec_type == "subtitle":
+                info["subtitles"].append({
+                    "codec": stream.get("codec_name"),
+                    "language": tags.get("language"),
+                    "title": tags.get("title"),
+                })
+        return info
+
+    def get_command(self, is_hd=False, start=None, stop=None, force_subtitles=False, audio=None):
+        args = ["ffmpeg"]
+        if start:
+            args += ["-ss", start]
+        args += ["-i", self.source]
+        if stop:
+            args += ["-to", stop]
+        if self.mode == "remux" or self.mode == "audio":
+            args += self._get_copy_args(audio)
+        else:
+            args += self._get_encoding_args(self.output_format, is_hd, force_subtitles, audio)
+        args += ["-progress", "pipe:2", "-v", "error", "-"]
+        return args
+
+    def select_rendition(self, name=None, bandwidth=None):
+        # Pick a rendition by name, or the best one fitting a bandwidth in bit/s
+        self.rendition = None
+        if name:
+            self.rendition = next((r for r in self.renditions if r[0] == name), None)
+            if self.rendition is None:
+                raise ValueError("Unknown rendition: " + name)
+        elif bandwidth:
+            fitting = [
+                r for r in self.renditions
+                if (r[2] + AUDIO_BITRATE) * 1000 <= bandwidth * 0.8
+            ]
+            self.rendition = fitting[-1] if fitting else self.renditions[0]
+        return self.rendition
+
+    def get_variants(self):
+        # Renditions not exceeding the source height, at least the lowest one
+        height = (self.get_info()["video"] or {}).get("height") or 0
+        variants = [r for r in self.renditions if r[1] <= height]
+        return variants or self.renditions[:1]
+
+    def select_mode(self, is_hd=False, start=None, force_subtitles=False, audio=None):
+        # Pick direct play, remux, audio-only transcode or full transcode
+        self.mode = "transcode"
+        self.output_format = "webm" if self.stream_format == "webm" else "matroska"
+        self.source = self.filename
+        if self.stream_format in ["webm", "matroska"] and not audio:
+            pretranscoded = self.get_pretranscoded()
+            if pretranscoded and (self.rendition is None or is_hd):
+                # H.264/AAC MP4, with subtitles already burnt in
+                self.source = pretranscoded
+                if self.stream_format == "webm":
+                    self.output_format = "mp4"
+                    self.mode = "remux" if parse_time(start) else "direct"
+                else:
+                    self.output_format = "matroska"
+                    self.mode = "remux"
+                return self.mode
+
+        info = self.get_info()
+        video = info["video"]
+        if self.stream_format not in ["webm", "matroska"] or video is None:
+            return self.mode
+        if self._get_subtitles_filter(force_subtitles):
+            return self.mode  # subtitles must be burnt in
+        if self.rendition and not is_hd:
+            if (video.get("height") or 0) > self.rendition[1]:
+                return self.mode  # must be downscaled
+            if info.get("bit_rate", 0) > (self.rendition[2] + AUDIO_BITRATE) * 1000:
+                return self.mode  # bitrate too high
+
+        if self.stream_format == "webm":  # browser
+            if video["codec"] == "h264" and video.get("pix_fmt") in [None, "yuv420p", "yuvj420p"]:
+                container = "mp4"
+            elif video["codec"] in ["vp8", "vp9"]:
+                container = "webm"
+            else:
+                return self.mode
+        else:  # Chromecast
+            if video["codec"] not in CAST_VIDEO_CODECS:
+                return self.mode
+            if (video.get("width") or 0) > 1920 or (video.get("height") or 0) > 1080:
+                return self.mode
+            container = "matroska"
+
+        tracks = info["audio"]
+        index = audio or 0
+        track = tracks[index] if 0 <= index < len(tracks) else None
+        self.output_format = container
+        if track is not None and track["codec"] not in COMPATIBLE_AUDIO_CODECS[container]:
+            self.mode = "audio"
+            return self.mode
+
+        ext = os.path.splitext(self.filename)[1][1:].lower()
+        is_direct = (
+            self.stream_format == "webm"
+            and not parse_time(start)
+            and not audio
+            and ext in DIRECT_EXTENSIONS[container]
+            and container in (info["format"] or "").split(",")
+        )
+        self.mode = "direct" if is_direct else "remux"
+        return self.mode
+
+    def get_pretranscoded(self):
+        if self.database is None:
+            return None
+        stat = os.stat(self.filename)
+        output = self.database.getTranscode(self.filename, stat.st_size, stat.st_mtime_ns)
+        if output and os.path.isfile(output):
+            return output
+        return None
+
+    def get_pretranscode_command(self, output):
+        # Offline encode playable as-is by browsers and Chromecast
+        filters = [r"scale=-2:min(ih\,1080)"]
+        subtitles = self._get_subtitles_filter(True)
+        if subtitles:
+            filters += [subtitles]
+        return [
+            "ffmpeg",
+            "-i", self.filename,
+            "-vf", ",".join(filters),
+            "-map", "0:v:0",
+            "-map", "0:a:0?",
+            "-c:v", "libx264",
+            "-preset", "medium",
+            "-crf", "21",
+            "-profile:v", "high",
+            "-level", "4.1",
+            "-pix_fmt", "yuv420p",
+            "-c:a", "aac",
+            "-b:a", "160k",
+            "-ac", "2",
+            "-ar", "48000",
+            "-movflags", "+faststart",
+            "-f", "mp4",
+            "-progress", "pipe:1",
+            "-nostats",
+            "-v", "error",
+            "-y", output,
+        ]
 
-    def get_stream(self, is_hd=False, start=None, stop=None, force_subtitles=False):
+    def get_master_playlist(self, query=""):
+        video = self.get_info()["video"] or {}
+        width = video.get("width") or 16
+        height = video.get("height") or 9
+        lines = ["#EXTM3U"]
+        for name, rendition_height, bitrate in self.get_variants():
+            rendition_width = int(round(rendition_height * width / height / 2)) * 2
+            lines.append(
+                "#EXT-X-STREAM-INF:BANDWIDTH={},RESOLUTION={}x{}".format(
+                    (bitrate + AUDIO_BITRATE) * 1000, rendition_width, rendition_height
+                )
+            )
+            lines.append("?format=hls&rendition={}{}".format(name, query))
+        return "\n".join(lines) + "\n"
+
+    def get_playlist(self, query=""):
+        duration = self.get_info()["duration"]
+        count = max(int(math.ceil(duration / SEGMENT_DURATION)), 1)
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:3",
+            "#EXT-X-PLAYLIST-TYPE:VOD",
+            "#EXT-X-TARGETDURATION:{}".format(SEGMENT_DURATION),
+            "#EXT-X-MEDIA-SEQUENCE:0",
+        ]
+        for index in range(count):
+            length = min(SEGMENT_DURATION, duration - index * SEGMENT_DURATION)
+            lines.append("#EXTINF:{:.3f},".format(max(length, 0)))
+            rendition = "&rendition=" + self.rendition[0] if self.rendition else ""
+            lines.append("?format=hls&segment={}{}{}".format(index, rendition, query))
+        lines.append("#EXT-X-ENDLIST")
+        return "\n".join(lines) + "\n"
+
+    def get_segment_name(
+        self, index, is_hd=False, force_subtitles=False, audio=None, container="mpegts"
+    ):
+        stat = os.stat(self.filename)
+        key = "{}|{}|{}|{}|{}|{}|{}|{}|{}".format(
+            self.filename, stat.st_size, stat.st_mtime_ns,
+            SEGMENT_DURATION, index, is_hd, force_subtitles, audio,
+            self.rendition,
+        )
+        extension = ".mp4" if container == "mp4" else ".ts"
+        return hashlib.sha1(key.encode()).hexdigest() + extension
+
+    def get_segment_command(
+        self, index, output, is_hd=False, force_subtitles=False, audio=None, container="mpegts"
+    ):
+        args = [
+            "ffmpeg",
+            "-ss", str(index * SEGMENT_DURATION),
+            "-i", self.filename,
+            "-t", str(SEGMENT_DURATION),
+        ]
+        if container == "mp4":
+            # Self-contained fragmented MP4 starting at zero for Media Source Extensions,
+            # the player offsets each segment by its position in the playlist
+            args += self._get_encoding_args("mp4", is_hd, force_subtitles, audio)
+            args += ["-v", "error", "-y", output]
+        else:
+            args += self._get_encoding_args("mpegts", is_hd, force_subtitles, audio)
+            args += ["-muxdelay", "0", "-muxpreload", "0", "-v", "error", "-y", output]
+        return args
+
+    def write_segment(
+        self, index, output, is_hd=False, force_subtitles=False, audio=None, container="mpegts"
+    ):
+        args = self.get_segment_command(index, output, is_hd, force_subtitles, audio, container)
+        with segment_seconds.time():
+            ManagedProcess.run(args)
+
+    def _get_filters(self, is_hd, force_subtitles):
         filters = []
-        if is_hd:
+        video = self.get_info()["video"] or {}
+        if is_hd and (video.get("width"), video.get("height")) != (1920, 1080):
             filters += [r"scale=-1:min(ih*1920/iw\,1080)"]
             filters += [r"pad=1920:1080:(1920-iw)/2:(1080-ih)/2:black"]
+        elif self.rendition and not is_hd:
+            filters += [r"scale=-2:min(ih\,{})".format(self.rendition[1])]
 
+        subtitles = self._get_subtitles_filter(force_subtitles)
+        if subtitles:
+            filters += [subtitles]
+        return filters
+
+    def _get_subtitles_filter(self, force_subtitles):
         if re.match("^[^\"'\\[\\]]+$", self.filename):
             base = os.path.splitext(self.filename)[0]
             srt = base + ".srt"
             srt_fr = os.path.splitext(self.filename)[0] + ".fr.srt"
             srt_en = os.path.splitext(self.filename)[0] + ".en.srt"
             if os.path.isfile(srt):
-                filters += ["subtitles=" + srt]
+                return "subtitles=" + srt
             elif os.path.isfile(srt_fr):
-                filters += ["subtitles=" + srt_fr + ":charenc=ISO-8859-15"]
+                return "subtitles=" + srt_fr + ":charenc=ISO-8859-15"
             elif os.path.isfile(srt_en):
-                filters += ["subtitles=" + srt_en + ":charenc=ISO-8859-1"]
-            elif force_subtitles and (
-                "codec_type=subtitle"
-                in subprocess.check_output(
-                    ["ffprobe", "-v", "error", "-show_streams", self.filename]
-                ).decode()
-            ):
-                filters += ["subtitles=" + self.filename]
+                return "subtitles=" + srt_en + ":charenc=ISO-8859-1"
+            elif force_subtitles and len(self.get_info()["subtitles"]) > 0:
+                return "subtitles=" + self.filename
+        return None
 
-        args = ["ffmpeg"]
-        if start:
-            args += ["-ss", start]
-        args += ["-i", self.filename]
-        if stop:
-            args += ["-to", stop]
+    def _get_copy_args(self, audio):
+        args = ["-map", "0:v:0", "-map", "0:a:{}?".format(int(audio or 0))]
+        args += ["-c:v", "copy"]
+        if self.mode == "audio":
+            args += ["-c:a", "libvorbis" if self.output_format == "webm" else "aac"]
+            args += ["-ac", "2", "-ar", "48000"]
+        else:
+            args += ["-c:a", "copy"]
+        if self.output_format == "mp4":
+            args += ["-movflags", "frag_keyframe+empty_moov+default_base_moof", "-f", "mp4"]
+        else:
+            args += ["-f", self.output_format]
+        args += ["-copyts"]
+        return args
+
+    def _get_video_bitrate(self, is_hd):
+        if self.rendition and not is_hd:
+            return "{}k".format(self.rendition[2])
+        return "8M" if is_hd else "3M"
+
+    def _get_encoding_args(self, stream_format, is_hd, force_subtitles, audio):
+        args = []
+        filters = self._get_filters(is_hd, force_subtitles)
         if len(filters):
             args += ["-vf", ",".join(filters)]
+        if audio is not None:
+            args += ["-map", "0:v:0", "-map", "0:a:{}?".format(int(audio))]
 
-        if self.stream_format == "webm":
+        if stream_format == "webm":
             args += [
                 "-c:v", "libvpx",
-                "-b:v", "8M" if is_hd else "3M",
+                "-b:v", self._get_video_bitrate(is_hd),
                 "-crf", "16",
                 "-quality", "realtime",
                 "-cpu-used", "8",
                 "-c:a", "libvorbis",
                 "-f", "webm",
             ]
+        elif stream_format == "mpegts":
+            args += [
+                "-c:v", "libx264",
+                "-b:v", self._get_video_bitrate(is_hd),
+                "-crf", "23",
+                "-preset", "veryfast",
+                "-c:a", "aac",
+                "-f", "mpegts",
+            ]
+        elif stream_format == "mp4":
+            args += [
+                "-c:v", "libx264",
+                "-b:v", self._get_video_bitrate(is_hd),
+                "-crf", "23",
+                "-preset", "veryfast",
+                "-c:a", "aac",
+                "-movflags", "frag_keyframe+empty_moov+default_base_moof",
+                "-f", "mp4",
+            ]
         else:  # matroska
             args += [
                 "-c:v", "libx264",
-                "-b:v", "8M" if is_hd else "3M",
+                "-b:v", self._get_video_bitrate(is_hd),
                 "-crf", "26",
                 "-preset", "veryfast",
                 "-tune", "zerolatency",
@@ -101,17 +466,19 @@ class Streamer:
                 "-f", "matroska",
             ]
 
-        args += [
-            "-ac", "2",
-            "-ar", "48000",
-            "-copyts",
-            "-v", "error",
-            "-",
-        ]
+        if self.rendition and not is_hd:
+            bitrate = self.rendition[2]
+            args += ["-maxrate", "{}k".format(bitrate), "-bufsize", "{}k".format(2 * bitrate)]
 
-        proc = subprocess.Popen(args, stdin=None, stdout=subprocess.PIPE, shell=False)
-        return proc.stdout
+        args += ["-ac", "2", "-ar", "48000"]
+        if stream_format != "mp4":
+            args += ["-copyts"]
+        return args
 
     @property
     def mimetype(self):
-        return "video/{}".format("webm" if self.stream_format == "webm" else "x-matroska")
+        if self.stream_format == "hls":
+            return "application/vnd.apple.mpegurl"
+        if self.output_format == "mp4":
+            return "video/mp4"
+        return "video/{}".format("webm" if self.output_format == "webm" else "x-matroska")
@@ -0,0 +1,191 @@
+"""
+    Copyright (C) 2017 by Paul-Louis Ageneau
+    paul-louis (at) ageneau (dot) org
+
+    This file is part of Swamp.
+
+    Swamp is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of
+    the License, or (at your option) any later version.
+
+    Swamp is distributed in the hope that it will be useful, but
+    WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public
+    License along with Swamp.
+    If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import collections
+import functools
+import hashlib
+import threading
+import queue
+import math
+import os
+
+from .process import ManagedProcess
+from .streamer import Streamer
+
+THUMBNAIL_WIDTH = 320  # pixels
+
+POSTER_POSITION = 0.1  # fraction of the duration where the poster frame is taken
+
+POSTER_MAX_TIME = 120  # seconds, the start of long videos is representative enough
+
+TILE_WIDTH = 160  # pixels of a preview in the sprite sheet
+
+TILE_COLUMNS = 10
+
+TILE_INTERVAL = 10  # minimal seconds between previews
+
+MAX_TILES = 100  # previews per sprite sheet
+
+QUEUE_SIZE = 256  # pending requests, more are dropped and requested again later
+
+FAILED_SIZE = 4096  # failed jobs remembered so that they are not requested again
+
+SUFFIXES = {"poster": "-poster.jpg", "sprite": "-sprite.jpg", "vtt": "-sprite.vtt"}
+
+
+class Thumbnailer:
+    """Poster frames and seek preview sprites of videos, generated in the background
+
+    Entries are named after a hash of (path, size, mtime) in a DiskCache. Lookups never
+    wait for generation, a missing entry is queued for the worker threads instead.
+    Failures are remembered by the same hash, so a file is tried again once it changes.
+    """
+
+    def __init__(self, database, cache, workers=1, niceness=10, queue_size=QUEUE_SIZE):
+        self.database = database
+        self.cache = cache
+        self.workers = max(workers, 1)
+        self.niceness = niceness
+        self.dropped = 0
+        self._queue = queue.Queue(queue_size)
+        self._queued = set()  # (key, kind) of queued or running jobs
+        self._failed = collections.OrderedDict()  # (key, kind) of failed jobs, oldest first
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def get(self, path, kind):
+        # Cache entry name for kind "poster", "sprite" or "vtt", None if not ready yet
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        key = "{}|{}|{}".format(path, stat.st_size, stat.st_mtime_ns)
+        key = hashlib.sha1(key.encode()).hexdigest()
+        name = key + SUFFIXES[kind]
+        if self.cache.get(name):
+            return name
+        self.request(path, "sprite" if kind == "vtt" else kind, key)
+        return None
+
+    def request(self, path, kind, key):
+        with self._lock:
+            if (key, kind) in self._queued or (key, kind) in self._failed:
+                return
+            self._queued.add((key, kind))
+        try:
+            self._queue.put_nowait((path, kind, key))
+        except queue.Full:
+            with self._lock:
+                self._queued.discard((key, kind))
+                self.dropped += 1
+
+    def start(self):
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def describe(self):
+        with self._lock:
+            return {
+                "queued": len(self._queued),
+                "dropped": self.dropped,
+                "failed": len(self._failed),
+            }
+
+    def _work(self):
+        while True:
+            path, kind, key = self._queue.get()
+            try:
+                if kind == "poster":
+                    generate = functools.partial(self._poster, path)
+                    self.cache.get_or_create(key + SUFFIXES["poster"], generate)
+                else:
+                    self._sprite(path, key)
+            except Exception as e:
+                print("Thumbnail generation failed for {}: {}".format(path, e))
+                with self._lock:
+                    self._failed[(key, kind)] = True
+                    if len(self._failed) > FAILED_SIZE:
+                        self._failed.popitem(last=False)
+            finally:
+                with self._lock:
+                    self._queued.discard((key, kind))
+
+    def _run(self, args):
+        ManagedProcess.run(["nice", "-n", str(self.niceness)] + args)
+
+    def _poster(self, path, output):
+        duration = Streamer(path, database=self.database).get_info()["duration"]
+        position = min(duration * POSTER_POSITION, POSTER_MAX_TIME)
+        args = ["ffmpeg", "-ss", "{:.3f}".format(position), "-i", path]
+        args += ["-map", "0:v:0", "-frames:v", "1"]
+        args += ["-vf", "scale={}:-2".format(THUMBNAIL_WIDTH), "-q:v", "4"]
+        args += ["-f", "mjpeg", "-v", "error", "-y", output]
+        self._run(args)
+
+    def _sprite(self, path, key):
+        info = Streamer(path, database=self.database).get_info()
+        video = info["video"] or {}
+        if not video.get("width") or not video.get("height"):
+            raise Exception("No video stream")
+        duration = info["duration"]
+        interval = max(TILE_INTERVAL, duration / MAX_TILES)
+        count = max(min(int(math.ceil(duration / interval)), MAX_TILES), 1)
+        width = TILE_WIDTH
+        height = max(int(round(TILE_WIDTH * video["height"] / video["width"] / 2)) * 2, 2)
+        columns = min(count, TILE_COLUMNS)
+        rows = int(math.ceil(count / columns))
+        name = key + SUFFIXES["sprite"]
+
+        def generate_sprite(output):
+            # Decoding only keyframes is much faster, previews need not be exact
+            args = ["ffmpeg", "-skip_frame", "nokey", "-i", path, "-map", "0:v:0"]
+            filters = "fps=1/{:.3f},scale={}:{},tile={}x{}"
+            args += ["-vf", filters.format(interval, width, height, columns, rows)]
+            args += ["-frames:v", "1", "-q:v", "5", "-f", "mjpeg", "-v", "error", "-y", output]
+            self._run(args)
+
+        def generate_vtt(output):
+            # WebVTT index of the previews, relative to the sprite sheet URL
+            lines = ["WEBVTT", ""]
+            for i in range(count):
+                start = i * interval
+                end = min((i + 1) * interval, duration) if i < count - 1 else duration
+                x = (i % columns) * width
+                y = (i // columns) * height
+                lines.append("{} --> {}".format(format_time(start), format_time(end)))
+                lines.append("{}#xywh={},{},{},{}".format(name, x, y, width, height))
+                lines.append("")
+            with open(output, "w") as f:
+                f.write("\n".join(lines))
+
+        self.cache.get_or_create(name, generate_sprite)
+        self.cache.get_or_create(key + SUFFIXES["vtt"], generate_vtt)
+
+
+def format_time(seconds):
+    # WebVTT timestamp "hh:mm:ss.mmm"
+    milliseconds = int(round(seconds * 1000))
+    hours, milliseconds = divmod(milliseconds, 3600000)
+    minutes, milliseconds = divmod(milliseconds, 60000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return "{:02d}:{:02d}:{:02d}.{:03d}".format(hours, minutes, seconds, milliseconds)
@@ -0,0 +1,97 @@
+"""
+    Copyright (C) 2017 by Paul-Louis Ageneau
+    paul-louis (at) ageneau (dot) org
+
+    This file is part of Swamp.
+
+    Swamp is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of
+    the License, or (at your option) any later version.
+
+    Swamp is distributed in the hope that it will be useful, but
+    WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public
+    License along with Swamp.
+    If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+
+BUFFER_SIZE = 1024 * 1024  # bytes read from the request per write
+
+
+def partial_path(path):
+    # Hidden file next to the destination, so that finishing is a rename
+    directory, name = os.path.split(path)
+    return os.path.join(directory, ".{}.upload-{}".format(name, os.urandom(4).hex()))
+
+
+def create_partial(partial):
+    fd = os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    os.close(fd)
+
+
+def write_chunk(partial, offset, stream, length):
+    # Write length bytes from stream at offset, returns the number actually written,
+    # less if the client went away. Chunks may be written concurrently.
+    written = 0
+    fd = os.open(partial, os.O_WRONLY)
+    try:
+        while written < length:
+            try:
+                data = stream.read(min(BUFFER_SIZE, length - written))
+            except Exception:
+                break  # client disconnected
+            if not data:
+                break
+            view = memoryview(data)
+            while view:
+                n = os.pwrite(fd, view, offset + written)
+                written += n
+                view = view[n:]
+    finally:
+        os.close(fd)
+    return written
+
+
+def finish_partial(partial, path):
+    # Move the complete file to path, False if a file appeared there meanwhile
+    try:
+        os.link(partial, path)  # unlike a rename, fails if path exists
+    except FileExistsError:
+        return False
+    except OSError:
+        # No hard links on this filesystem
+        if os.path.lexists(path):
+            return False
+        os.rename(partial, path)
+        return True
+    os.remove(partial)
+    return True
+
+
+def received(ranges):
+    # Bytes received contiguously from the start, the resume offset of a sequential upload
+    offset = 0
+    for start, stop in ranges:
+        if start > offset:
+            break
+        offset = max(offset, stop)
+    return offset
+
+
+def missing(ranges, size):
+    # Byte ranges still to be sent, as [start, stop] pairs
+    gaps = []
+    offset = 0
+    for start, stop in ranges:
+        if start > offset:
+            gaps.append([offset, start])
+        offset = max(offset, stop)
+    if offset < size:
+        gaps.append([offset, size])
+    return gaps
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+    Throughput of requests authenticated with HTTP Basic auth, with and without
+    the verified credential cache. Run from the repository root:
+
+        python3 benchmarks/auth_throughput.py [requests]
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import tempfile
+import atexit
+import shutil
+
+import flask
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config  # noqa: E402
+
+# Importing the app creates its database and caches, keep them out of the source tree
+SANDBOX = tempfile.mkdtemp(prefix="swamp-bench-")
+atexit.register(shutil.rmtree, SANDBOX, ignore_errors=True)
+config.DATABASE_FILE = os.path.join(SANDBOX, "database.db")
+config.FILES_DIRECTORY = os.path.join(SANDBOX, "files")
+config.CACHE_DIRECTORY = os.path.join(SANDBOX, "cache")
+
+from app.database import Database  # noqa: E402
+
+
+def run(filename, requests, credential_cache_size):
+    db = Database(filename, credential_cache_size=credential_cache_size)
+    app = flask.Flask(__name__)
+
+    @app.route("/")
+    def index():
+        auth = flask.request.authorization
+        if not auth or not db.authUser(auth.username, auth.password):
+            flask.abort(401)
+        return "ok"
+
+    client = app.test_client()
+    headers = {"Authorization": "Basic " + base64.b64encode(b"user:password").decode()}
+    start = time.perf_counter()
+    for _ in range(requests):
+        assert client.get("/", headers=headers).status_code == 200
+    elapsed = time.perf_counter() - start
+    db.close()
+    return {
+        "credential_cache": credential_cache_size > 0,
+        "requests": requests,
+        "requests_s": round(requests / elapsed, 1),
+        "mean_ms": round(elapsed / requests * 1000, 3),
+    }
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "database.db")
+        db = Database(filename)
+        db.init()
+        db.addUser("user", "password")
+        db.close()
+        for credential_cache_size in [0, 1024]:
+            print(json.dumps(run(filename, requests, credential_cache_size)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+    Latency of typical database calls as the number of concurrent clients grows
+
+    Each client resolves a link and a shared directory, then stores media
+    information, like a request playing a file. Run from the repository root:
+
+        python3 benchmarks/db_concurrency.py [calls per client] [pool size]
+"""
+
+import os
+import sys
+import json
+import time
+import tempfile
+import threading
+import atexit
+import shutil
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config  # noqa: E402
+
+# Importing the app creates its database and caches, keep them out of the source tree
+SANDBOX = tempfile.mkdtemp(prefix="swamp-bench-")
+atexit.register(shutil.rmtree, SANDBOX, ignore_errors=True)
+config.DATABASE_FILE = os.path.join(SANDBOX, "database.db")
+config.FILES_DIRECTORY = os.path.join(SANDBOX, "files")
+config.CACHE_DIRECTORY = os.path.join(SANDBOX, "cache")
+
+from app.database import Database  # noqa: E402
+
+
+def client(db, identifier, calls, latencies):
+    for i in range(calls):
+        start = time.perf_counter()
+        _, urlpath = db.resolveLink(identifier)
+        path, _ = db.resolveDirectory("user", urlpath)
+        db.setMediaInfo(path, i, i, {"duration": 60.0})
+        latencies.append(time.perf_counter() - start)
+
+
+def run(db, identifier, clients, calls):
+    latencies = []
+    threads = [
+        threading.Thread(target=client, args=(db, identifier, calls, latencies))
+        for _ in range(clients)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "clients": clients,
+        "requests_s": round(len(latencies) / elapsed),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95)] * 1000, 3),
+    }
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    pool_size = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    with tempfile.TemporaryDirectory() as directory:
+        shared = os.path.join(directory, "shared")
+        os.makedirs(shared)
+        db = Database(os.path.join(directory, "database.db"), pool_size)
+        db.init()
+        db.addUser("user", "password")
+        db.addDirectoryForUser(shared, "user")
+        identifier = db.createLink("user", "shared/movie.mkv")
+        for clients in [1, 4, 16, 64]:
+            print(json.dumps(run(db, identifier, clients, calls)))
+        db.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
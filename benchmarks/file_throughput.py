@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+    Download throughput of flask.send_file against the sendfile() delivery path
+
+    The server runs in this process under gevent, clients run in a separate
+    process so they do not compete for the event loop. Run from the repository root:
+
+        python3 benchmarks/file_throughput.py [clients] [megabytes]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import tempfile
+import subprocess
+import threading
+
+
+def client(port, path, clients, repeat):
+    # Download path concurrently and print the total bytes received
+    def fetch(results):
+        buf = bytearray(1024 * 1024)
+        total = 0
+        for _ in range(repeat):
+            with socket.create_connection(("127.0.0.1", port)) as sock:
+                request = "GET {} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n"
+                sock.sendall(request.format(path).encode())
+                while True:
+                    n = sock.recv_into(buf)
+                    if not n:
+                        break
+                    total += n
+        results.append(total)
+
+    results = []
+    threads = [threading.Thread(target=fetch, args=(results,)) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print(sum(results))
+
+
+def server(clients, megabytes):
+    from gevent import monkey
+
+    monkey.patch_all()
+
+    import flask
+    from gevent.pywsgi import WSGIServer, WSGIHandler
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import config
+
+    # Importing the app creates its database and caches, keep them out of the source tree
+    sandbox = tempfile.mkdtemp(prefix="swamp-bench-")
+    config.DATABASE_FILE = os.path.join(sandbox, "database.db")
+    config.FILES_DIRECTORY = os.path.join(sandbox, "files")
+    config.CACHE_DIRECTORY = os.path.join(sandbox, "cache")
+
+    from app.delivery import send_file, SendfileHandler
+
+    fd, filename = tempfile.mkstemp()
+    with os.fdopen(fd, "wb") as f:
+        block = os.urandom(1024 * 1024)
+        for _ in range(megabytes):
+            f.write(block)
+
+    app = flask.Flask(__name__)
+    app.add_url_rule("/flask", "flask", lambda: flask.send_file(filename))
+    app.add_url_rule("/delivery", "delivery", lambda: send_file(filename))
+
+    try:
+        for name, path, handler in [
+            ("flask.send_file", "/flask", WSGIHandler),
+            ("delivery, buffered", "/delivery", WSGIHandler),
+            ("delivery, sendfile", "/delivery", SendfileHandler),
+        ]:
+            http_server = WSGIServer(("127.0.0.1", 0), app, handler_class=handler, log=None)
+            http_server.start()
+            args = [sys.executable, __file__, "--client", str(http_server.server_port), path]
+            args += [str(clients), "4"]
+            start = time.time()
+            proc = subprocess.Popen(args, stdout=subprocess.PIPE)
+            while proc.poll() is None:
+                time.sleep(0.05)  # cooperative, lets the server run
+            elapsed = time.time() - start
+            total = int(proc.stdout.read())
+            http_server.stop()
+            result = {
+                "path": name,
+                "clients": clients,
+                "seconds": round(elapsed, 3),
+                "mb_s": round(total / elapsed / 1024 / 1024, 1),
+            }
+            print(json.dumps(result))
+    finally:
+        os.remove(filename)
+        shutil.rmtree(sandbox, ignore_errors=True)
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "--client":
+        port, path, clients, repeat = sys.argv[2:6]
+        client(int(port), path, int(clients), int(repeat))
+        return 0
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    megabytes = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+    server(clients, megabytes)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+    Time to list and render large directories with the former FileInfo
+    pipeline and template against the current ones, including the time to the
+    first chunk of a streamed listing. Run from the repository root:
+
+        python3 benchmarks/listing_throughput.py [entries...]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import atexit
+
+import flask
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config  # noqa: E402
+
+# Importing the app creates its database and caches, keep them out of the source tree
+SANDBOX = tempfile.mkdtemp(prefix="swamp-bench-")
+atexit.register(shutil.rmtree, SANDBOX, ignore_errors=True)
+config.DATABASE_FILE = os.path.join(SANDBOX, "database.db")
+config.FILES_DIRECTORY = os.path.join(SANDBOX, "files")
+config.CACHE_DIRECTORY = os.path.join(SANDBOX, "cache")
+
+import app  # noqa: E402
+
+# Listing before FileInfo had slots and the pipeline ran in one pass
+OLD_TEMPLATE = """{% extends "base.html" %}
+{% block content %}
+  <div id="files" class="box">
+    <table>
+    {% for file in files %}
+      <tr class="{{ loop.cycle('odd', 'even') }}">
+        <td class="icon"><img src="{{ url_for('static', filename=('icons/directory.png' if file.isdir else 'icons/file.png')) }}"></td>
+        <td class="name"><a href="{{ url_quote(file.name) + ('?play' if file.isvideo else '') }}">{{ file.name }}</a></td>
+        <td class="actions"><a href="{{ url_quote(file.name) + '?download' }}"><img src="{{ url_for('static', filename='icons/download.png') }}"></a><a href="{{ file.name + '?link' }}"><img src="{{ url_for('static', filename='icons/link.png') }}"></a>{% if file.writable %}<a href="#" onclick="deleteFile('{{file.name}}'); return false;"><img src="{{ url_for('static', filename='icons/delete.png') }}"></a>{% endif %}</td>
+      </tr>
+    {% endfor %}
+    </table>
+  </div>
+{% endblock %}"""
+
+
+class OldFileInfo:
+    def __init__(self, path, urlpath, writable=False):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.isdir = os.path.isdir(path)
+        self.ext = os.path.splitext(path)[1][1:]
+        self.isvideo = self.ext in ["avi", "mkv", "mp4"]
+        self.urlpath = urlpath
+        self.writable = writable
+
+
+def old_list_files(path, urlpath, writable):
+    files = [OldFileInfo(os.path.join(path, f), urlpath + f, writable) for f in os.listdir(path)]
+    files = list(
+        filter(lambda f: f.name[0] != "." and (f.isdir or app.allowed_file(f.name)), files)
+    )
+    files.sort(key=lambda f: "0" + f.name.lower() if f.isdir else "1" + f.name.lower())
+    return files
+
+
+def populate(path, entries):
+    # Mostly media files, with some directories, hidden and forbidden files
+    for i in range(entries):
+        name = "Entry {:07d}".format(entries - i)
+        if i % 20 == 0:
+            os.mkdir(os.path.join(path, name))
+            continue
+        if i % 20 == 1:
+            name = "." + name
+        elif i % 20 == 2:
+            name += ".php"
+        else:
+            name += [".mkv", ".mp3", ".jpg", ".srt"][i % 4]
+        open(os.path.join(path, name), "w").close()
+
+
+def timed(f, *args):
+    start = time.perf_counter()
+    result = f(*args)
+    return result, round((time.perf_counter() - start) * 1000, 1)
+
+
+def run(directory, entries):
+    path = os.path.join(directory, str(entries))
+    os.mkdir(path)
+    populate(path, entries)
+    context = {"path": "/", "writable": True}
+
+    old_files, old_list_ms = timed(old_list_files, path, "", True)
+    files, list_ms = timed(app.list_files, path, "", True)
+    assert [f.name for f in files] == [f.name for f in old_files]
+
+    with app.app.test_request_context("/file/"):
+        old_html, old_render_ms = timed(
+            lambda: flask.render_template_string(OLD_TEMPLATE, files=old_files, **context)
+        )
+        html, render_ms = timed(
+            lambda: flask.render_template("directory.html", files=files, **context)
+        )
+        start = time.perf_counter()
+        stream = app.render_listing("directory.html", files, **context).response
+        first_chunk_ms = round((time.perf_counter() - start) * 1000 + timed(next, stream)[1], 1)
+        for _ in stream:
+            pass
+        stream_ms = round((time.perf_counter() - start) * 1000, 1)
+
+    return {
+        "entries": entries,
+        "listed": len(files),
+        "old_list_ms": old_list_ms,
+        "list_ms": list_ms,
+        "old_render_ms": old_render_ms,
+        "render_ms": render_ms,
+        "stream_first_chunk_ms": first_chunk_ms,
+        "stream_ms": stream_ms,
+        "html_bytes": len(html),
+        "old_fileinfo_bytes": sys.getsizeof(old_files[0]) + sys.getsizeof(old_files[0].__dict__),
+        "fileinfo_bytes": sys.getsizeof(files[0]),
+    }
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10000, 100000]
+    directory = tempfile.mkdtemp()
+    try:
+        for entries in sizes:
+            print(json.dumps(run(directory, entries)))
+    finally:
+        shutil.rmtree(directory)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
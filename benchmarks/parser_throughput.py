@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+    File names classified per second on a synthetic corpus, with the per-name
+    Parser, the batch Classifier inline, in worker processes and memoized, then
+    times of PatternMusic alone and of classify_name(), which rejects names the
+    pattern cannot match before trying it, on pathological names.
+    Run from the repository root:
+
+        python3 benchmarks/parser_throughput.py [names] [processes]
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import atexit
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config  # noqa: E402
+
+# Importing the app creates its database and caches, keep them out of the source tree
+SANDBOX = tempfile.mkdtemp(prefix="swamp-bench-")
+atexit.register(shutil.rmtree, SANDBOX, ignore_errors=True)
+config.DATABASE_FILE = os.path.join(SANDBOX, "database.db")
+config.FILES_DIRECTORY = os.path.join(SANDBOX, "files")
+config.CACHE_DIRECTORY = os.path.join(SANDBOX, "cache")
+
+from app.parser import Parser, Classifier, classify_name  # noqa: E402
+
+PATHOLOGICAL = {
+    "tag brackets": lambda n: "[" + "a]-" * n + "(.mp3",
+    "reversed brackets": lambda n: "[" + "]a-" * n + ").mp3(",
+    "dashes and comments": lambda n: "[a]" + "a-" * n + ".(a).(.mp3",
+    "repeated extension": lambda n: "a-b.mp3" * n + "(",
+}
+
+WORDS = ["the", "black", "night", "river", "love", "of", "city", "lost", "blue", "song", "home"]
+TAGS = ["", "", "", "[HorribleSubs] ", "[1080p]."]
+OTHER_EXTENSIONS = ["txt", "nfo", "jpg", "srt", "pdf"]
+
+
+def words(rng, count):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, count)))
+
+
+def corpus(count, seed=0):
+    # Realistic mix of series, movies, music and other files
+    rng = random.Random(seed)
+    names = []
+    for i in range(count):
+        kind = rng.random()
+        if kind < 0.3:
+            name = "{}{}.S{:02d}E{:02d}.720p.{}".format(
+                rng.choice(TAGS),
+                words(rng, 3).replace(" ", "."),
+                rng.randint(1, 12),
+                rng.randint(1, 24),
+                rng.choice(["mkv", "mp4"]),
+            )
+        elif kind < 0.5:
+            name = "{} ({}) x264.{}".format(
+                words(rng, 4).title(), rng.randint(1950, 2025), rng.choice(["mkv", "avi"])
+            )
+        elif kind < 0.8:
+            name = "{:02d} - {} - {}.{}".format(
+                rng.randint(1, 20), words(rng, 2), words(rng, 5), rng.choice(["mp3", "flac"])
+            )
+        else:
+            name = "{}_{}.{}".format(words(rng, 3), i, rng.choice(OTHER_EXTENSIONS))
+        names.append(name)
+    return names
+
+
+def measure(label, names, classify):
+    start = time.perf_counter()
+    count = 0
+    for _ in classify(names):
+        count += 1
+    elapsed = time.perf_counter() - start
+    return {
+        "mode": label,
+        "names": count,
+        "names_s": round(count / elapsed),
+        "seconds": round(elapsed, 3),
+    }
+
+
+def match_ms(match, name, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        match(name)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best * 1000, 3)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    names = corpus(count)
+
+    print(json.dumps(measure("Parser", names, lambda names: map(Parser, names))))
+    classifier = Classifier(cache_size=count)
+    print(json.dumps(measure("Classifier", names, classifier.classify)))
+    print(json.dumps(measure("Classifier, memoized", names, classifier.classify)))
+    if processes > 1:
+        classifier = Classifier(processes, cache_size=count)
+        label = "Classifier, {} processes".format(processes)
+        print(json.dumps(measure(label, names, classifier.classify)))
+
+    for case, generate in PATHOLOGICAL.items():
+        for repeat in [20, 40, 80]:
+            name = generate(repeat)[:255]
+            result = {
+                "case": case,
+                "length": len(name),
+                "pattern_ms": match_ms(Parser.PatternMusic.match, name),
+                "classify_ms": match_ms(classify_name, name),
+            }
+            print(json.dumps(result))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+    Throughput of transcoding sessions with many concurrent clients
+
+    A synthetic producer stands in for ffmpeg so that only the pipe reading,
+    buffering and fan-out are measured. Run from the repository root:
+
+        python3 benchmarks/stream_throughput.py [streams] [megabytes] [chunk KiB]
+"""
+
+from gevent import monkey
+
+monkey.patch_all()
+
+import os
+import sys
+import json
+import time
+import atexit
+import shutil
+import tempfile
+import gevent
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config  # noqa: E402
+
+# Importing the app creates its database and caches, keep them out of the source tree
+SANDBOX = tempfile.mkdtemp(prefix="swamp-bench-")
+atexit.register(shutil.rmtree, SANDBOX, ignore_errors=True)
+config.DATABASE_FILE = os.path.join(SANDBOX, "database.db")
+config.FILES_DIRECTORY = os.path.join(SANDBOX, "files")
+config.CACHE_DIRECTORY = os.path.join(SANDBOX, "cache")
+
+from app.sessions import SessionRegistry  # noqa: E402
+
+
+def consume(subscription, results, delay=0):
+    size = 0
+    for data in subscription:
+        size += len(data)
+        gevent.sleep(delay)  # yield like a socket write would
+    results.append(size)
+
+
+def run(streams, megabytes, chunk_size, shared, slow=0):
+    registry = SessionRegistry(buffer_size=16 * 1024 * 1024, chunk_size=chunk_size, lag_timeout=1)
+    args = ["head", "-c", str(megabytes * 1024 * 1024), "/dev/zero"]
+    subscriptions = [
+        registry.subscribe(("bench",) if shared else ("bench", i), args) for i in range(streams)
+    ]
+    results = []
+    start = time.time()
+    greenlets = [
+        gevent.spawn(consume, s, results, 0.01 if i < slow else 0)
+        for i, s in enumerate(subscriptions)
+    ]
+    gevent.joinall(greenlets)
+    elapsed = time.time() - start
+    total = sum(results)
+    return {
+        "streams": streams,
+        "shared": shared,
+        "slow": slow,
+        "chunk_size": chunk_size,
+        "seconds": round(elapsed, 3),
+        "total_mb_s": round(total / elapsed / 1024 / 1024, 1),
+        "per_stream_mb_s": round(total / elapsed / 1024 / 1024 / streams, 1),
+    }
+
+
+def main():
+    streams = int(sys.argv[1]) if len(sys.argv) > 1 else 24
+    megabytes = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    chunk_size = int(sys.argv[3]) * 1024 if len(sys.argv) > 3 else 256 * 1024
+    for shared, slow in [(False, 0), (True, 0), (True, 2)]:
+        print(json.dumps(run(streams, megabytes, chunk_size, shared, slow)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
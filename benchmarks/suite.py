@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+"""
+    Benchmark suite driving the whole application, offline and reproducible
+
+    A synthetic share tree is generated in a temporary directory, with short test
+    videos made from ffmpeg lavfi sources. The application is then driven through
+    its WSGI interface and through a local gevent server to measure directory
+    listing latency, Basic auth throughput, link resolution among a million links,
+    time to first byte of streams and how many concurrent transcoded streams keep
+    up with real time. Stream measurements are skipped when ffmpeg is missing.
+
+    Results are written as one JSON document, a run can be compared with the
+    results of another commit. Run from the repository root:
+
+        python3 benchmarks/suite.py [--quick] [--output FILE] [--compare FILE]
+"""
+
+from gevent import monkey
+
+monkey.patch_all()
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import sqlite3
+import base64
+import argparse
+import platform
+import tempfile
+import contextlib
+import subprocess
+import http.client
+
+import gevent
+from gevent.pywsgi import WSGIServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import config  # noqa: E402
+
+USERNAME = "bench"
+PASSWORD = "password"
+
+LINK_LETTERS = "abcdefghijklmnopqrstuvwxyz0123456789"
+
+NAMES = [
+    "Show {i} S01E{j:02d} 720p.mkv",
+    "Show {i} S02E{j:02d}.mp4",
+    "Movie {i} {j} (2012).avi",
+    "Artist {i} - {j:02d} - Song.mp3",
+    "Show {i} S01E{j:02d} 720p.srt",
+    "Notes {i} {j}.txt",
+]
+
+SIZES = {
+    "full": {"dirs": 2000, "files": 20, "big": 10000, "links": 1000000, "videos": 4},
+    "quick": {"dirs": 200, "files": 10, "big": 2000, "links": 100000, "videos": 2},
+}
+
+
+def summarize(samples):
+    # Latency statistics in milliseconds
+    samples = sorted(samples)
+    count = len(samples)
+    if count == 0:
+        return {"n": 0}
+
+    def percentile(p):
+        return round(samples[min(int(count * p), count - 1)] * 1000, 3)
+
+    return {
+        "n": count,
+        "mean_ms": round(sum(samples) / count * 1000, 3),
+        "p50_ms": percentile(0.5),
+        "p90_ms": percentile(0.9),
+        "p99_ms": percentile(0.99),
+        "max_ms": round(samples[-1] * 1000, 3),
+    }
+
+
+def repeat(f, count):
+    samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        f()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def build_tree(share, dirs, files, big):
+    # Groups of directories with media-like names, and one large directory
+    for i in range(dirs):
+        path = os.path.join(share, "group-{:03d}".format(i // 100), "dir-{:05d}".format(i))
+        os.makedirs(path)
+        for j in range(files):
+            name = NAMES[j % len(NAMES)].format(i=i, j=j)
+            open(os.path.join(path, name), "w").close()
+    path = os.path.join(share, "big")
+    os.makedirs(path)
+    for j in range(big):
+        open(os.path.join(path, NAMES[j % len(NAMES)].format(i=j, j=j % 100)), "w").close()
+
+
+def make_videos(path, count, duration):
+    # Short H.264/AAC clips from synthetic sources, None if ffmpeg is missing
+    if shutil.which("ffmpeg") is None:
+        return None
+    os.makedirs(path)
+    names = []
+    for i in range(count):
+        name = "clip-{}.mkv".format(i)
+        args = ["ffmpeg", "-v", "error", "-y"]
+        args += ["-f", "lavfi", "-i", "testsrc2=size=1280x720:rate=25:duration={}".format(duration)]
+        args += ["-f", "lavfi", "-i", "sine=frequency={}:duration={}".format(440 + i, duration)]
+        args += ["-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p"]
+        args += ["-c:a", "aac", "-shortest", os.path.join(path, name)]
+        subprocess.check_call(args)
+        names.append(name)
+    return names
+
+
+def insert_links(filename, count, path):
+    # Bulk insert unexpired links, returns a sample of their identifiers
+    rng = random.Random(0)
+    conn = sqlite3.connect(filename)
+    user_id = conn.execute("SELECT id FROM user WHERE name = ?", (USERNAME,)).fetchone()[0]
+    expires_at = int(time.time()) + 365 * 24 * 60 * 60
+    identifiers = set()
+    while len(identifiers) < count:
+        identifiers.add("".join(rng.choice(LINK_LETTERS) for _ in range(8)))
+    identifiers = list(identifiers)
+    with conn:
+        conn.executemany(
+            "INSERT INTO link (identifier, user_id, path, timestamp, expires_at)"
+            " VALUES (?, ?, ?, ?, ?)",
+            ((identifier, user_id, path, 0, expires_at) for identifier in identifiers),
+        )
+    conn.close()
+    return rng.sample(identifiers, min(count, 10000))
+
+
+def basic_auth():
+    return "Basic " + base64.b64encode("{}:{}".format(USERNAME, PASSWORD).encode()).decode()
+
+
+def bench_listing(app, repeats):
+    client = app.app.test_client()
+    client.post("/login", data={"username": USERNAME, "password": PASSWORD})
+    headers = {"Accept": "text/html"}
+    results = {}
+    for name, url in [
+        ("shares", "/file/"),
+        ("small", "/file/share/group-000/dir-00000/"),
+        ("big", "/file/share/big/"),
+    ]:
+
+        def get():
+            response = client.get(url, headers=headers)
+            assert response.status_code == 200, response.status_code
+            response.get_data()
+
+        get()  # warm up the index and the template cache
+        results[name] = summarize(repeat(get, repeats))
+    return results
+
+
+def bench_auth_wsgi(app, requests):
+    client = app.app.test_client()
+    headers = {"Authorization": basic_auth(), "Accept": "text/html"}
+
+    def get():
+        assert client.get("/file/", headers=headers).status_code == 200
+
+    samples = repeat(get, requests)
+    result = summarize(samples)
+    result["requests_s"] = round(len(samples) / sum(samples), 1)
+    return result
+
+
+def bench_auth_server(port, requests, concurrency):
+    # Keep-alive clients sharing the requests
+    headers = {"Authorization": basic_auth(), "Accept": "text/html"}
+    samples = []
+
+    def client(count):
+        conn = http.client.HTTPConnection("127.0.0.1", port)
+        for _ in range(count):
+            start = time.perf_counter()
+            conn.request("GET", "/file/", headers=headers)
+            response = conn.getresponse()
+            response.read()
+            assert response.status == 200, response.status
+            samples.append(time.perf_counter() - start)
+        conn.close()
+
+    start = time.perf_counter()
+    clients = [gevent.spawn(client, requests // concurrency) for _ in range(concurrency)]
+    gevent.joinall(clients, raise_error=True)
+    elapsed = time.perf_counter() - start
+    result = summarize(samples)
+    result["concurrency"] = concurrency
+    result["requests_s"] = round(len(samples) / elapsed, 1)
+    return result
+
+
+def bench_links(app, identifiers, repeats):
+    samples = []
+    for identifier in identifiers:
+        start = time.perf_counter()
+        assert app.db.resolveLink(identifier) is not None
+        samples.append(time.perf_counter() - start)
+    client = app.app.test_client()
+
+    def get():
+        identifier = random.choice(identifiers)
+        response = client.get("/link/{}/?display".format(identifier))
+        assert response.status_code == 200, response.status_code
+
+    return {
+        "database": summarize(samples),
+        "wsgi": summarize(repeat(get, repeats)),
+    }
+
+
+def first_byte(port, url):
+    # Seconds to the first byte of the body, then the connection is dropped
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    start = time.perf_counter()
+    conn.request("GET", url)
+    response = conn.getresponse()
+    assert response.status == 200, response.status
+    response.read(1)
+    elapsed = time.perf_counter() - start
+    conn.close()
+    return elapsed
+
+
+def bench_first_byte(port, identifier, repeats):
+    # Distinct start times, so that each request spawns its own encoder
+    results = {}
+    for mode, query in [("remux", "format=webm"), ("transcode", "format=webm&rendition=480p")]:
+        samples = []
+        for i in range(repeats):
+            url = "/stream/{}/?{}&start=00:00:{:02d}".format(identifier, query, i % 10)
+            samples.append(first_byte(port, url))
+            gevent.sleep(0.1)  # let the server reap the encoder
+        results[mode] = summarize(samples)
+    return results
+
+
+def bench_capacity(port, identifiers, duration, max_streams):
+    # Double the number of concurrent transcoded streams until one falls behind
+    levels = []
+    streams = 1
+    while streams <= max_streams:
+        speeds = []
+        failures = []
+
+        def client(i):
+            identifier = identifiers[i % len(identifiers)]
+            start_time = i // len(identifiers) % (duration // 2)
+            url = "/stream/{}/?format=webm&rendition=480p&start=00:00:{:02d}".format(
+                identifier, start_time
+            )
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=duration * 10)
+            start = time.perf_counter()
+            try:
+                conn.request("GET", url)
+                response = conn.getresponse()
+                if response.status != 200:
+                    failures.append(response.status)
+                    return
+                while response.read(64 * 1024):
+                    pass
+                speeds.append((duration - start_time) / (time.perf_counter() - start))
+            except OSError as e:
+                failures.append(str(e))
+            finally:
+                conn.close()
+
+        gevent.joinall([gevent.spawn(client, i) for i in range(streams)])
+        level = {
+            "streams": streams,
+            "failures": len(failures),
+            "min_speed": round(min(speeds), 2) if speeds else None,
+            "mean_speed": round(sum(speeds) / len(speeds), 2) if speeds else None,
+        }
+        levels.append(level)
+        if failures or not speeds or min(speeds) < 1.0:
+            break
+        streams *= 2
+    sustained = [
+        level["streams"]
+        for level in levels
+        if not level["failures"] and level["min_speed"] is not None and level["min_speed"] >= 1.0
+    ]
+    return {"capacity": max(sustained) if sustained else 0, "levels": levels}
+
+
+def git_commit():
+    try:
+        out = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL
+        )
+        return out.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(results, prefix=""):
+    # Numeric leaves by dotted path, for comparisons
+    values = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, prefix + key + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[prefix + key] = value
+    return values
+
+
+def compare(baseline, current):
+    old = flatten(baseline["results"])
+    new = flatten(current["results"])
+    lines = ["{:<48} {:>12} {:>12} {:>8}".format("metric", "baseline", "current", "change")]
+    for key in sorted(set(old) & set(new)):
+        change = "{:+.1f}%".format((new[key] - old[key]) / old[key] * 100) if old[key] else ""
+        lines.append("{:<48} {:>12} {:>12} {:>8}".format(key, old[key], new[key], change))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Swamp benchmark suite")
+    parser.add_argument("--quick", action="store_true", help="smaller tree and fewer links")
+    parser.add_argument("--output", help="write results to this file instead of stdout")
+    parser.add_argument("--compare", help="results of a previous run to compare with")
+    parser.add_argument("--repeats", type=int, default=50, help="requests per latency test")
+    parser.add_argument("--requests", type=int, default=1000, help="requests per auth test")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent auth clients")
+    parser.add_argument("--links", type=int, help="link rows in the database")
+    parser.add_argument("--duration", type=int, default=20, help="seconds of test videos")
+    parser.add_argument("--max-streams", type=int, default=32, help="capacity test limit")
+    args = parser.parse_args()
+
+    sizes = dict(SIZES["quick" if args.quick else "full"])
+    if args.links is not None:
+        sizes["links"] = args.links
+    directory = tempfile.mkdtemp(prefix="swamp-bench-")
+    try:
+        # The application reads its configuration when imported
+        config.DEBUG = False
+        config.DATABASE_FILE = os.path.join(directory, "database.db")
+        config.FILES_DIRECTORY = os.path.join(directory, "files")
+        config.CACHE_DIRECTORY = os.path.join(directory, "cache")
+        config.MAX_TRANSCODES = args.max_streams
+        config.TRANSCODE_QUEUE_SIZE = args.max_streams
+        with contextlib.redirect_stdout(sys.stderr):
+            import app
+            from app.delivery import SendfileHandler
+
+        share = os.path.join(directory, "share")
+        start = time.perf_counter()
+        build_tree(share, sizes["dirs"], sizes["files"], sizes["big"])
+        videos = make_videos(os.path.join(share, "videos"), sizes["videos"], args.duration)
+        app.db.addUser(USERNAME, PASSWORD)
+        app.db.addDirectory(share, "share")
+        app.db.setDirectoryAccess(share, USERNAME, 2)
+        setup_seconds = time.perf_counter() - start
+
+        results = {}
+        start = time.perf_counter()
+        directories = app.indexer.scan()
+        results["index"] = {
+            "directories": directories,
+            "seconds": round(time.perf_counter() - start, 3),
+        }
+        print("Listing", file=sys.stderr)
+        results["listing"] = bench_listing(app, args.repeats)
+
+        print("Basic auth", file=sys.stderr)
+        server = WSGIServer(("127.0.0.1", 0), app.app, handler_class=SendfileHandler, log=None)
+        server.start()
+        try:
+            results["auth"] = {
+                "wsgi": bench_auth_wsgi(app, args.requests),
+                "server": bench_auth_server(server.server_port, args.requests, args.concurrency),
+            }
+
+            print("Links ({} rows)".format(sizes["links"]), file=sys.stderr)
+            start = time.perf_counter()
+            identifiers = insert_links(
+                config.DATABASE_FILE, sizes["links"], "share/group-000/dir-00000"
+            )
+            results["links"] = bench_links(app, identifiers, args.repeats)
+            results["links"]["rows"] = sizes["links"]
+            results["links"]["insert_seconds"] = round(time.perf_counter() - start, 3)
+
+            if videos is None:
+                print("ffmpeg not found, skipping streams", file=sys.stderr)
+                results["streams"] = None
+            else:
+                print("Streams", file=sys.stderr)
+                links = [app.db.createLink(USERNAME, "share/videos/" + v) for v in videos]
+                port = server.server_port
+                results["streams"] = {
+                    "first_byte": bench_first_byte(port, links[0], max(args.repeats // 5, 1)),
+                    "concurrent": bench_capacity(port, links, args.duration, args.max_streams),
+                }
+        finally:
+            server.stop()
+
+        document = {
+            "commit": git_commit(),
+            "time": int(time.time()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "sizes": sizes,
+            "setup_seconds": round(setup_seconds, 3),
+            "results": results,
+        }
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    output = json.dumps(document, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    if args.compare:
+        with open(args.compare) as f:
+            print(compare(json.load(f), document), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,3 +10,83 @@ PREFERRED_URL_SCHEME = "http"
 # Networks allowed to request casting
 # Local networks are always allowed
 CAST_ALLOWED_NETWORKS = []
+
+# Seconds a cast job status request may wait for the job to finish
+CAST_POLL_TIMEOUT = 20
+
+# Memory buffered per shared transcoding session, in bytes
+STREAM_BUFFER_SIZE = 16 * 1024 * 1024
+
+# Size of reads from ffmpeg and of writes to clients, in bytes
+STREAM_CHUNK_SIZE = 256 * 1024
+
+# Seconds to wait for a lagging viewer before dropping buffered data
+STREAM_LAG_TIMEOUT = 10
+
+# Directory for transcoding caches, defaults to app/cache
+CACHE_DIRECTORY = ""
+
+# Database file, defaults to app/database.db
+DATABASE_FILE = ""
+
+# Directory for private user files, defaults to app/files
+FILES_DIRECTORY = ""
+
+# Maximum size of the segment cache for segmented (HLS) streaming, in bytes
+SEGMENT_CACHE_SIZE = 4 * 1024 * 1024 * 1024
+
+# Client cache lifetime of encoded segments, in seconds
+SEGMENT_MAX_AGE = 24 * 60 * 60
+
+# Maximum number of concurrent ffmpeg encoders, 0 for half the CPU count
+MAX_TRANSCODES = 0
+
+# Maximum number of requests waiting for an encoder before answering 503
+TRANSCODE_QUEUE_SIZE = 16
+
+# Seconds a request may wait for an encoder
+TRANSCODE_QUEUE_TIMEOUT = 30
+
+# Retry-After value sent with 503 responses, in seconds
+TRANSCODE_RETRY_AFTER = 10
+
+# Quality ladder as (name, height, video bitrate in kbit/s)
+RENDITIONS = [
+    ("480p", 480, 1500),
+    ("720p", 720, 3000),
+    ("1080p", 1080, 6000),
+]
+
+# Number of background workers encoding shared videos ahead of time
+PRETRANSCODE_WORKERS = 1
+
+# Scheduling niceness of pre-transcoding processes
+PRETRANSCODE_NICENESS = 10
+
+# Run pre-transcoding workers inside the server process
+PRETRANSCODE_IN_PROCESS = False
+
+# Maximum number of open database connections
+DATABASE_POOL_SIZE = 8
+
+# Seconds between deletions of expired share links
+LINK_SWEEP_INTERVAL = 60 * 60
+
+# Seconds between rescans of shared directories for the file index
+INDEX_RESCAN_INTERVAL = 10 * 60
+
+# Default and maximum number of items per page when browsing the library
+LIBRARY_PAGE_SIZE = 100
+LIBRARY_MAX_PAGE_SIZE = 1000
+
+# Directory listings with at least this many entries are sent while being rendered
+LISTING_STREAM_THRESHOLD = 1000
+
+# Maximum size in bytes of the thumbnail and preview sprite cache
+THUMBNAIL_CACHE_SIZE = 512 * 1024 * 1024
+
+# Number of background workers generating thumbnails
+THUMBNAIL_WORKERS = 1
+
+# Seconds browsers may keep a thumbnail, its URL changes with the file
+THUMBNAIL_MAX_AGE = 365 * 24 * 60 * 60
@@ -0,0 +1,161 @@
+"""
+    Copyright (C) 2017 by Paul-Louis Ageneau
+    paul-louis (at) ageneau (dot) org
+
+    This file is part of Swamp.
+
+    Swamp is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of
+    the License, or (at your option) any later version.
+
+    Swamp is distributed in the hope that it will be useful, but
+    WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public
+    License along with Swamp.
+    If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import collections
+import threading
+
+CastInfo = collections.namedtuple("CastInfo", ["uuid", "host", "port", "friendly_name"])
+
+
+class FakeMediaController:
+    def __init__(self):
+        self.calls = []
+        self.status = FakeMediaStatus()
+
+    def play_media(self, url, mimetype, stream_type=None):
+        self.calls.append(("play_media", url, mimetype))
+        self.status.player_state = "PLAYING"
+
+    def pause(self):
+        self.calls.append(("pause",))
+        self.status.player_state = "PAUSED"
+
+    def play(self):
+        self.calls.append(("play",))
+        self.status.player_state = "PLAYING"
+
+    def seek(self, position):
+        self.calls.append(("seek", position))
+
+
+class FakeMediaStatus:
+    def __init__(self):
+        self.player_state = "IDLE"
+        self.adjusted_current_time = 0
+        self.duration = None
+
+
+class FakeChromecast:
+    """Device connection recording the calls made on it"""
+
+    def __init__(self, host, fail=False):
+        self.host = host
+        self.fail = fail
+        self.started = False
+        self.connected = False
+        self.media_controller = FakeMediaController()
+        self.status = None
+        self.volume = None
+
+    def start(self):
+        self.started = True
+        if self.fail:
+            raise ConnectionError("Unreachable: {}".format(self.host))
+        self.connected = True
+
+    def wait(self, timeout=None):
+        if not self.connected:
+            raise ConnectionError("Not connected: {}".format(self.host))
+
+    def disconnect(self):
+        self.connected = False
+
+    @property
+    def is_idle(self):
+        return self.media_controller.status.player_state == "IDLE"
+
+    def quit_app(self):
+        self.media_controller.status.player_state = "IDLE"
+
+    def set_volume(self, level):
+        self.volume = level
+
+
+class FakeCastBrowser:
+    """Discovery driven by the test through add, update and remove"""
+
+    def __init__(self, listener, zconf):
+        self.listener = listener
+        self.devices = {}  # uuid -> CastInfo
+        self.discovering = False
+
+    def start_discovery(self):
+        self.discovering = True
+
+    def stop_discovery(self):
+        self.discovering = False
+
+    def add(self, info):
+        self.devices[info.uuid] = info
+        self.listener.add_cast(info.uuid, "_googlecast._tcp.local.")
+
+    def update(self, info):
+        self.devices[info.uuid] = info
+        self.listener.update_cast(info.uuid, "_googlecast._tcp.local.")
+
+    def remove(self, uuid):
+        info = self.devices.pop(uuid)
+        self.listener.remove_cast(uuid, "_googlecast._tcp.local.", info)
+
+
+class FakeSimpleCastListener:
+    def __init__(self, add_callback=None, remove_callback=None, update_callback=None):
+        self.add_cast = add_callback
+        self.remove_cast = remove_callback
+        self.update_cast = update_callback
+
+
+class FakeDiscovery:
+    SimpleCastListener = FakeSimpleCastListener
+
+    def __init__(self):
+        self.browsers = []
+
+    def CastBrowser(self, listener, zconf):
+        browser = FakeCastBrowser(listener, zconf)
+        self.browsers.append(browser)
+        return browser
+
+
+class FakeBackend:
+    """Stand-in for the pychromecast module, casts to hosts in unreachable fail to start"""
+
+    def __init__(self, unreachable=()):
+        self.discovery = FakeDiscovery()
+        self.unreachable = set(unreachable)
+        self.casts = []  # every connection made, in order
+        self._lock = threading.Lock()
+
+    @property
+    def browser(self):
+        return self.discovery.browsers[-1]
+
+    def get_chromecast_from_cast_info(self, info, zconf):
+        return self._create(info.host)
+
+    def get_chromecast_from_host(self, host, tries=None, retry_wait=None, timeout=None):
+        return self._create(host[0])
+
+    def _create(self, host):
+        cast = FakeChromecast(host, fail=host in self.unreachable)
+        with self._lock:
+            self.casts.append(cast)
+        return cast
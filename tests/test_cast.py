@@ -0,0 +1,118 @@
+"""
+    Copyright (C) 2017 by Paul-Louis Ageneau
+    paul-louis (at) ageneau (dot) org
+
+    This file is part of Swamp.
+
+    Swamp is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of
+    the License, or (at your option) any later version.
+
+    Swamp is distributed in the hope that it will be useful, but
+    WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public
+    License along with Swamp.
+    If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import sys
+import time
+import unittest
+from unittest import mock
+
+from . import fake_chromecast
+from .fake_chromecast import CastInfo
+
+from app.cast import CastService, NoDevice  # noqa: E402
+
+cast_module = sys.modules[CastService.__module__]  # app.cast is also a view of the app
+
+JOB_TIMEOUT = 5  # seconds
+
+
+class CastServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.backend = fake_chromecast.FakeBackend()
+        self.service = CastService(backend=self.backend, zconf=object())
+        self.service.start()
+        self.browser = self.backend.browser
+
+    def tearDown(self):
+        self.service.stop()
+
+    def run_job(self, command, host=None, **args):
+        job_id = self.service.submit(command, host, **args)
+        return self.service.job(job_id, JOB_TIMEOUT)
+
+    def connection(self, host):
+        return next(c for c in reversed(self.backend.casts) if c.host == host)
+
+    def test_add(self):
+        self.browser.add(CastInfo("uuid-1", "10.0.0.1", 8009, "Living room"))
+        self.assertEqual(self.service.list(), [{"name": "Living room", "host": "10.0.0.1"}])
+        cast = self.connection("10.0.0.1")
+        self.assertTrue(cast.connected)
+
+        job = self.run_job("play", url="http://server/video", mimetype="video/mp4")
+        self.assertEqual(job["state"], "done")
+        self.assertEqual(job["host"], "10.0.0.1")
+        self.assertEqual(cast.media_controller.calls, [("play_media", "http://server/video", "video/mp4")])
+        self.assertEqual(self.service.status()["state"], "PLAYING")
+        self.assertEqual(len(self.backend.casts), 1)  # the connection is kept
+
+    def test_update_host_move(self):
+        self.browser.add(CastInfo("uuid-1", "10.0.0.1", 8009, "Living room"))
+        old = self.connection("10.0.0.1")
+        self.browser.update(CastInfo("uuid-1", "10.0.0.2", 8009, "Living room"))
+        self.assertEqual(self.service.list(), [{"name": "Living room", "host": "10.0.0.2"}])
+        self.assertFalse(old.connected)
+        new = self.connection("10.0.0.2")
+        self.assertTrue(new.connected)
+
+        job = self.run_job("volume", level=0.5)
+        self.assertEqual(job["state"], "done")
+        self.assertEqual(job["host"], "10.0.0.2")
+        self.assertEqual(new.volume, 0.5)
+        self.assertIsNone(old.volume)
+
+    def test_remove(self):
+        self.browser.add(CastInfo("uuid-1", "10.0.0.1", 8009, "Living room"))
+        cast = self.connection("10.0.0.1")
+        self.browser.remove("uuid-1")
+        self.assertEqual(self.service.list(), [])
+        self.assertFalse(cast.connected)
+        self.assertEqual(self.service.describe()["connections"], 0)
+        with self.assertRaises(NoDevice):
+            self.service.submit("pause")
+
+    def test_failed_connection_not_kept(self):
+        self.backend.unreachable.add("10.0.0.1")
+        self.browser.add(CastInfo("uuid-1", "10.0.0.1", 8009, "Living room"))
+        self.assertEqual(self.service.describe()["connections"], 0)
+
+        job = self.run_job("pause")
+        self.assertEqual(job["state"], "failed")
+        self.backend.unreachable.clear()
+        job = self.run_job("pause")
+        self.assertEqual(job["state"], "done")
+        self.assertTrue(self.connection("10.0.0.1").connected)
+        self.assertEqual(self.service.describe()["connections"], 1)
+
+    def test_idle_worker_exits(self):
+        with mock.patch.object(cast_module, "WORKER_IDLE_TIMEOUT", 0.05):
+            job = self.run_job("stop", "10.0.0.9")  # not discovered
+            self.assertEqual(job["state"], "done")
+            deadline = time.time() + JOB_TIMEOUT
+            while self.service._queues and time.time() < deadline:
+                time.sleep(0.01)
+        self.assertEqual(self.service._queues, {})
+        self.assertFalse(self.connection("10.0.0.9").connected)
+        self.assertEqual(self.service.describe()["connections"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
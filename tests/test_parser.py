@@ -0,0 +1,77 @@
+"""
+    Copyright (C) 2017 by Paul-Louis Ageneau
+    paul-louis (at) ageneau (dot) org
+
+    This file is part of Swamp.
+
+    Swamp is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of
+    the License, or (at your option) any later version.
+
+    Swamp is distributed in the hope that it will be useful, but
+    WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public
+    License along with Swamp.
+    If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import signal
+import unittest
+import multiprocessing
+
+from . import SANDBOX  # noqa: F401, sandboxes the app before it is imported
+
+from app.parser import Classifier, classify_name, _slot_values  # noqa: E402
+
+NAMES = [
+    "Show {i} S01E{j:02d} 720p.mkv",
+    "Movie {i} {j} (2012).avi",
+    "Artist {i} - {j:02d} - Song.mp3",
+    "Notes {i} {j}.txt",
+]
+
+
+def corpus(count):
+    return ["dir/" + NAMES[i % len(NAMES)].format(i=i, j=i % 30) for i in range(count)]
+
+
+class ClassifierTest(unittest.TestCase):
+    def assertClassified(self, names, records):
+        self.assertEqual(
+            [_slot_values(c) for c in records],
+            [_slot_values(classify_name(name)) for name in names],
+        )
+
+    def test_workers(self):
+        names = corpus(1000)
+        self.assertClassified(names, Classifier(processes=2).classify(names, chunk_size=50))
+        self.assertEqual(multiprocessing.active_children(), [])
+
+    def test_worker_death(self):
+        # Batches of dead workers, sent or not yet, are classified inline
+        names = corpus(1000)
+        records = Classifier(processes=2).classify(names, chunk_size=50)
+        first = next(records)
+        for process in multiprocessing.active_children():
+            os.kill(process.pid, signal.SIGKILL)
+            process.join()
+        self.assertClassified(names, [first] + list(records))
+        self.assertEqual(multiprocessing.active_children(), [])
+
+    def test_shutdown(self):
+        # Workers are stopped when the consumer gives up early
+        names = corpus(1000)
+        records = Classifier(processes=2).classify(names, chunk_size=50)
+        self.assertClassified(names[:10], [next(records) for _ in range(10)])
+        self.assertEqual(len(multiprocessing.active_children()), 2)
+        records.close()
+        self.assertEqual(multiprocessing.active_children(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()